@@ -1,11 +1,9 @@
-from concurrent import futures
-
-from easy2use.component import pbr
 from easy2use.globals import cli
 
 from ectoys.cmd import IntArg
 from ectoys.cmd import BoolArg
 from ectoys.cmd import log_arg_group
+from ectoys.common import conf
 from ectoys.common import exceptions
 from ectoys.managers.openstack import manager
 from ectoys.common import utils
@@ -14,6 +12,8 @@ from ectoys.common import log
 
 
 
+CONF = conf.CONF
+LOG = log.getLogger()
 parser = cli.SubCliParser('EC Cinder Utils')
 
 
@@ -33,13 +33,14 @@ def create_volume(args):
         raise exceptions.InvalidArgs(
             reason='--image and --snapshot can not specify both')
 
-    mgr = manager.OpenstackManager()
-    volumes = mgr.create_volumes(args.size, args.name, num=args.num,
-                                 image=args.image, snapshot=args.snapshot,
-                                 volume_type=args.type,
-                                 workers=args.workers)
-    utils.echo('new volumes:')
-    utils.echo(volumes, list_join='\n')
+    with manager.OpenstackManager() as mgr:
+        volumes = mgr.create_volumes(args.size, args.name, num=args.num,
+                                     image=args.image, snapshot=args.snapshot,
+                                     volume_type=args.type,
+                                     workers=args.workers)
+        mgr.client.report_pool_stats()
+        utils.echo('new volumes:')
+        utils.echo(volumes, list_join='\n')
 
 
 @parser.add_command(
@@ -47,36 +48,48 @@ def create_volume(args):
             help='Volume name., Defaults to ecToys'),
     IntArg('-w', '--worker', default=1, help='Workers. Defaults to 1'),
     BoolArg('-a', '--all', action='store_true', help='All tenants'),
+    BoolArg('-y', '--yes',
+            help='Delete the volumes while listing them, without asking'),
     log_arg_group)
 def cleanup_volume(args):
     """Cleanup Volume
     """
-    mgr = manager.OpenstackManager()
-    LOG.debug('Cleanup volume by name: %s', args.name)
-
-    found_volumes = [
-        vol for vol in mgr.client.list_volumes(all_tenants=args.all)
-        if vol.status == 'available' and (
-            (vol.name and vol.name.startswith(args.name))
+    with manager.OpenstackManager() as mgr:
+        LOG.debug('Cleanup volume by name: {}', args.name)
+
+        found_volumes = (
+            vol for vol in mgr.client.iter_volumes(
+                all_tenants=args.all, status='available', name_like=args.name,
+                detailed=False, page_size=CONF.openstack.list_page_size)
+            if vol.name and vol.name.startswith(args.name)
         )
-    ]
-    if not found_volumes:
-        utils.echo('Found 0 volume')
-        return
-    utils.echo(f'Found {len(found_volumes)} volume(s):')
-    for volume in found_volumes:
-        utils.echo(f'{volume.id} {volume.name}')
+        if args.yes:
+            deleted = mgr.delete_volumes(found_volumes, workers=args.worker,
+                                         all_tenants=args.all)
+            utils.echo(f'Deleted {deleted} volume(s)')
+            mgr.client.report_pool_stats()
+            return
+
+        found_volumes = list(found_volumes)
+        if not found_volumes:
+            utils.echo('Found 0 volume')
+            return
+        utils.echo(f'Found {len(found_volumes)} volume(s):')
+        for volume in found_volumes:
+            utils.echo(f'{volume.id} {volume.name}')
 
-    utils.echo()
+        utils.echo()
 
-    sure = utils.wait_user_input('Are you sure to cleanup this volumes (y/n):',
-                                 {'y', 'yes', 'n', 'no'},
-                                 'Please input (y/n):')
+        sure = utils.wait_user_input(
+            'Are you sure to cleanup this volumes (y/n):',
+            {'y', 'yes', 'n', 'no'}, 'Please input (y/n):')
 
-    if sure in {'n', 'no'}:
-        return
+        if sure in {'n', 'no'}:
+            return
 
-    mgr.delete_volumes(found_volumes, workers=args.worker)
+        mgr.delete_volumes(found_volumes, workers=args.worker,
+                           all_tenants=args.all)
+        mgr.client.report_pool_stats()
 
 
 @parser.add_command(
@@ -85,37 +98,24 @@ def cleanup_volume(args):
 def cleanup_rbd(args):
     """Cleanup RBD Image
     """
-    mgr = manager.OpenstackManager()
-    volumes = [
-        'volume-{}'.format(vol.id) for vol in mgr.client.list_volumes()]
-    lines = mgr.rbd_ls(args.pool)
-
-    delete_images = [
-        line for line in lines \
-            if line and line.startswith('volume') and line not in volumes]
-    LOG.info('Found %s image(s)', len(delete_images))
-    if not delete_images:
-        return
-    utils.echo(delete_images, list_join='\n')
-    utils.echo()
-
-    sure = utils.wait_user_input('Are you sure to cleanup all vms (y/n):',
-                                 {'y', 'yes', 'n', 'no'},
-                                 'Please input (y/n):')
-
-    if sure in {'n', 'no'}:
-        return
-
-    LOG.info('Try to delete %s image(s) with rbd', len(delete_images))
-    def delete_image(image):
-        return mgr.rbd_rm(args.pool, image)
-
-    bar = pbr.factory(len(delete_images))
-    with futures.ThreadPoolExecutor(max_workers=args.workers or 1) as executor:
-        LOG.info('Deleting, please be patient ...')
-        for _ in executor.map(delete_image, delete_images):
-            bar.update(1)
-        bar.close()
+    with manager.OpenstackManager() as mgr:
+        delete_images = mgr.find_orphan_rbd_images(args.pool)
+        LOG.info('Found {} image(s)', len(delete_images))
+        if not delete_images:
+            return
+        utils.echo(delete_images, list_join='\n')
+        utils.echo()
+
+        sure = utils.wait_user_input('Are you sure to cleanup all vms (y/n):',
+                                     {'y', 'yes', 'n', 'no'},
+                                     'Please input (y/n):')
+
+        if sure in {'n', 'no'}:
+            return
+
+        removed, failed = mgr.cleanup_rbd(args.pool, workers=args.workers,
+                                          images=delete_images)
+        LOG.info('Removed {} image(s), {} failed', len(removed), len(failed))
 
 
 def main():
@@ -1,5 +1,8 @@
-import libvirt
+import json
 import pathlib
+import sys
+
+import libvirt
 
 from easy2use.globals import cli
 from ectoys.cmd import BoolArg
@@ -28,6 +31,60 @@ def cmd(args):
     except libvirt.libvirtError as e:
         print(e)
 
+
+def _decode(data):
+    return data and data.decode(errors='replace')
+
+
+@parser.add_command(
+    cli.Arg('cmd', help='Command'),
+    cli.Arg('--host', action='append',
+            help='Guest host, can be specified multiple times. '
+                 'Defaults to localhost'),
+    cli.Arg('-d', '--domain', action='append',
+            help='Domain name or uuid, can be specified multiple times. '
+                 'Defaults to all the running domains of the hosts'),
+    cli.Arg('-p', '--pattern', help='Name pattern of the domains, e.g. vm-*'),
+    cli.Arg('--parallel', type=int, default=8,
+            help='The max number of the commands running on one host, '
+                 'the commands of all the hosts are started concurrently'),
+    cli.Arg('--timeout', type=int, default=60, help='Command timeout'),
+    log_arg_group)
+def fanout(args):
+    """Execute command on guests of the hosts by QGA
+
+    The results are printed as JSON lines when the commands finish.
+    """
+    hosts = args.host or ['localhost']
+    try:
+        guests, missing = guest.find_guests(hosts, domains=args.domain,
+                                            pattern=args.pattern)
+    except libvirt.libvirtError as e:
+        print(e)
+        return 1
+    failed = False
+    for name, error in missing.items():
+        failed = True
+        print(json.dumps({'domain': name, 'error': str(error)}), flush=True)
+    # start the commands of all the hosts at once
+    executor = guest.QGAExecutor(workers=args.parallel * len(hosts))
+    for instance, future in guest.fan_out(guests, args.cmd,
+                                          parallel=args.parallel,
+                                          timeout=args.timeout,
+                                          executor=executor):
+        line = {'host': instance.host, 'domain': instance.name_or_id}
+        try:
+            result = future.result()
+            line.update(exitcode=result.exitcode, out=_decode(result.out),
+                        err=_decode(result.err))
+            failed = failed or result.exitcode != 0
+        except Exception as e:
+            line['error'] = str(e)
+            failed = True
+        print(json.dumps(line), flush=True)
+    return 1 if failed else 0
+
+
 @parser.add_command(
     cli.Arg('domain', help='Domain name or id'),
     cli.Arg('xml', help='The path of xml file'),
@@ -52,7 +109,7 @@ def update_device(args):
 
 
 def main():
-    parser.call()
+    sys.exit(parser.call())
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
+import json
 import logging
 import sys
 import pathlib
@@ -9,6 +10,7 @@ from ectoys.common import conf
 from ectoys.common import exceptions
 from ectoys.common import utils
 from ectoys.common import log as context_log
+from ectoys.common.test import benchmark
 from ectoys.common.test import scenario
 
 CONF = conf.CONF
@@ -51,10 +53,43 @@ def vm_scenario_test(debug, conf_file):
             scenario.coroutine_test_vm()
         except Exception as e:
             LOG.error("test failed, {}", e)
+    elif CONF.scenario_test.mode == 'asyncio':
+        scenario.asyncio_test_vm()
     else:
         raise ValueError('Invalid config worker_mode')
 
 
+@main.command('benchmark')
+@click.option('-c', '--conf', 'conf_file')
+@click.option('-d', '--debug', default=False, is_flag=True)
+@click.option('-b', '--benchmark', 'names', multiple=True,
+              type=click.Choice(list(benchmark.BENCHMARKS)),
+              help='Benchmarks to run, defaults to all')
+@click.option('-n', '--num', type=int,
+              help='Number of resources, defaults to the size of benchmark')
+@click.option('-w', '--workers', type=int, default=10)
+@click.option('--fake', is_flag=True, help='Run with the fake backend')
+@click.option('-o', '--output', help='Write the results to the json file')
+def run_benchmark(debug, conf_file, names, num, workers, fake, output):
+    """Benchmark the scenario runner and the wait engine
+    """
+    context_log.basic_config(debug=debug)
+    log.basic_config(level=debug and logging.DEBUG or logging.INFO)
+
+    try:
+        conf.load_configs(conf_file=conf_file)
+        if not fake:
+            utils.load_env(CONF.openstack.env)
+    except (exceptions.ConfileNotExists, exceptions.InvalidConfig) as e:
+        LOG.error('load config failed, {}', e)
+        sys.exit(1)
+
+    results = benchmark.run_benchmarks(names=names, num=num, workers=workers,
+                                       backend=fake and 'fake' or None,
+                                       output=output)
+    if not output:
+        click.echo(json.dumps(results, indent=2))
+
 
 if __name__ == '__main__':
     main()
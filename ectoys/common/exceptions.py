@@ -61,6 +61,11 @@ class WaitVMStatusTimeout(base_exc.BaseException):
     _msg = 'wait {vm} status timeout, expect: {expect}, actual: {actual}'
 
 
+class WaitVolumeStatusTimeout(base_exc.BaseException):
+    _msg = 'wait volume {volume} status timeout, expect: {expect}, ' \
+           'actual: {actual}'
+
+
 class VMIsError(base_exc.BaseException):
     _msg = 'vm {vm} status is error'
 
@@ -117,5 +122,9 @@ class InvalidImage(base_exc.BaseException):
     _msg = 'Invalid image, reason: {reason}.'
 
 
+class QuotaNotEnough(base_exc.BaseException):
+    _msg = 'Quota is not enough, {reason}.'
+
+
 class VMTestFailed(base_exc.BaseException):
     _msg = 'vm {vm} {action} falied, {reason}.'
@@ -0,0 +1,290 @@
+"""
+Prometheus metrics of the live runs
+
+The metrics are rendered in the Prometheus text format, they can be scraped
+from a HTTP endpoint or written to a file for the textfile collector of
+node_exporter. Both are disabled by default, see the [metrics] options.
+"""
+import atexit
+import collections
+from http import server
+import os
+import re
+import threading
+import time
+
+from easy2use.globals import cfg
+
+from ectoys.common import log
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+DEFAULT_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600]
+ID_PATTERN = re.compile(
+    r'/([0-9a-f]{8}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{4}-?[0-9a-f]{12}'
+    r'|[0-9a-f]{32}|[0-9]+)(?=/|$)')
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace(
+        '"', r'\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(f'{k}="{_escape(v)}"' for k, v in labels)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+    def _samples(self):
+        raise NotImplementedError()
+
+    def render(self, const_labels=()):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.type}']
+        for suffix, labels, value in self._samples():
+            lines.append(f'{self.name}{suffix}'
+                         f'{_format_labels(tuple(const_labels) + labels)} '
+                         f'{_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    """Counter, the name should end with _total"""
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield '', tuple(zip(self.labelnames, key)), value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames=labelnames)
+        if not self.labelnames:
+            self._values[()] = 0
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield '', tuple(zip(self.labelnames, key)), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=None):
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS) + [float('inf')]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * len(self.buckets), 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        with self._lock:
+            values = {k: (list(v[0]), v[1]) for k, v in self._values.items()}
+        for key, (counts, total) in sorted(values.items()):
+            labels = tuple(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', labels + (('le', _format_value(bound)),), \
+                    cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self.const_labels = ()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render(const_labels=self.const_labels))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+VMS_IN_FLIGHT = REGISTRY.register(Gauge(
+    'ectoys_vms_in_flight', 'VM tests which are running'))
+ACTIONS = REGISTRY.register(Counter(
+    'ectoys_actions_total', 'Finished actions', ['scenario', 'result']))
+ACTION_DURATION = REGISTRY.register(Histogram(
+    'ectoys_action_duration_seconds', 'Duration of the scenario phases',
+    ['scenario', 'phase']))
+API_REQUESTS = REGISTRY.register(Counter(
+    'ectoys_api_requests_total', 'API requests',
+    ['service', 'method', 'endpoint']))
+API_ERRORS = REGISTRY.register(Counter(
+    'ectoys_api_errors_total', 'Failed API requests',
+    ['service', 'method', 'endpoint', 'code']))
+API_RETRIES = REGISTRY.register(Counter(
+    'ectoys_api_retries_total', 'API requests sent again after Retry-After',
+    ['service']))
+NOTIFICATIONS = REGISTRY.register(Counter(
+    'ectoys_notifications_total', 'Received notifications', ['event_type']))
+POLLS = REGISTRY.register(Counter(
+    'ectoys_polls_total',
+    'Status polls, probes of single waits and batched lists', ['kind']))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    'ectoys_cache_lookups_total', 'Lookups of the resource cache',
+    ['kind', 'result']))
+
+
+def normalize_endpoint(path):
+    """Replace the ids in the url path, e.g. /servers/{id}/action"""
+    path = path.split('?', 1)[0]
+    return ID_PATTERN.sub('/{id}', path) or '/'
+
+
+def observe_phase(scenario, phase, duration):
+    ACTION_DURATION.observe(duration, scenario=scenario, phase=phase)
+
+
+def observe_action(scenario, success=True):
+    """Count the action once, it's failed if any phase of it failed"""
+    ACTIONS.inc(scenario=scenario, result='success' if success else 'failed')
+
+
+def observe_request(service, method, endpoint, code=None):
+    """Count the request, code is the error status code or exception name"""
+    API_REQUESTS.inc(service=service, method=method, endpoint=endpoint)
+    if code:
+        API_ERRORS.inc(service=service, method=method, endpoint=endpoint,
+                       code=code)
+
+
+class _MetricsHandler(server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = REGISTRY.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address='0.0.0.0'):
+    httpd = server.ThreadingHTTPServer((address, port), _MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, name='metrics-http',
+                     daemon=True).start()
+    LOG.info('serving metrics on http://{}:{}/metrics', address, port)
+    return httpd
+
+
+def write_textfile(path):
+    tmp_file = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp_file, path)
+
+
+_TEXTFILE = None
+
+
+def flush():
+    """Write the current values to the textfile if it's enabled"""
+    if _TEXTFILE:
+        write_textfile(_TEXTFILE)
+
+
+def start_textfile_writer(path, interval=15):
+    global _TEXTFILE
+
+    def _write_loop():
+        while True:
+            try:
+                write_textfile(path)
+            except OSError as e:
+                LOG.warning('write metrics to {} failed: {}', path, e)
+            time.sleep(interval)
+
+    _TEXTFILE = path
+    threading.Thread(target=_write_loop, name='metrics-textfile',
+                     daemon=True).start()
+    # write the final values
+    atexit.register(flush)
+    LOG.info('writing metrics to {} every {}s', path, interval)
+
+
+def start(worker=None):
+    """Start the exporters enabled in config
+
+    In process mode every worker process has its own metrics, they are
+    labeled with the worker index, served on the port plus the index and
+    written to the textfile with the index suffix.
+    """
+    port, textfile = CONF.metrics.port, CONF.metrics.textfile
+    if worker is not None:
+        REGISTRY.const_labels = (('worker', str(worker)),)
+        port = port and port + worker
+        if textfile:
+            root, ext = os.path.splitext(textfile)
+            textfile = f'{root}-{worker}{ext}'
+    if port:
+        start_http_server(port, address=CONF.metrics.address)
+    if textfile:
+        start_textfile_writer(textfile,
+                              interval=CONF.metrics.textfile_interval)
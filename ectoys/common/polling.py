@@ -0,0 +1,197 @@
+"""
+Polling policies for the wait engine
+
+A policy yields the delays between two probes: a fast first probe,
+an optional jump close to the expected duration learned from the past runs,
+then an exponential backoff with jitter.
+"""
+import asyncio
+import atexit
+import json
+import os
+import random
+import threading
+import time
+
+from easy2use.globals import cfg
+
+from ectoys.common import exceptions
+from ectoys.common import exporter
+from ectoys.common import log
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+POLICY_FIXED = 'fixed'
+POLICY_BACKOFF = 'backoff'
+POLICIES = [POLICY_FIXED, POLICY_BACKOFF]
+
+# jump to this ratio of the expected duration after the first probe
+EXPECTED_RATIO = 0.9
+
+
+class PollingPolicy(object):
+
+    def __init__(self, interval=5, first=None, factor=1, max_interval=None,
+                 jitter=0, expected=None):
+        self.interval = interval
+        self.first = interval if first is None else first
+        self.factor = factor
+        self.max_interval = max_interval or interval
+        self.jitter = jitter
+        self.expected = expected
+
+    def _jitter(self, delay):
+        if not self.jitter:
+            return delay
+        return max(delay * (1 + random.uniform(-self.jitter, self.jitter)),
+                   0)
+
+    def delays(self):
+        yield self._jitter(self.first)
+        if self.expected and self.expected * EXPECTED_RATIO > self.first:
+            yield self._jitter(self.expected * EXPECTED_RATIO - self.first)
+
+        delay = self.first if self.factor > 1 else self.interval
+        while True:
+            yield self._jitter(delay)
+            delay = min(delay * self.factor, self.max_interval)
+
+
+class DurationHints(object):
+    """Expected durations of operations, learned with moving average
+
+    The hints are loaded from and saved to a json file if the path is set.
+    The worker processes don't save the file, their learned hints are
+    merged by the parent process, which saves them once.
+    """
+
+    def __init__(self, path=None, alpha=0.3):
+        self.path = path
+        self.alpha = alpha
+        self._durations = {}
+        # the operations recorded in this process
+        self._recorded = set()
+        self._lock = threading.Lock()
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self._durations = json.load(f)
+            except (OSError, ValueError) as e:
+                LOG.warning('load duration hints from {} failed: {}',
+                            self.path, e)
+
+    def get(self, op):
+        return self._durations.get(op)
+
+    def record(self, op, duration):
+        with self._lock:
+            expected = self._durations.get(op)
+            self._durations[op] = duration if expected is None else \
+                expected + self.alpha * (duration - expected)
+            self._recorded.add(op)
+
+    def learned(self):
+        """The hints of the operations recorded in this process"""
+        with self._lock:
+            return {op: self._durations[op] for op in self._recorded}
+
+    def merge(self, learned_list):
+        """Merge the hints learned by the workers, use their mean
+
+        The workers start from the same hints, so the mean of the learned
+        ones is taken.
+        """
+        durations = {}
+        for learned in learned_list:
+            for op, duration in learned.items():
+                durations.setdefault(op, []).append(duration)
+        with self._lock:
+            for op, values in durations.items():
+                self._durations[op] = sum(values) / len(values)
+                self._recorded.add(op)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            durations = dict(self._durations)
+        tmp_file = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(durations, f, indent=2)
+        os.replace(tmp_file, self.path)
+        LOG.debug('saved duration hints to {}', self.path)
+
+
+_HINTS = None
+
+
+def get_hints():
+    global _HINTS
+
+    if _HINTS is None:
+        _HINTS = DurationHints(path=CONF.scenario_test.poll_hints_file)
+        atexit.register(_HINTS.save)
+    return _HINTS
+
+
+def get_policy_name(op):
+    if op == 'boot' and CONF.boot.poll_policy:
+        name = CONF.boot.poll_policy
+    else:
+        overrides = dict(item.split(':', 1)
+                         for item in CONF.scenario_test.poll_policies)
+        name = overrides.get(op, CONF.scenario_test.poll_policy)
+    if name not in POLICIES:
+        raise exceptions.InvalidConfig(
+            reason=f'poll policy of {op} must be one of {POLICIES}')
+    return name
+
+
+def get_policy(op, interval=5):
+    """Get the polling policy of the operation from config
+
+    interval is used by the fixed policy.
+    """
+    if get_policy_name(op) == POLICY_FIXED:
+        return PollingPolicy(interval=interval)
+    return PollingPolicy(
+        interval=interval,
+        first=CONF.scenario_test.poll_first_delay_ms / 1000,
+        factor=CONF.scenario_test.poll_backoff_factor,
+        max_interval=CONF.scenario_test.poll_max_interval,
+        jitter=CONF.scenario_test.poll_jitter_percent / 100,
+        expected=get_hints().get(op))
+
+
+def wait_until(func, policy, timeout=None):
+    """Call func until it returns True
+
+    Raise LoopTimeout if timeout is set and reached.
+    """
+    started = time.monotonic()
+    for delay in policy.delays():
+        exporter.POLLS.inc(kind='probe')
+        if func():
+            return time.monotonic() - started
+        elapsed = time.monotonic() - started
+        if timeout is not None and elapsed >= timeout:
+            raise exceptions.LoopTimeout(timeout=timeout)
+        time.sleep(min(delay, timeout - elapsed) if timeout else delay)
+
+
+async def async_wait_until(func, policy, timeout=None):
+    """Await func until it returns True, sleep with asyncio
+
+    Raise LoopTimeout if timeout is set and reached.
+    """
+    started = time.monotonic()
+    for delay in policy.delays():
+        exporter.POLLS.inc(kind='probe')
+        if await func():
+            return time.monotonic() - started
+        elapsed = time.monotonic() - started
+        if timeout is not None and elapsed >= timeout:
+            raise exceptions.LoopTimeout(timeout=timeout)
+        await asyncio.sleep(min(delay, timeout - elapsed) if timeout
+                            else delay)
@@ -0,0 +1,78 @@
+"""
+Rate limiters
+"""
+import threading
+import time
+
+
+class TokenBucket(object):
+    """Allow `rate` requests per second, with bursts up to `burst`
+
+    The bucket records how many callers are waiting for a token and how
+    long they have been throttled.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(int(rate), 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.max_waiting = 0
+        self.throttled = 0
+        self.throttle_time = 0
+
+    def _refill(self, now):
+        self._tokens = min(self._tokens + (now - self._updated) * self.rate,
+                           self.burst)
+        self._updated = now
+
+    def _try_acquire(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Block until a token is available"""
+        with self._lock:
+            delay = self._try_acquire()
+            if not delay:
+                return
+            self.waiting += 1
+            self.throttled += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+        started = time.monotonic()
+        try:
+            while delay:
+                time.sleep(delay)
+                with self._lock:
+                    delay = self._try_acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                self.throttle_time += time.monotonic() - started
+
+    def pause(self, seconds):
+        """Stop handing out tokens for seconds, e.g. for Retry-After"""
+        with self._lock:
+            self._paused_until = max(self._paused_until,
+                                     time.monotonic() + seconds)
+            self._tokens = 0
+
+    def to_dict(self):
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'waiting': self.waiting,
+            'max_waiting': self.max_waiting,
+            'throttled': self.throttled,
+            'throttle_time': round(self.throttle_time, 3),
+        }
@@ -0,0 +1,178 @@
+"""
+Admission control of the scenario tests
+
+The capacity is read from the project quotas and the free resources of the
+hypervisors of the available compute services before the tests. Every vm
+lifecycle is admitted only if its servers and volumes fit in the capacity,
+so the tests wait for the finished lifecycles instead of failing with
+quota exceeded or NoValidHost.
+"""
+import asyncio
+import collections
+import threading
+
+from easy2use.globals import cfg
+
+from ectoys.common import exceptions
+from ectoys.common import log
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+
+def vm_demand(flavor):
+    """The resources used by the lifecycle of one vm"""
+    demand = {'instances': 1, 'cores': flavor.vcpus, 'ram': flavor.ram,
+              'volumes': 0, 'gigabytes': 0}
+    if CONF.openstack.boot_from_volume:
+        demand['volumes'] += 1
+        demand['gigabytes'] += CONF.openstack.volume_size
+    # the volumes created by the volume scenarios
+    for scenario, size in [('attach_volume', 1), ('attach_volume_loop', 10)]:
+        if scenario in CONF.scenario_test.scenarios:
+            num = CONF.scenario_test.attach_volume_nums_each_time
+            demand['volumes'] += num
+            demand['gigabytes'] += num * size
+    return demand
+
+
+def hypervisor_capacity(hypervisors, flavor):
+    """The number of the servers of the flavor which fit in the hypervisors"""
+    cpu_ratio = float(CONF.scenario_test.cpu_allocation_ratio)
+    ram_ratio = float(CONF.scenario_test.ram_allocation_ratio)
+    num = 0
+    for hypervisor in hypervisors:
+        free_cores = hypervisor.vcpus * cpu_ratio - hypervisor.vcpus_used
+        free_ram = hypervisor.memory_mb * ram_ratio - \
+            hypervisor.memory_mb_used
+        num += max(int(min(free_cores // max(flavor.vcpus, 1),
+                           free_ram // max(flavor.ram, 1))), 0)
+    return num
+
+
+def get_capacity(api, flavor):
+    """Get the capacity, the resources which are not limited are None"""
+    az, host = None, None
+    if CONF.openstack.boot_az:
+        if ':' in CONF.openstack.boot_az:
+            az, host = CONF.openstack.boot_az.split(':')
+        else:
+            az = CONF.openstack.boot_az
+    capacity = api.get_quota_headroom()
+    servers = hypervisor_capacity(
+        api.get_available_hypervisors(host=host, zone=az), flavor)
+    if capacity['instances'] is None or servers < capacity['instances']:
+        capacity['instances'] = servers
+    return capacity
+
+
+def split_capacity(capacity, parts):
+    """Split the capacity to the worker processes"""
+    return [
+        {resource: None if value is None else value // parts + (
+            1 if index < value % parts else 0)
+         for resource, value in capacity.items()}
+        for index in range(parts)
+    ]
+
+
+def check_capacity(capacity, demand):
+    """Make sure one vm fits in the capacity"""
+    short = [resource for resource, value in capacity.items()
+             if value is not None and value < demand.get(resource, 0)]
+    if short:
+        raise exceptions.QuotaNotEnough(
+            reason=f'{", ".join(short)} of the capacity {capacity} is less '
+                   f'than the demand of one vm {demand}')
+
+
+class AdmissionController(object):
+    """Admit the vm lifecycles whose resources fit in the capacity
+
+    The threads wait with `acquire` and the coroutines wait with
+    `async_acquire`, `release` is called after the vm is deleted.
+    """
+
+    def __init__(self, capacity, demand):
+        self.capacity = {resource: value for resource, value in
+                         capacity.items() if value is not None}
+        self.demand = demand
+        self.in_use = collections.Counter()
+        self.max_in_use = 0
+        self.waited = 0
+        self._cond = threading.Condition()
+        self._waiters = []
+        check_capacity(self.capacity, self.demand)
+
+    def _fits(self):
+        return all(self.in_use[resource] + self.demand.get(resource, 0) <=
+                   limit for resource, limit in self.capacity.items())
+
+    def _take(self):
+        self.in_use.update(self.demand)
+        self.max_in_use = max(self.max_in_use, self.in_use['instances'])
+
+    def acquire(self):
+        with self._cond:
+            if not self._fits():
+                self.waited += 1
+                self._cond.wait_for(self._fits)
+            self._take()
+
+    async def async_acquire(self):
+        loop = asyncio.get_running_loop()
+        waited = False
+        while True:
+            with self._cond:
+                if self._fits():
+                    self._take()
+                    return
+                if not waited:
+                    self.waited += 1
+                    waited = True
+                waiter = loop.create_future()
+                self._waiters.append((loop, waiter))
+            await waiter
+
+    def release(self):
+        with self._cond:
+            self.in_use.subtract(self.demand)
+            waiters, self._waiters = self._waiters, []
+            self._cond.notify_all()
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(
+                lambda w=waiter: w.done() or w.set_result(None))
+
+    def report(self):
+        LOG.info('admission capacity: {}, vm demand: {}, max vms in use: {}, '
+                 'waited: {}', self.capacity, self.demand, self.max_in_use,
+                 self.waited)
+
+
+def get_shares(api, parts):
+    """Get the capacity shares of the worker processes
+
+    The shares are None if admission control is disabled.
+    """
+    if not CONF.scenario_test.admission_control:
+        return [None] * parts
+    flavor = api.get_flavor(CONF.openstack.flavor)
+    demand = vm_demand(flavor)
+    shares = split_capacity(get_capacity(api, flavor), parts)
+    for share in shares:
+        check_capacity(share, demand)
+    return shares
+
+
+def create_controller(api, capacity=None):
+    """Create the controller if admission control is enabled
+
+    capacity is the share of this worker process, it's read from the cloud
+    if it's None.
+    """
+    if not CONF.scenario_test.admission_control:
+        return None
+    flavor = api.get_flavor(CONF.openstack.flavor)
+    if capacity is None:
+        capacity = get_capacity(api, flavor)
+    return AdmissionController(capacity, vm_demand(flavor))
@@ -0,0 +1,263 @@
+"""
+Benchmarks of the scenario runner and the wait engine
+
+Every workload runs a fixed number of operations and reports the API calls
+per resource, the wall-clock and CPU time, the peak RSS and the latency
+percentiles of every action. Every workload runs in a new process, so the
+peak RSS of a workload doesn't include the earlier ones. Run them with the
+fake backend to measure the overhead of ectoys itself, and compare the JSON
+results of two commits.
+"""
+import collections
+import contextlib
+from concurrent import futures
+import json
+import platform
+import resource
+import subprocess
+import threading
+import time
+
+from easy2use.globals import cfg
+
+from ectoys.common import log
+from ectoys.common import utils
+from ectoys.common.test import scenario
+from ectoys.managers.openstack import manager
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+
+class LatencyRecorder(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+
+    def add(self, action, latency):
+        with self._lock:
+            self.latencies[action].append(latency)
+
+    @contextlib.contextmanager
+    def timeit(self, action):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(action, time.monotonic() - started)
+
+    def summary(self):
+        with self._lock:
+            latencies = dict(self.latencies)
+        return {
+            action: dict(count=len(values),
+                         **{k: v and round(v, 4) for k, v in
+                            utils.percentiles(values).items()})
+            for action, values in latencies.items()
+        }
+
+
+class Benchmark(object):
+    """Base class of the workloads
+
+    Subclasses implement `run`, the resources are created in `prepare` and
+    removed in `cleanup`, both are not measured.
+    """
+    name = None
+    default_num = 1
+
+    def __init__(self, mgr: manager.OpenstackManager, num=None, workers=10):
+        self.mgr = mgr
+        self.num = num or self.default_num
+        self.workers = workers
+        self.prefix = utils.generate_name(f'bench-{self.name}')
+        self.recorder = LatencyRecorder()
+        self.failed = 0
+
+    def prepare(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError()
+
+    def cleanup(self):
+        pass
+
+    def _api_calls(self):
+        return sum(stats['requests']
+                   for stats in self.mgr.client.get_pool_stats().values())
+
+    def _create_servers(self):
+        LOG.info('creating {} server(s) for {}', self.num, self.name)
+        self.mgr.resize_pools(self.workers)
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            tasks = [executor.submit(self.mgr.create_server,
+                                     name=f'{self.prefix}-{index}', wait=True,
+                                     timeout=CONF.boot.timeout)
+                     for index in range(1, self.num + 1)]
+            return [task.result() for task in tasks]
+
+    def execute(self):
+        self.prepare()
+        try:
+            api_calls = self._api_calls()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.monotonic()
+            self.run()
+            wall_time = time.monotonic() - started
+            end_usage = resource.getrusage(resource.RUSAGE_SELF)
+            api_calls = self._api_calls() - api_calls
+        finally:
+            self.cleanup()
+        cpu_time = (end_usage.ru_utime - usage.ru_utime +
+                    end_usage.ru_stime - usage.ru_stime)
+        return {
+            'num': self.num,
+            'workers': self.workers,
+            'failed': self.failed,
+            'api_calls': api_calls,
+            'api_calls_per_resource': round(api_calls / self.num, 2),
+            'wall_time': round(wall_time, 3),
+            'cpu_time': round(cpu_time, 3),
+            # kilobytes on linux, the peak of the process of this workload
+            # including prepare, and how much run raised it
+            'peak_rss': end_usage.ru_maxrss,
+            'peak_rss_growth': end_usage.ru_maxrss - usage.ru_maxrss,
+            'latency': self.recorder.summary(),
+        }
+
+
+class VMActionsBenchmark(Benchmark):
+    """Run the stop, start and reboot scenarios on every server"""
+    name = 'vm_actions'
+    default_num = 1000
+    actions = ['stop', 'start', 'reboot']
+
+    def prepare(self):
+        self.servers = self._create_servers()
+
+    def _run_actions(self, server):
+        for action in self.actions:
+            test_runner = scenario.VM_TEST_SCENARIOS[action](server, self.mgr)
+            with self.recorder.timeit(action):
+                test_runner.run()
+
+    def run(self):
+        with futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for task in futures.as_completed(
+                    [executor.submit(self._run_actions, server)
+                     for server in self.servers]):
+                try:
+                    task.result()
+                except Exception as e:
+                    LOG.error('run actions failed: {}', e)
+                    self.failed += 1
+
+    def cleanup(self):
+        self.mgr.delete_vms(name=self.prefix, workers=self.workers)
+
+
+class CreateVolumesBenchmark(Benchmark):
+    """Bulk create volumes with create_volumes"""
+    name = 'create_volumes'
+    default_num = 500
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the created volumes, collected even if create_volumes failed
+        self.volumes = []
+        self._lock = threading.Lock()
+
+    def _on_created(self, volume, duration, error):
+        self.recorder.add('volume_create', duration)
+        with self._lock:
+            if error:
+                LOG.error('create volume failed: {}', error)
+                self.failed += 1
+            else:
+                self.volumes.append(volume)
+
+    def run(self):
+        try:
+            self.mgr.create_volumes(1, name=self.prefix, num=self.num,
+                                    workers=self.workers,
+                                    on_done=self._on_created)
+        except Exception:
+            # counted by _on_created
+            pass
+
+    def cleanup(self):
+        self.mgr.delete_volumes(self.volumes, workers=self.workers)
+
+
+class DeleteVMsBenchmark(Benchmark):
+    """Delete servers with the delete_vms pipeline"""
+    name = 'delete_vms'
+    default_num = 5000
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def prepare(self):
+        self._create_servers()
+
+    def _on_deleted(self, server, duration, error):
+        self.recorder.add('delete', duration)
+        if error:
+            with self._lock:
+                self.failed += 1
+
+    def run(self):
+        self.mgr.delete_vms(name=self.prefix, workers=self.workers,
+                            on_done=self._on_deleted)
+
+
+BENCHMARKS = {
+    bench_cls.name: bench_cls
+    for bench_cls in [VMActionsBenchmark, CreateVolumesBenchmark,
+                      DeleteVMsBenchmark]
+}
+
+
+def _get_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _execute_benchmark(args):
+    name, num, workers, backend = args
+    with manager.OpenstackManager(backend=backend) as mgr:
+        return BENCHMARKS[name](mgr, num=num, workers=workers).execute()
+
+
+def run_benchmarks(names=None, num=None, workers=10, backend=None,
+                   output=None):
+    """Run the benchmarks and write the results to the output json file
+
+    Every benchmark runs in a new process with its own manager.
+    """
+    results = {
+        'commit': _get_commit(),
+        'backend': backend or CONF.openstack.backend,
+        'python': platform.python_version(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmarks': {},
+    }
+    for name in names or BENCHMARKS:
+        LOG.info('start benchmark {}', name)
+        for result in utils.run_processes(
+                _execute_benchmark, maps=[(name, num, workers, backend)]):
+            results['benchmarks'][name] = result
+        LOG.info('benchmark {} finished: {}', name,
+                 results['benchmarks'][name])
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+        LOG.info('saved benchmark results to {}', output)
+    return results
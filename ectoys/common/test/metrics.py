@@ -0,0 +1,165 @@
+"""
+Latency metrics of the scenario tests
+
+Every phase of a scenario (tear_up, start, wait, varify and tear_down) is
+timed and recorded with the compute host of the vm, the records are
+aggregated per scenario and per host into histograms and percentiles.
+"""
+import collections
+import contextlib
+import csv
+import json
+import statistics
+import threading
+import time
+
+import prettytable
+
+from ectoys.common import exporter
+from ectoys.common import log
+from ectoys.common import utils
+
+LOG = log.getLogger()
+
+PHASES = ['tear_up', 'start', 'wait', 'varify', 'tear_down']
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = [0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, float('inf')]
+CSV_FIELDS = ['group', 'scenario', 'host', 'phase', 'count', 'failed', 'min',
+              'mean', 'max', 'p50', 'p95', 'p99']
+
+Record = collections.namedtuple('Record',
+                                ['scenario', 'host', 'phase', 'duration',
+                                 'success'])
+
+
+def _bucket_name(bound):
+    return '+Inf' if bound == float('inf') else str(bound)
+
+
+def _sort_key(key):
+    # the phase is the last item of the key, sorted by the running order
+    *names, phase = key
+    return [str(name) for name in names] + [
+        PHASES.index(phase) if phase in PHASES else len(PHASES)]
+
+
+def aggregate(durations, failed=0):
+    """Aggregate the durations to count, mean, percentiles and histogram"""
+    histogram = collections.OrderedDict(
+        (_bucket_name(bound), 0) for bound in BUCKETS)
+    for duration in durations:
+        for bound in BUCKETS:
+            if duration <= bound:
+                histogram[_bucket_name(bound)] += 1
+                break
+    result = {'count': len(durations), 'failed': failed}
+    for key, func in [('min', min), ('mean', statistics.mean), ('max', max)]:
+        result[key] = round(func(durations), 3) if durations else None
+    result.update({k: v if v is None else round(v, 3)
+                   for k, v in utils.percentiles(durations).items()})
+    result['histogram'] = histogram
+    return result
+
+
+class ScenarioMetrics(object):
+    """Thread-safe recorder of the scenario phase durations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.records = []
+
+    def add(self, scenario, host, phase, duration, success=True):
+        with self._lock:
+            self.records.append(
+                Record(scenario, host, phase, duration, success))
+        exporter.observe_phase(scenario, phase, duration)
+
+    @contextlib.contextmanager
+    def count_action(self, scenario):
+        """Count the action once, it's failed if any phase in it failed"""
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            exporter.observe_action(scenario, success=success)
+
+    def extend(self, records):
+        with self._lock:
+            self.records.extend(Record(*record) for record in records)
+
+    @contextlib.contextmanager
+    def timeit(self, scenario, phase, get_host=None):
+        """Time the phase, the host is got after the phase finished"""
+        started = time.monotonic()
+        success = False
+        try:
+            yield
+            success = True
+        finally:
+            duration = time.monotonic() - started
+            try:
+                host = get_host() if get_host else None
+            except Exception:
+                host = None
+            self.add(scenario, host, phase, duration, success=success)
+
+    def _group(self, key_func):
+        with self._lock:
+            records = list(self.records)
+        groups = collections.defaultdict(list)
+        for record in records:
+            groups[key_func(record)].append(record)
+        return {
+            key: aggregate([r.duration for r in group if r.success],
+                           failed=sum(not r.success for r in group))
+            for key, group in sorted(groups.items(),
+                                     key=lambda x: _sort_key(x[0]))
+        }
+
+    def summary(self):
+        """Aggregate by (scenario, phase) and (host, scenario, phase)"""
+        return {
+            'scenarios': self._group(lambda r: (r.scenario, r.phase)),
+            'hosts': self._group(lambda r: (r.host, r.scenario, r.phase)),
+        }
+
+    def to_dict(self):
+        summary = self.summary()
+        scenarios, hosts = {}, {}
+        for (scenario, phase), result in summary['scenarios'].items():
+            scenarios.setdefault(scenario, {})[phase] = result
+        for (host, scenario, phase), result in summary['hosts'].items():
+            hosts.setdefault(host or 'unknown', {}).setdefault(
+                scenario, {})[phase] = result
+        return {'scenarios': scenarios, 'hosts': hosts}
+
+    def _csv_rows(self):
+        summary = self.summary()
+        for (scenario, phase), result in summary['scenarios'].items():
+            yield dict(group='scenario', scenario=scenario, host='',
+                       phase=phase, **result)
+        for (host, scenario, phase), result in summary['hosts'].items():
+            yield dict(group='host', scenario=scenario, host=host or '',
+                       phase=phase, **result)
+
+    def write_report(self, path):
+        """Write the report, csv if the path ends with .csv, else json"""
+        with open(path, 'w', newline='') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=CSV_FIELDS,
+                                        extrasaction='ignore')
+                writer.writeheader()
+                writer.writerows(self._csv_rows())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+        LOG.info('saved scenario report to {}', path)
+
+    def report(self):
+        pt = prettytable.PrettyTable(['Scenario', 'Phase', 'Count', 'Failed',
+                                      'Mean', 'P50', 'P95', 'P99', 'Max'])
+        for (scenario, phase), result in self.summary()['scenarios'].items():
+            pt.add_row([scenario, phase, result['count'], result['failed'],
+                        result['mean'], result['p50'], result['p95'],
+                        result['p99'], result['max']])
+        LOG.info('scenario latency (seconds):\n{}', pt)
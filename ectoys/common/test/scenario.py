@@ -1,12 +1,19 @@
+import asyncio
 from concurrent import futures
+import contextlib
 import random
+import threading
 
 from easy2use.globals import cfg
 from easy2use.common import colorstr
 
 from ectoys.common import exceptions
+from ectoys.common import exporter
+from ectoys.common import polling
 from ectoys.common import utils
 from ectoys.common import log
+from ectoys.common.test import admission
+from ectoys.common.test import metrics as test_metrics
 from ectoys.managers.openstack import manager
 
 CONF = cfg.CONF
@@ -14,10 +21,13 @@ LOG = log.getLogger()
 
 
 class ECScenarioTest(object):
+    name = None
 
-    def __init__(self, vm, api: manager.OpenstackManager) -> None:
+    def __init__(self, vm, api: manager.OpenstackManager,
+                 metrics: test_metrics.ScenarioMetrics = None) -> None:
         self.api = api
         self.vm = vm
+        self.metrics = metrics
 
     def tear_up(self):
         pass
@@ -25,21 +35,87 @@ class ECScenarioTest(object):
     def tear_down(self):
         pass
 
+    def _timeit(self, phase):
+        if not self.metrics:
+            return contextlib.nullcontext()
+        return self.metrics.timeit(
+            self.name or self.__class__.__name__, phase,
+            get_host=lambda: self.api.get_server_host(self.vm))
+
+    def _count_action(self):
+        if not self.metrics:
+            return contextlib.nullcontext()
+        return self.metrics.count_action(self.name or
+                                         self.__class__.__name__)
+
     def run(self):
-        self.tear_up()
-        try: 
-            self.start()
-            self.varify()
+        with self._count_action():
+            self._run()
+
+    def _run(self):
+        with self._timeit('tear_up'):
+            self.tear_up()
+        try:
+            with self._timeit('start'):
+                self.start()
+            with self._timeit('wait'):
+                self.wait()
+            with self._timeit('varify'):
+                self.varify()
+        finally:
+            LOG.info('tear down')
+            with self._timeit('tear_down'):
+                self.tear_down()
+
+    async def async_run(self):
+        """Run the phases as coroutines
+
+        By default a phase runs in the executor of the API requests, the
+        phases which wait override their async versions, so the waits don't
+        hold a thread.
+        """
+        with self._count_action():
+            await self._async_run()
+
+    async def _async_run(self):
+        with self._timeit('tear_up'):
+            await self.async_tear_up()
+        try:
+            with self._timeit('start'):
+                await self.async_start()
+            with self._timeit('wait'):
+                await self.async_wait()
+            with self._timeit('varify'):
+                await self.async_varify()
         finally:
             LOG.info('tear down')
-            self.tear_down()
+            with self._timeit('tear_down'):
+                await self.async_tear_down()
+
+    async def async_tear_up(self):
+        await utils.to_thread(self.tear_up)
+
+    async def async_tear_down(self):
+        await utils.to_thread(self.tear_down)
 
     def start(self):
         pass
 
+    async def async_start(self):
+        await utils.to_thread(self.start)
+
+    def wait(self):
+        pass
+
+    async def async_wait(self):
+        await utils.to_thread(self.wait)
+
     def varify(self):
         pass
 
+    async def async_varify(self):
+        await utils.to_thread(self.varify)
+
     def assert_vm_state_is_active(self):
         vm_state = self.api.get_vm_state(self.vm, refresh=True)
         if vm_state.upper() != 'ACTIVE':
@@ -48,12 +124,24 @@ class ECScenarioTest(object):
                                           reason=f'vm state is {vm_state}')
 
 
-class VMStopScenarioTest(ECScenarioTest):
+class VMTaskScenarioTest(ECScenarioTest):
+    """Scenario which waits until the task of vm finished"""
+    op = 'task'
+
+    def wait(self):
+        self.api.wait_for_vm_task_finished(self.vm, op=self.op)
+
+    async def async_wait(self):
+        await self.api.async_wait_for_vm_task_finished(self.vm, op=self.op)
+
+
+class VMStopScenarioTest(VMTaskScenarioTest):
+    name = 'stop'
+    op = 'stop'
 
     def start(self):
         self.vm.stop()
         LOG.info('stopping')
-        self.api.wait_for_vm_task_finished(self.vm)
 
     def varify(self):
         vm_state = self.api.get_vm_state(self.vm, refresh=True)
@@ -64,12 +152,13 @@ class VMStopScenarioTest(ECScenarioTest):
         LOG.success('test stop success', vm=self.vm.id)
 
 
-class VMRebootScenarioTest(ECScenarioTest):
+class VMRebootScenarioTest(VMTaskScenarioTest):
+    name = 'reboot'
+    op = 'reboot'
 
     def start(self):
         self.vm.reboot()
         LOG.info('rebooting', vm=self.vm.id)
-        self.api.wait_for_vm_task_finished(self.vm)
 
     def varify(self):
         self.assert_vm_state_is_active()
@@ -84,13 +173,28 @@ class VMRebootScenarioTest(ECScenarioTest):
         LOG.success('tes rebooted success', vm=self.vm.id)
         return self.vm
 
+    async def async_varify(self):
+        await utils.to_thread(self.assert_vm_state_is_active)
+        LOG.info('rebooted', vm=self.vm.id)
+
+        try:
+            if CONF.boot.check_console_log:
+                await self.api.async_wait_for_console_log(self.vm,
+                                                          interval=10)
+        except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
+            raise exceptions.VMTestFailed(vm=self.vm.id, action='reboot',
+                                          reason=e)
+        LOG.success('tes rebooted success', vm=self.vm.id)
+        return self.vm
 
-class VMHardRebootScenarioTest(ECScenarioTest):
+
+class VMHardRebootScenarioTest(VMTaskScenarioTest):
+    name = 'hard_reboot'
+    op = 'hard_reboot'
 
     def start(self):
         self.vm.reboot(reboot_type='HARD')
         LOG.info('hard rebooting', vm=self.vm.id)
-        self.api.wait_for_vm_task_finished(self.vm)
 
     def varify(self):
         self.assert_vm_state_is_active()
@@ -105,32 +209,58 @@ class VMHardRebootScenarioTest(ECScenarioTest):
         LOG.info('test rebooted success', vm=self.vm.id)
         return self.vm
 
+    async def async_varify(self):
+        await utils.to_thread(self.assert_vm_state_is_active)
+        LOG.info('started', vm=self.vm.id)
+
+        try:
+            await self.api.async_wait_for_vm(self.vm, timeout=60 * 10,
+                                             interval=5)
+            if CONF.boot.check_console_log:
+                await self.api.async_wait_for_console_log(self.vm,
+                                                          interval=10)
+        except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
+            raise exceptions.RebootFailed(vm=self.vm.id, reason=e)
+        LOG.info('test rebooted success', vm=self.vm.id)
+        return self.vm
 
-class VMStartScenarioTest(ECScenarioTest):
+
+class VMStartScenarioTest(VMTaskScenarioTest):
+    name = 'start'
+    op = 'start'
 
     def start(self):
         self.vm.start()
         LOG.info('starting')
-        self.api.wait_for_vm_task_finished(self.vm)
 
     def varify(self):
         self.assert_vm_state_is_active()
 
 
 class VMAttachInterfaceTest(ECScenarioTest):
+    name = 'attach_interface'
 
-    def __init__(self, vm, api: manager.OpenstackManager) -> None:
-        super().__init__(vm, api)
+    def __init__(self, vm, api: manager.OpenstackManager,
+                 metrics: test_metrics.ScenarioMetrics = None) -> None:
+        super().__init__(vm, api, metrics=metrics)
         self.attached_ports = []
 
+    def _attach_interface(self, j):
+        LOG.info('attaching interface {}/{}', j+1,
+                 CONF.scenario_test.attach_interface_nums_each_time,
+                 vm=self.vm.id)
+        attached = self.vm.interface_attach(
+            None, CONF.openstack.attach_net, None)
+        self.attached_ports.append(attached.port_id)
+
     def start(self):
         for j in range(CONF.scenario_test.attach_interface_nums_each_time):
-            LOG.info('attaching interface {}/{}', j+1,
-                     CONF.scenario_test.attach_interface_nums_each_time,
-                     vm=self.vm.id) 
-            attached = self.vm.interface_attach(
-                None, CONF.openstack.attach_net, None)
-            self.attached_ports.append(attached.port_id)
+            self._attach_interface(j)
+
+    async def async_start(self):
+        # one request at a time, an attachment may take seconds
+        for j in range(CONF.scenario_test.attach_interface_nums_each_time):
+            await utils.to_thread(self._attach_interface, j)
 
     def varify(self):
         vifs = self.api.get_vm_interfaces(self.vm)
@@ -146,32 +276,50 @@ class VMAttachInterfaceTest(ECScenarioTest):
 
 
 class VMAttachInterfaceLoopTest(ECScenarioTest):
+    name = 'attach_interface_loop'
+
+    def __init__(self, vm, api: manager.OpenstackManager,
+                 metrics: test_metrics.ScenarioMetrics = None) -> None:
+        super().__init__(vm, api, metrics=metrics)
 
-    def __init__(self, vm, api: manager.OpenstackManager) -> None:
-        super().__init__(vm, api)
+    def _attach_interface(self, index, j):
+        LOG.info('attaching interface {}-{}', index + 1, j + 1)
+        attached = self.vm.interface_attach(None, CONF.openstack.attach_net,
+                                            None)
+        return attached.port_id
+
+    def _check_interfaces(self, attached_ports):
+        vifs = self.api.get_vm_interfaces(self.vm)
+        LOG.debug('vm ip interfaces: {}', vifs, vm=self.vm.id)
+        for port_id in attached_ports:
+            if port_id not in vifs:
+                raise exceptions.VMTestFailed(
+                    vm=self.vm.id, action='attach_interface',
+                    reason=f'port {port_id} not in vm interfaces {vifs}')
+
+    def _detach_interface(self, index, port_id):
+        LOG.info('detaching interface {} {}',
+                 index + 1, port_id, vm=self.vm.id)
+        self.vm.interface_detach(port_id)
 
     def start(self):
+        nums = CONF.scenario_test.attach_interface_nums_each_time
         for index in range(CONF.scenario_test.attach_interface_loop_times):
-            attached_ports = []
-            for j in range(CONF.scenario_test.attach_interface_nums_each_time):
-                LOG.info('attaching interface {}-{}', index + 1, j + 1) 
-                attached = self.vm.interface_attach(None,
-                                                    CONF.openstack.attach_net,
-                                                    None)
-                attached_ports.append(attached.port_id)
-
-            vifs = self.api.get_vm_interfaces(self.vm)
-            LOG.debug('vm ip interfaces: {}', vifs, vm=self.vm.id)
+            attached_ports = [self._attach_interface(index, j)
+                              for j in range(nums)]
+            self._check_interfaces(attached_ports)
             for port_id in attached_ports:
-                if port_id not in vifs:
-                    raise exceptions.VMTestFailed(
-                        vm=self.vm.id, action='attach_interface',
-                        reason=f'port {port_id} not in vm interfaces {vifs}')
+                self._detach_interface(index, port_id)
 
+    async def async_start(self):
+        for index in range(CONF.scenario_test.attach_interface_loop_times):
+            attached_ports = []
+            for j in range(CONF.scenario_test.attach_interface_nums_each_time):
+                attached_ports.append(
+                    await utils.to_thread(self._attach_interface, index, j))
+            await utils.to_thread(self._check_interfaces, attached_ports)
             for port_id in attached_ports:
-                LOG.info('detaching interface {} {}',
-                         index + 1, port_id, vm=self.vm.id) 
-                self.vm.interface_detach(port_id)
+                await utils.to_thread(self._detach_interface, index, port_id)
 
     def varify(self):
         self.assert_vm_state_is_active()
@@ -179,20 +327,36 @@ class VMAttachInterfaceLoopTest(ECScenarioTest):
 
 
 class VMAttachVolumeTest(ECScenarioTest):
+    name = 'attach_volume'
 
-    def __init__(self, vm, api: manager.OpenstackManager) -> None:
-        super().__init__(vm, api)
+    def __init__(self, vm, api: manager.OpenstackManager,
+                 metrics: test_metrics.ScenarioMetrics = None) -> None:
+        super().__init__(vm, api, metrics=metrics)
         self.attached_volumes = []
 
     def start(self):
         LOG.info('creating volumes', vm=self.vm.id)
-        volume_ids = self.api.create_volumes(
-            1, num=CONF.scenario_test.attach_volume_nums_each_time)
+        volumes = self.api.create_volumes(
+            1, num=CONF.scenario_test.attach_volume_nums_each_time,
+            volume_type=CONF.openstack.volume_type)
         LOG.info('test attach volume', vm=self.vm.id)
-        for volume_id in volume_ids:
+        for volume_id in [volume.id for volume in volumes]:
             self.api.attach_volume(self.vm, volume_id)
             LOG.info('attaching volume {}', volume_id, vm=self.vm.id)
-            self.api.wait_for_vm_task_finished(self.vm)
+            self.api.wait_for_vm_task_finished(self.vm, op='attach_volume')
+            self.attached_volumes.append(volume_id)
+
+    async def async_start(self):
+        LOG.info('creating volumes', vm=self.vm.id)
+        volumes = await self.api.async_create_volumes(
+            1, num=CONF.scenario_test.attach_volume_nums_each_time,
+            volume_type=CONF.openstack.volume_type)
+        LOG.info('test attach volume', vm=self.vm.id)
+        for volume_id in [volume.id for volume in volumes]:
+            await utils.to_thread(self.api.attach_volume, self.vm, volume_id)
+            LOG.info('attaching volume {}', volume_id, vm=self.vm.id)
+            await self.api.async_wait_for_vm_task_finished(
+                self.vm, op='attach_volume')
             self.attached_volumes.append(volume_id)
 
     def varify(self):
@@ -203,27 +367,52 @@ class VMAttachVolumeTest(ECScenarioTest):
 
 
 class VMAttachVolumeLoopTest(ECScenarioTest):
+    name = 'attach_volume_loop'
 
-    def __init__(self, vm, api: manager.OpenstackManager) -> None:
-        super().__init__(vm, api)
+    def __init__(self, vm, api: manager.OpenstackManager,
+                 metrics: test_metrics.ScenarioMetrics = None) -> None:
+        super().__init__(vm, api, metrics=metrics)
         self.created_volumes = []
 
     def tear_up(self):
         super().tear_up()
         LOG.info('creating volumes', vm=self.vm.id)
         self.created_volumes = self.api.create_volumes(
-            10, num=CONF.scenario_test.attach_volume_nums_each_time)
+            10, num=CONF.scenario_test.attach_volume_nums_each_time,
+            volume_type=CONF.openstack.volume_type)
+
+    async def async_tear_up(self):
+        await utils.to_thread(super().tear_up)
+        LOG.info('creating volumes', vm=self.vm.id)
+        self.created_volumes = await self.api.async_create_volumes(
+            10, num=CONF.scenario_test.attach_volume_nums_each_time,
+            volume_type=CONF.openstack.volume_type)
 
     def start(self):
         for i in range(CONF.scenario_test.attach_volume_loop_times):
             for (j, volume) in enumerate(self.created_volumes):
                 LOG.info('test attach volume {}-{}', i+1, j+1, vm=self.vm.id)
                 self.api.attach_volume(self.vm, volume.id, wait=True)
-                self.api.wait_for_vm_task_finished(self.vm)
+                self.api.wait_for_vm_task_finished(self.vm,
+                                                   op='attach_volume')
 
             for volume in self.created_volumes:
                 self.api.detach_volume(self.vm, volume.id, wait=True)
-                self.api.wait_for_vm_task_finished(self.vm)
+                self.api.wait_for_vm_task_finished(self.vm,
+                                                   op='detach_volume')
+
+    async def async_start(self):
+        for i in range(CONF.scenario_test.attach_volume_loop_times):
+            for (j, volume) in enumerate(self.created_volumes):
+                LOG.info('test attach volume {}-{}', i+1, j+1, vm=self.vm.id)
+                await self.api.async_attach_volume(self.vm, volume.id)
+                await self.api.async_wait_for_vm_task_finished(
+                    self.vm, op='attach_volume')
+
+            for volume in self.created_volumes:
+                await self.api.async_detach_volume(self.vm, volume.id)
+                await self.api.async_wait_for_vm_task_finished(
+                    self.vm, op='detach_volume')
 
     def varify(self):
         # TODO
@@ -237,6 +426,12 @@ class VMAttachVolumeLoopTest(ECScenarioTest):
         self.api.delete_volumes(self.created_volumes)
         super().tear_down()
 
+    async def async_tear_down(self):
+        LOG.info('clean up {} volumes', len(self.created_volumes),
+                 vm=self.vm.id)
+        await self.api.async_delete_volumes(self.created_volumes)
+        await utils.to_thread(super().tear_down)
+
 
 VM_TEST_SCENARIOS = {
     'stop': VMStopScenarioTest,
@@ -250,9 +445,103 @@ VM_TEST_SCENARIOS = {
 
 class VMScenarioTest(object):
 
-    def __init__(self, ec_manager=None) -> None:
+    def __init__(self, ec_manager=None, admission_controller=None) -> None:
         self.manager = ec_manager or manager.OpenstackManager()
+        self.admission = admission_controller
         self.server = None
+        self.metrics = test_metrics.ScenarioMetrics()
+        self.deferred_servers = []
+
+    def report_server_actions(self, server):
+        if CONF.scenario_test.defer_action_report:
+            self.deferred_servers.append(server)
+        else:
+            self.manager.report_server_actions(server)
+
+    def report_deferred_actions(self):
+        """Report the actions of the deferred vms concurrently
+
+        The vms are reported by action_fetch_workers threads, the events of
+        each vm are fetched one by one to keep the fan-out bounded.
+        """
+        servers, self.deferred_servers = self.deferred_servers, []
+        if not servers:
+            return
+        LOG.info('reporting the actions of {} vm(s)', len(servers))
+        with futures.ThreadPoolExecutor(
+                max_workers=CONF.scenario_test.action_fetch_workers) as tp:
+            tasks = [tp.submit(self.manager.report_server_actions, server,
+                               workers=1)
+                     for server in servers]
+            for future in futures.as_completed(tasks):
+                try:
+                    future.result()
+                except Exception as e:
+                    LOG.warning('report server actions failed: {}', e)
+
+    def _timeit(self, scenario, phase, server=None):
+        return self.metrics.timeit(
+            scenario, phase,
+            get_host=server and (lambda: self.manager.get_server_host(server)))
+
+    def boot_servers(self, num):
+        """Boot num servers with one multi-create request"""
+        with self._timeit('boot', 'start'):
+            try:
+                return self.manager.create_servers(num)
+            except Exception:
+                # the boots of the servers are never waited
+                for _ in range(num):
+                    exporter.observe_action('boot', success=False)
+                raise
+
+    def _create_server(self, server=None):
+        with self.metrics.count_action('boot'):
+            if not server:
+                with self._timeit('boot', 'start'):
+                    server = self.manager.create_server()
+            with self._timeit('boot', 'wait', server=server):
+                try:
+                    self.manager._wait_for_vm(
+                        server, timeout=CONF.boot.timeout, op='boot')
+                except exceptions.VMIsError:
+                    raise exceptions.VmCreatedFailed(vm=server.id)
+        return server
+
+    async def _async_create_server(self, server=None):
+        with self.metrics.count_action('boot'):
+            if not server:
+                with self._timeit('boot', 'start'):
+                    server = await utils.to_thread(self.manager.create_server)
+            with self._timeit('boot', 'wait', server=server):
+                try:
+                    await self.manager.async_wait_for_vm(
+                        server, timeout=CONF.boot.timeout, op='boot')
+                except exceptions.VMIsError:
+                    raise exceptions.VmCreatedFailed(vm=server.id)
+        return server
+
+    def _release(self, server, cleaned):
+        if not self.admission:
+            return
+        # the resources of the server which is not deleted are still used
+        if server and not cleaned:
+            LOG.warning('vm is not deleted, its resources are not released '
+                        'to the admission control', vm=server.id)
+            return
+        self.admission.release()
+
+    def admit_servers(self, num):
+        """Wait until num servers are admitted before booting them"""
+        if self.admission:
+            for _ in range(num):
+                self.admission.acquire()
+
+    def release_servers(self, num):
+        """Release the admitted servers which are not booted"""
+        if self.admission:
+            for _ in range(num):
+                self.admission.release()
 
     def get_scenarios(self):
         if CONF.scenario_test.random_order:
@@ -262,15 +551,23 @@ class VMScenarioTest(object):
             test_scenarios = CONF.scenario_test.scenarios
         return test_scenarios
 
-    def run(self):
+    def run(self, booted_server=None):
+        """Run the scenarios with a new server
+
+        booted_server is the server booted by boot_servers, it's waited to
+        be active instead of booting a new one.
+        """
         test_scenarios = self.get_scenarios()
         if not test_scenarios:
             LOG.warning("test scenarions is empty")
         error = False
         server = None
+        if self.admission and not booted_server:
+            self.admission.acquire()
+        cleaned = False
+        exporter.VMS_IN_FLIGHT.inc()
         try:
-            server = self.manager.create_server(wait=True,
-                                                timeout=CONF.boot.timeout)
+            server = self._create_server(server=booted_server)
 
             # if CONF.boot.check_console_log:
             #     self._wait_for_console_log(vm, interval=10)
@@ -279,7 +576,8 @@ class VMScenarioTest(object):
 
             for scenario in test_scenarios:
                 test_cls = VM_TEST_SCENARIOS.get(scenario)
-                test_runner = test_cls(server, self.manager)
+                test_runner = test_cls(server, self.manager,
+                                       metrics=self.metrics)
                 test_runner.run()
 
         except Exception as e:
@@ -289,23 +587,223 @@ class VMScenarioTest(object):
         else:
             LOG.success('test success', vm=server.id)
         finally:
-            if server:
-                self.manager.report_server_actions(server)
-                if not error or CONF.scenario_test.cleanup_error_vms:
-                    LOG.info('cleanup vm', vm=server.id)
-                    self.manager.delete_vm(server)
+            try:
+                if server:
+                    self.report_server_actions(server)
+                    if not error or CONF.scenario_test.cleanup_error_vms:
+                        LOG.info('cleanup vm', vm=server.id)
+                        with self.metrics.count_action('delete'), \
+                                self._timeit('delete', 'wait', server=server):
+                            self.manager.delete_vm(server)
+                        cleaned = True
+            finally:
+                exporter.VMS_IN_FLIGHT.dec()
+                self._release(server, cleaned)
 
+    async def async_run(self, booted_server=None):
+        test_scenarios = self.get_scenarios()
+        if not test_scenarios:
+            LOG.warning("test scenarions is empty")
+        error = False
+        server = None
+        if self.admission and not booted_server:
+            await self.admission.async_acquire()
+        cleaned = False
+        exporter.VMS_IN_FLIGHT.inc()
+        try:
+            server = await self._async_create_server(server=booted_server)
+            LOG.success('created, host: {}', self.manager.get_server_host(server),
+                        vm=server.id)
 
-def do_test_vm():
+            for scenario in test_scenarios:
+                test_cls = VM_TEST_SCENARIOS.get(scenario)
+                test_runner = test_cls(server, self.manager,
+                                       metrics=self.metrics)
+                await test_runner.async_run()
+
+        except Exception as e:
+            LOG.exception('test failed')
+            error = True
+            raise e
+        else:
+            LOG.success('test success', vm=server.id)
+        finally:
+            try:
+                if server:
+                    await utils.to_thread(self.report_server_actions,
+                                          server)
+                    if not error or CONF.scenario_test.cleanup_error_vms:
+                        LOG.info('cleanup vm', vm=server.id)
+                        with self.metrics.count_action('delete'), \
+                                self._timeit('delete', 'wait', server=server):
+                            await self.manager.async_delete_vm(server)
+                        cleaned = True
+            finally:
+                exporter.VMS_IN_FLIGHT.dec()
+                self._release(server, cleaned)
+
+
+def _batch_sizes(total, worker):
+    """The batches are not larger than the worker"""
+    batch_size = min(CONF.scenario_test.boot_batch_size, worker)
+    return [min(batch_size, total - i) for i in range(0, total, batch_size)]
+
+
+def _thread_test_vm(test_task, total, worker):
+    failed = 0
+    completed = 0
+    test_task.manager.resize_pools(worker)
+    # at most worker servers are booted and not tested
+    slots = threading.Semaphore(worker)
+
+    def run_booted(server):
+        try:
+            return test_task.run(booted_server=server)
+        finally:
+            slots.release()
+
+    with futures.ThreadPoolExecutor(max_workers=worker) as tp:
+        if not CONF.scenario_test.boot_batch_size:
+            tasks = [tp.submit(test_task.run) for _ in range(total)]
+        else:
+            # the tests of a batch start while the next batch is booting
+            tasks = []
+            for num in _batch_sizes(total, worker):
+                for _ in range(num):
+                    slots.acquire()
+                test_task.admit_servers(num)
+                try:
+                    servers = test_task.boot_servers(num)
+                except Exception as e:
+                    LOG.exception('boot {} server(s) failed: {}', num, e)
+                    servers = []
+                test_task.release_servers(num - len(servers))
+                for _ in range(num - len(servers)):
+                    slots.release()
+                failed += num - len(servers)
+                tasks.extend(tp.submit(run_booted, server)
+                             for server in servers)
+        for future in futures.as_completed(tasks):
+            try:
+                future.result()
+                completed += 1
+            except Exception as e:
+                failed += 1
+                LOG.exception(e)
+            finally:
+                LOG.info('completed {}/{}', completed, len(tasks))
+    test_task.report_deferred_actions()
+    test_task.manager.client.report_pool_stats()
+    test_task.manager.report_cache_stats()
+    if test_task.admission:
+        test_task.admission.report()
+    return failed
+
+
+async def _asyncio_test_vm(test_task, total, worker):
+    semaphore = asyncio.Semaphore(worker)
+    # at most worker servers are booted and not tested
+    slots = asyncio.Semaphore(worker)
+    completed = 0
+
+    async def run_test(server=None):
+        nonlocal completed
+        async with semaphore:
+            try:
+                await test_task.async_run(booted_server=server)
+            finally:
+                if server:
+                    slots.release()
+                completed += 1
+                LOG.info('completed {}/{}', completed, total)
+
+    boot_failed = 0
+    if not CONF.scenario_test.boot_batch_size:
+        tests = [run_test() for _ in range(total)]
+    else:
+        tests = []
+        for num in _batch_sizes(total, worker):
+            for _ in range(num):
+                await slots.acquire()
+            if test_task.admission:
+                for _ in range(num):
+                    await test_task.admission.async_acquire()
+            try:
+                servers = await utils.to_thread(test_task.boot_servers, num)
+            except Exception as e:
+                LOG.exception('boot {} server(s) failed: {}', num, e)
+                servers = []
+            test_task.release_servers(num - len(servers))
+            for _ in range(num - len(servers)):
+                slots.release()
+            boot_failed += num - len(servers)
+            tests.extend(asyncio.ensure_future(run_test(server))
+                         for server in servers)
+    results = await asyncio.gather(*tests, return_exceptions=True)
+    return boot_failed + sum(isinstance(result, Exception)
+                             for result in results)
+
+
+def _run_asyncio_test_vm(test_task, total, worker):
+    test_task.manager.resize_pools(CONF.scenario_test.asyncio_api_workers)
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(futures.ThreadPoolExecutor(
+        max_workers=CONF.scenario_test.asyncio_api_workers))
+    try:
+        return loop.run_until_complete(
+            _asyncio_test_vm(test_task, total, worker))
+    finally:
+        loop.close()
+        test_task.report_deferred_actions()
+        test_task.manager.client.report_pool_stats()
+        test_task.manager.report_cache_stats()
+        if test_task.admission:
+            test_task.admission.report()
+
+
+def do_test_vm(num, worker_index=None, capacity=None):
+    """Run num vm tests in this process
+
+    The manager (and the authenticated client) is created once and shared
+    by all the tests of this process. capacity is the share of this process
+    if the admission control is enabled.
+    Returns the failed num, the metric records and the learned duration
+    hints.
+    """
+    exporter.start(worker=worker_index)
     try:
-        test_task = VMScenarioTest()
-        test_task.run()
-        return True
-    except (exceptions.VmCreatedFailed) as e:
-        LOG.error('test failed, {}', e)
+        api = manager.OpenstackManager()
+        test_task = VMScenarioTest(
+            ec_manager=api,
+            admission_controller=admission.create_controller(
+                api, capacity=capacity))
     except Exception as e:
-        LOG.exception('test failed, {}', e)
-    return False
+        LOG.exception('init test failed, {}', e)
+        return num, [], {}
+    try:
+        if CONF.scenario_test.process_inner_mode == 'asyncio':
+            failed = _run_asyncio_test_vm(
+                test_task, num, CONF.scenario_test.process_concurrency)
+        else:
+            failed = _thread_test_vm(test_task, num,
+                                     CONF.scenario_test.process_concurrency)
+    finally:
+        api.close()
+    # the exit handlers are not called in the worker processes
+    exporter.flush()
+    return (failed, [tuple(record) for record in test_task.metrics.records],
+            polling.get_hints().learned())
+
+
+def _do_test_vm_shard(shard):
+    worker_index, num, capacity = shard
+    return do_test_vm(num, worker_index=worker_index, capacity=capacity)
+
+
+def report_metrics(metrics: test_metrics.ScenarioMetrics):
+    metrics.report()
+    if CONF.scenario_test.report_file:
+        metrics.write_report(CONF.scenario_test.report_file)
 
 
 def _check_services(api: manager.OpenstackManager):
@@ -353,39 +851,125 @@ def _check_image(api: manager.OpenstackManager):
             reason=f'get image {CONF.openstack.image_id} failed')
 
 
+def _check_networks(api: manager.OpenstackManager):
+    for net_id in (CONF.openstack.net_ids or []) + [CONF.openstack.attach_net]:
+        if not net_id:
+            continue
+        try:
+            api.get_network(net_id)
+        except Exception:
+            raise exceptions.InvalidConfig(
+                reason=f'get network {net_id} failed')
+
+
+def _check_volume_type(api: manager.OpenstackManager):
+    if not CONF.openstack.volume_type:
+        return
+    try:
+        api.get_volume_type(CONF.openstack.volume_type)
+    except Exception:
+        raise exceptions.InvalidConfig(
+            reason=f'get volume type {CONF.openstack.volume_type} failed')
+
+
+def _peak_servers():
+    """The max number of the servers which exist at the same time"""
+    total = CONF.scenario_test.total
+    if CONF.scenario_test.admission_control:
+        # the others wait for the admission
+        return 1
+    # the batches are booted only if the tests of the servers started
+    concurrency = CONF.scenario_test.worker
+    if CONF.scenario_test.mode == 'process':
+        concurrency *= CONF.scenario_test.process_concurrency
+    return min(total, concurrency)
+
+
+def _check_quota(api: manager.OpenstackManager):
+    if not CONF.openstack.flavor:
+        return
+    servers = _peak_servers()
+    required = {resource: num * servers for resource, num in
+                admission.vm_demand(
+                    api.get_flavor(CONF.openstack.flavor)).items()}
+    headroom = api.get_quota_headroom()
+    not_enough = [
+        f'{resource} requires {num} but {headroom[resource]} left'
+        for resource, num in required.items()
+        if num and headroom.get(resource) is not None and
+        headroom[resource] < num
+    ]
+    if not_enough:
+        raise exceptions.QuotaNotEnough(reason=', '.join(not_enough))
+    LOG.info('quota headroom: {}', headroom)
+
+
+PRE_CHECKS = [_check_flavor, _check_image, _check_services, _check_networks,
+              _check_volume_type, _check_quota]
+
+
 def pre_start():
+    """Check the config and the resources concurrently
+
+    Returns the manager whose client is authenticated and whose cache is
+    warmed, the tests of this process should reuse it.
+    """
     LOG.info('check before test')
     for scenario in CONF.scenario_test.scenarios:
         if scenario not in VM_TEST_SCENARIOS:
             raise exceptions.InvalidScenario(scenario)
 
     api = manager.OpenstackManager()
-    _check_flavor(api)
-    _check_image(api)
-    _check_services(api)
+    with futures.ThreadPoolExecutor(max_workers=len(PRE_CHECKS)) as executor:
+        tasks = [(check, executor.submit(check, api)) for check in PRE_CHECKS]
+    errors = []
+    for check, task in tasks:
+        try:
+            task.result()
+        except Exception as e:
+            LOG.error('{} failed: {}', check.__name__.lstrip('_'), e)
+            errors.append(e)
+    if errors:
+        api.close()
+        raise errors[0]
+    # the forked workers inherit the warmed cache
+    api.warm_cache()
+    return api
 
 
 def process_test_vm():
+    shards = utils.split_num(CONF.scenario_test.total,
+                             CONF.scenario_test.worker)
     try:
-        pre_start()
+        api = pre_start()
+        capacities = admission.get_shares(api, len(shards))
     except Exception as e:
         LOG.error('pre check failed: {}', e)
-        return 
-
-    # test_task = VMScenarioTest()
+        return
+    # the connections and threads can't be shared with the worker processes,
+    # they create their own managers with the inherited cache and tokens
+    api.close()
 
-    # test_task.check_image()
-
-    LOG.info('Start scenario test, worker: {}, total: {}, scenarios: {}',
-             CONF.scenario_test.worker, CONF.scenario_test.total,
-             CONF.scenario_test.scenarios)
+    LOG.info('Start scenario test, worker: {}, concurrency: {}, total: {}, '
+             'scenarios: {}',
+             CONF.scenario_test.worker, CONF.scenario_test.process_concurrency,
+             CONF.scenario_test.total, CONF.scenario_test.scenarios)
 
     ng = 0
-    for success in utils.run_processes(do_test_vm,
-                                       nums=CONF.scenario_test.total,
-                                       max_workers=CONF.scenario_test.worker):
-        if not success:
-            ng += 1
+    metrics = test_metrics.ScenarioMetrics()
+    hints = []
+    for failed, records, learned in utils.run_processes(
+            _do_test_vm_shard,
+            maps=[(index, num, capacity) for index, (num, capacity) in
+                  enumerate(zip(shards, capacities))],
+            max_workers=len(shards)):
+        ng += failed
+        metrics.extend(records)
+        hints.append(learned)
+    # saved at exit by this process only, the workers would overwrite each
+    # other
+    polling.get_hints().merge(hints)
+    report_metrics(metrics)
     if ng == 0:
         LOG.success('OK/NG/Total: {}/{}/{}', CONF.scenario_test.total - ng,
                     ng, CONF.scenario_test.total)
@@ -397,29 +981,60 @@ def process_test_vm():
                     ng, CONF.scenario_test.total)
 
 def coroutine_test_vm():
-    test_task = VMScenarioTest()
-    # test_task.check_services()
-    # test_task.check_flavor()
-    # test_task.check_image()
+    try:
+        api = pre_start()
+        admission_controller = admission.create_controller(api)
+    except Exception as e:
+        LOG.error('pre check failed: {}', e)
+        return
+
+    exporter.start()
+    test_task = VMScenarioTest(ec_manager=api,
+                               admission_controller=admission_controller)
 
     LOG.info('Start tasks, worker: {}, total: {}, actions: {}',
              CONF.scenario_test.worker, CONF.scenario_test.total,
              CONF.scenario_test.scenarios)
 
-    failed = 0
-    completed = 0
-    with futures.ThreadPoolExecutor(max_workers=CONF.scenario_test.worker) as tp:
-        tasks = [tp.submit(test_task.run, CONF.scenario_test.scenarios)
-                 for _ in range(CONF.scenario_test.total)]
-        for future in futures.as_completed(tasks):
-            try:
-                future.result()
-                completed += 1
-            except Exception as e:
-                failed += 1
-                LOG.exception(e)
-            finally:
-                LOG.info('completed {}/{}', completed, len(tasks))
+    try:
+        failed = _thread_test_vm(test_task, CONF.scenario_test.total,
+                                 CONF.scenario_test.worker)
+    finally:
+        api.close()
+    report_metrics(test_task.metrics)
+
+    LOG.info('Summary: total: {}, ' +
+             str(colorstr.GreenStr('success: {}')) + ", " +
+             str(colorstr.RedStr('failed: {}')) + ".",
+             CONF.scenario_test.total, CONF.scenario_test.total - failed, failed)
+
+
+def asyncio_test_vm():
+    """Run the vm tests as coroutines in one event loop
+
+    Only the API requests are run in the executor, the waits are coroutines,
+    so the worker can be much larger than the number of threads.
+    """
+    try:
+        api = pre_start()
+        admission_controller = admission.create_controller(api)
+    except Exception as e:
+        LOG.error('pre check failed: {}', e)
+        return
+
+    exporter.start()
+    test_task = VMScenarioTest(ec_manager=api,
+                               admission_controller=admission_controller)
+    LOG.info('Start tasks with asyncio, worker: {}, total: {}, actions: {}',
+             CONF.scenario_test.worker, CONF.scenario_test.total,
+             CONF.scenario_test.scenarios)
+
+    try:
+        failed = _run_asyncio_test_vm(test_task, CONF.scenario_test.total,
+                                      CONF.scenario_test.worker)
+    finally:
+        api.close()
+    report_metrics(test_task.metrics)
 
     LOG.info('Summary: total: {}, ' +
              str(colorstr.GreenStr('success: {}')) + ", " +
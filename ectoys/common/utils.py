@@ -1,5 +1,7 @@
+import asyncio
 import functools
 import json
+import math
 import os
 import time
 import pathlib
@@ -65,18 +67,46 @@ def do_times(options=None):
     return wrapper
 
 
+async def to_thread(func, *args, **kwargs):
+    """Run the blocking function in the default executor of the loop"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None,
+                                      functools.partial(func, *args, **kwargs))
+
+
 # TODO: move this to easy2use
 def run_processes(func, maps=None, max_workers=1, nums=None):
     from concurrent import futures
 
     with futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
         if maps:
-            tasks = executor.map(func, maps)
+            tasks = [executor.submit(func, item) for item in maps]
         elif nums:
             tasks = [executor.submit(func) for _ in range(nums)]
         for future in futures.as_completed(tasks):
             yield future.result()
 
+def split_num(total, parts):
+    """Split total into at most parts non-empty shards
+
+    e.g. split_num(10, 3) -> [4, 3, 3]
+    """
+    parts = max(min(parts, total), 1)
+    return [total // parts + (1 if i < total % parts else 0)
+            for i in range(parts)]
+
+
+def percentiles(values, percents=(50, 95, 99)):
+    """Nearest-rank percentiles, e.g. {'p50': 1.2, 'p95': 3.4, 'p99': 5.6}"""
+    values = sorted(values)
+    if not values:
+        return {f'p{p}': None for p in percents}
+    return {
+        f'p{p}': values[max(math.ceil(len(values) * p / 100), 1) - 1]
+        for p in percents
+    }
+
+
 def generate_name(resource):
     return 'ecToys-{}-{}'.format(resource,
                                  date.now_str(date_fmt='%m%d-%H:%M:%S'))
@@ -0,0 +1,122 @@
+"""
+Resource lookup cache
+
+The flavors, images, networks, services and volume types used by the tests
+rarely change, they are cached with TTL and LRU eviction and shared by all
+the workers in the process.
+"""
+import collections
+import threading
+import time
+
+from easy2use.globals import cfg
+
+from ectoys.common import exporter
+
+CONF = cfg.CONF
+
+
+class ResourceCache(object):
+    """Thread-safe cache with TTL and LRU eviction
+
+    The values are loaded by `get(key, loader)` if they are missing or
+    expired, the concurrent lookups of the same key share one load. The
+    errors of the loaders are raised and not cached.
+    """
+
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._items = collections.OrderedDict()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def _get_item(self, key, now):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        if item[0] <= now:
+            del self._items[key]
+            self.expired += 1
+            return None
+        self._items.move_to_end(key)
+        return item
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def get(self, key, loader, ttl=None):
+        """Get the value of the key, the first item of the key is the kind"""
+        kind = key[0] if isinstance(key, tuple) else key
+        with self._lock:
+            item = self._get_item(key, time.monotonic())
+            if item:
+                self.hits += 1
+            else:
+                self.misses += 1
+        exporter.CACHE_LOOKUPS.inc(kind=kind,
+                                   result='hit' if item else 'miss')
+        if item:
+            return item[1]
+        with self._lock:
+            loading = self._loading.get(key)
+            if not loading:
+                loading = self._loading[key] = threading.Lock()
+        with loading:
+            # the value may be loaded by another thread while waiting
+            with self._lock:
+                item = self._get_item(key, time.monotonic())
+            if item:
+                return item[1]
+            try:
+                value = loader()
+                self.put(key, value, ttl=ttl)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            return value
+
+    def invalidate(self, key=None):
+        """Remove the key, or all the keys if key is None"""
+        with self._lock:
+            if key is None:
+                self._items.clear()
+            else:
+                self._items.pop(key, None)
+
+    def to_dict(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._items),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0,
+                'expired': self.expired,
+                'evictions': self.evictions,
+            }
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Get the cache of this process, created from [openstack] config"""
+    global _CACHE
+
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = ResourceCache(maxsize=CONF.openstack.cache_size,
+                                   ttl=CONF.openstack.cache_ttl)
+        return _CACHE
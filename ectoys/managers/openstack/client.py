@@ -1,7 +1,14 @@
 """
 openstack client
 """
+import atexit
+import collections
+from concurrent import futures
+import hashlib
+import json
 import os
+import pathlib
+import threading
 
 from cinderclient import client as cinder_client
 import glanceclient
@@ -13,12 +20,30 @@ from novaclient import client as nova_client
 from novaclient import exceptions as nova_exc
 
 from easy2use.common import exceptions as base_exc
-from easy2use.common import retry
 from ectoys.common import log
+from ectoys.common import polling
+from . import pool
 
 LOG = log.getLogger()
 
 NOVA_API_VERSION = "2.37"
+# the name~ filter of volumes requires 3.34
+CINDER_API_VERSION = "3.34"
+# set to true (or a directory) to cache the tokens on disk
+TOKEN_CACHE_ENV = 'ECTOYS_TOKEN_CACHE'
+DEFAULT_TOKEN_CACHE_DIR = pathlib.Path('~', '.cache', 'ectoys', 'tokens')
+# resource: (max limit, used limit) of the absolute limits of the services
+ABSOLUTE_LIMITS = {
+    'nova': {
+        'instances': ('maxTotalInstances', 'totalInstancesUsed'),
+        'cores': ('maxTotalCores', 'totalCoresUsed'),
+        'ram': ('maxTotalRAMSize', 'totalRAMUsed'),
+    },
+    'cinder': {
+        'volumes': ('maxTotalVolumes', 'totalVolumesUsed'),
+        'gigabytes': ('maxTotalVolumeGigabytes', 'totalGigabytesUsed'),
+    },
+}
 nova_extensions = [ext for ext in
                    nova_client.discover_extensions(NOVA_API_VERSION)
                    if ext.name in ("assisted_volume_snapshots",
@@ -26,25 +51,184 @@ nova_extensions = [ext for ext in
                                    "server_external_events")]
 
 
+class TokenCache(object):
+    """Cache the auth state of keystone on disk
+
+    The cache file is keyed by auth url, user, project and region, it's
+    reused until the token expires and only readable by the owner.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = pathlib.Path(
+            cache_dir or DEFAULT_TOKEN_CACHE_DIR).expanduser()
+
+    @classmethod
+    def from_env(cls):
+        value = os.getenv(TOKEN_CACHE_ENV, '')
+        if value.lower() in ('', '0', 'false', 'no'):
+            return None
+        if value.lower() in ('1', 'true', 'yes'):
+            return cls()
+        return cls(cache_dir=value)
+
+    def get_file(self, auth_url, auth_kwargs):
+        key = json.dumps(
+            [auth_url] + [auth_kwargs.get(k) for k in
+                          ['username', 'user_domain_name', 'project_name',
+                           'project_domain_name', 'region_name']])
+        return self.cache_dir.joinpath(
+            hashlib.sha256(key.encode()).hexdigest())
+
+    def load(self, cache_file):
+        if not cache_file.exists():
+            return None
+        try:
+            with cache_file.open() as f:
+                return f.read()
+        except OSError as e:
+            LOG.warning('read token cache {} failed: {}', cache_file, e)
+
+    def save(self, cache_file, auth_state):
+        self.cache_dir.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(auth_state)
+        os.replace(tmp_file, cache_file)
+        LOG.debug('saved token cache to {}', cache_file)
+
+
+class ActionEventsCache(object):
+    """Events of the finished instance actions, keyed by vm and request id
+
+    The events of an action never change once all of them are finished,
+    only the events of the latest `max_vms` vms are kept.
+    """
+
+    def __init__(self, max_vms=1000):
+        self.max_vms = max_vms
+        self._lock = threading.Lock()
+        self._vms = collections.OrderedDict()
+
+    def get(self, vm_id):
+        with self._lock:
+            if vm_id not in self._vms:
+                return {}
+            self._vms.move_to_end(vm_id)
+            return dict(self._vms[vm_id])
+
+    def update(self, vm_id, action_events):
+        finished = {
+            request_id: events for request_id, events in action_events.items()
+            if events and all(event.get('finish_time') for event in events)
+        }
+        with self._lock:
+            self._vms.setdefault(vm_id, {}).update(finished)
+            self._vms.move_to_end(vm_id)
+            while len(self._vms) > self.max_vms:
+                self._vms.popitem(last=False)
+
+
 class OpenstackClient(object):
     V3_AUTH_KWARGS = ['username', 'password', 'project_name',
                       'user_domain_name', 'project_domain_name',
                       'region_name']
+    SERVICES = ['keystone', 'nova', 'neutron', 'glance', 'cinder']
 
-    def __init__(self, *args, **kwargs):
-        region_name = kwargs.pop('region_name', None)
-        self.auth = v3.Password(*args, **kwargs)
-        self.session = Session(auth=self.auth)
+    def __init__(self, *args, token_cache: TokenCache = None,
+                 pool_size=None, pool_sizes=None, pool_block=False,
+                 rate_limit=None, rate_limits=None, rate_burst=None,
+                 **kwargs):
+        """
+        pool_size: the connection pool size of every service
+        pool_sizes: the connection pool size of special services,
+                    e.g. {'nova': 50}
+        rate_limit: requests per second of every service
+        rate_limits: requests per second of special services,
+                     e.g. {'nova': 20}
+        """
+        region_name = kwargs.get('region_name')
+        self.action_events = ActionEventsCache()
+        self.auth = v3.Password(
+            *args, **{k: v for k, v in kwargs.items() if k != 'region_name'})
+        if token_cache:
+            self._use_token_cache(token_cache, kwargs)
+        pool_sizes = pool_sizes or {}
+        rate_limits = rate_limits or {}
+        self.pools = {}
+        for service in self.SERVICES:
+            rate = rate_limits.get(service, rate_limit)
+            self.pools[service] = pool.ServicePool(
+                service, pool_size=pool_sizes.get(service, pool_size),
+                block=pool_block,
+                limiter=pool.get_limiter(service, rate, burst=rate_burst)
+                if rate else None)
+        self.session = self._get_session('keystone')
         self.keystone = client.Client(session=self.session)
-        self.neutron = neutron_client.Client(session=self.session,
-                                             region_name=region_name)
-        self.nova = nova_client.Client(NOVA_API_VERSION, session=self.session,
+        self.neutron = neutron_client.Client(
+            session=self._get_session('neutron'), region_name=region_name)
+        self.nova = nova_client.Client(NOVA_API_VERSION,
+                                       session=self._get_session('nova'),
                                        extensions=nova_extensions,
                                        region_name=region_name)
-        self.glance = glanceclient.Client('2', session=self.session,
-                                          region_name=region_name)
-        self.cinder = cinder_client.Client('3', session=self.session,
-                                           region_name=region_name)
+        self.glance = glanceclient.Client(
+            '2', session=self._get_session('glance'),
+            region_name=region_name)
+        self.cinder = cinder_client.Client(
+            CINDER_API_VERSION, session=self._get_session('cinder'),
+            region_name=region_name)
+
+    def _get_session(self, service):
+        return Session(auth=self.auth, session=self.pools[service].session)
+
+    def resize_pools(self, pool_size, services=None):
+        """Make sure the connection pools are large enough for the workers"""
+        for service in services or self.SERVICES:
+            self.pools[service].resize(pool_size)
+
+    def get_pool_stats(self):
+        return {
+            service: service_pool.stats.to_dict()
+            for service, service_pool in self.pools.items()
+        }
+
+    def get_limiter_stats(self):
+        return {
+            service: service_pool.limiter.to_dict()
+            for service, service_pool in self.pools.items()
+            if service_pool.limiter
+        }
+
+    def report_pool_stats(self):
+        for service, stats in self.get_pool_stats().items():
+            if not stats['requests']:
+                continue
+            LOG.info('{} connection pool: requests={requests}, '
+                     'connections={connections}, reuse={reuse_rate}, '
+                     'wait={wait_time}s, max_wait={max_wait_time}s',
+                     service, **stats)
+        for service, stats in self.get_limiter_stats().items():
+            LOG.info('{} rate limiter: rate={rate}/s, burst={burst}, '
+                     'throttled={throttled}, max_waiting={max_waiting}, '
+                     'throttle_time={throttle_time}s', service, **stats)
+
+    def _use_token_cache(self, token_cache, auth_kwargs):
+        cache_file = token_cache.get_file(self.auth.auth_url, auth_kwargs)
+        cached_state = token_cache.load(cache_file)
+        if cached_state:
+            try:
+                self.auth.set_auth_state(cached_state)
+                LOG.debug('use token cache {}', cache_file)
+            except (ValueError, KeyError) as e:
+                LOG.warning('invalid token cache {}: {}', cache_file, e)
+                cached_state = None
+
+        def save_auth_state():
+            auth_state = self.auth.get_auth_state()
+            if auth_state and auth_state != cached_state:
+                token_cache.save(cache_file, auth_state)
+
+        atexit.register(save_auth_state)
 
     @classmethod
     def get_auth_info_from_env(cls):
@@ -60,10 +244,11 @@ class OpenstackClient(object):
         return auth_url, auth_kwargs
 
     @classmethod
-    def create_instance(cls):
+    def create_instance(cls, **pool_kwargs):
         auth_url, auth_kwargs = cls.get_auth_info_from_env()
         LOG.debug('auth info: {}', auth_kwargs)
-        return OpenstackClient(auth_url, **auth_kwargs)
+        return OpenstackClient(auth_url, token_cache=TokenCache.from_env(),
+                               **pool_kwargs, **auth_kwargs)
 
     def attach_interface(self, net_id=None, port_id=None):
         return self.nova.servers.interface_attach(net_id=net_id,
@@ -94,31 +279,52 @@ class OpenstackClient(object):
     def delete_volume(self, volume_id):
         return self.cinder.volumes.delete(volume_id)
 
-    def get_vm_actions(self, vm):
+    def _list_action_events(self, vm, workers=4):
+        """List the actions of the vm with their events
+
+        Only the events of the actions which are not cached are fetched,
+        by at most `workers` concurrent requests.
+        """
+        actions = self.nova.instance_action.list(vm.id)
+        cached = self.action_events.get(vm.id)
+        missing = [action.request_id for action in actions
+                   if action.request_id not in cached]
+
+        def get_events(request_id):
+            return self.nova.instance_action.get(vm.id, request_id).events
+
+        fetched = {}
+        if len(missing) > 1 and workers > 1:
+            with futures.ThreadPoolExecutor(
+                    max_workers=min(workers, len(missing))) as executor:
+                fetched = dict(zip(missing, executor.map(get_events,
+                                                         missing)))
+        elif missing:
+            fetched = {request_id: get_events(request_id)
+                       for request_id in missing}
+        self.action_events.update(vm.id, fetched)
+        cached.update(fetched)
+        return [(action, cached[action.request_id]) for action in actions]
+
+    def get_vm_actions(self, vm, workers=4):
         actions = {}
-        for action in self.nova.instance_action.list(vm.id):
-            actions.setdefault(action.action, [])
-            vm_action = self.nova.instance_action.get(vm.id,
-                                                      action.request_id)
-            for event in vm_action.events:
-                actions[action.action].append(event)
+        for action, events in self._list_action_events(vm, workers=workers):
+            actions.setdefault(action.action, []).extend(events)
         return actions
 
-    def get_vm_events(self, vm):
-        action_events = []
-        for action in self.nova.instance_action.list(vm.id):
-            vm_action = self.nova.instance_action.get(vm.id,
-                                                      action.request_id)
-            events = sorted(vm_action.events,
-                            key=lambda x: x.get('start_time'))
-            action_events.append((action.action, events))
-        return action_events
+    def get_vm_events(self, vm, workers=4):
+        return [
+            (action.action,
+             sorted(events, key=lambda x: x.get('start_time')))
+            for action, events in self._list_action_events(vm,
+                                                           workers=workers)
+        ]
 
     def get_server_interfaces(self, server_id):
         return self.nova.servers.interface_list(server_id)
 
     def detach_server_interface(self, server_id, port_id, wait=False,
-                                interval=5, timeout=600):
+                                interval=5, timeout=600, policy=None):
         self.detach_interface(server_id, port_id)
 
         if not wait:
@@ -129,18 +335,58 @@ class OpenstackClient(object):
             return all(interface.id != port_id for interface in interfaces)
 
         LOG.debug('[vm: %s] interface %s detaching', server_id, port_id)
-        retry.retry_untile_true(_check_interface,
-                                interval=interval, timeout=timeout)
+        polling.wait_until(_check_interface,
+                           policy or polling.PollingPolicy(interval=interval),
+                           timeout=timeout)
         LOG.debug('[vm: %s] interface %s detached', server_id, port_id)
 
     def list_volumes(self, all_tenants=False):
         return self.cinder.volumes.list({'all_tenants': all_tenants})
 
+    def iter_volumes(self, all_tenants=False, status=None, name_like=None,
+                     detailed=True, page_size=1000):
+        """Get the volumes page by page
+
+        The filters are sent to cinder, name_like matches the volumes whose
+        names contain it. Only the id and name are returned if detailed is
+        false. The pages may be smaller than page_size if it's larger than
+        osapi_max_limit of cinder, so the pages are listed until an empty one
+        is returned. The next page is fetched before the volumes of this page
+        are yielded, so the volumes may be deleted while iterating, the
+        marker is never a deleted volume.
+        """
+        search_opts = {}
+        if all_tenants:
+            search_opts['all_tenants'] = 1
+        if status:
+            search_opts['status'] = status
+        if name_like:
+            search_opts['name~'] = name_like
+
+        def list_page(marker=None):
+            return self.cinder.volumes.list(detailed=detailed,
+                                            search_opts=search_opts,
+                                            marker=marker, limit=page_size)
+
+        volumes = list_page()
+        while volumes:
+            next_volumes = list_page(marker=volumes[-1].id)
+            for volume in volumes:
+                if name_like and name_like not in (volume.name or ''):
+                    continue
+                yield volume
+            volumes = next_volumes
+
     def get_flavor(self, id_or_name):
         try:
             return self.nova.flavors.get(id_or_name)
         except nova_exc.NotFound:
             return self.nova.flavors.find(name=id_or_name)
 
-def factory():
-    return OpenstackClient.create_instance()
+def factory(**kwargs):
+    """Create the client with the auth info from env
+
+    kwargs are the connection pool and rate limit arguments of
+    OpenstackClient.
+    """
+    return OpenstackClient.create_instance(**kwargs)
@@ -0,0 +1,1198 @@
+"""
+Fake openstack backend
+
+An in-process fake cloud which stands in for the openstack client, so the
+scenario runner, the wait engine and the bulk operations can be run and
+profiled without a real cloud.
+
+The fake services implement the parts of the nova, cinder, glance and
+neutron clients used by ectoys. The state transitions (e.g. building ->
+active) finish after configurable durations, they are applied lazily when
+the resources are read. With the local notification listener a background
+ticker thread also applies the due transitions, so their notifications are
+published without reading. Every API call can sleep for a sampled latency
+and fail with a configured error rate.
+"""
+import collections
+import datetime
+import itertools
+import math
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from cinderclient import exceptions as cinder_exc
+from easy2use.globals import cfg
+from glanceclient import exc as glance_exc
+from neutronclient.common import exceptions as neutron_exc
+from novaclient import exceptions as nova_exc
+
+from ectoys.common import exporter
+from ectoys.common import log
+from . import client
+from . import notification
+from . import rbd
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+# seconds of the state transitions
+DEFAULT_TRANSITION_TIMES = {
+    'boot': 10, 'delete': 2,
+    'stop': 3, 'start': 3, 'reboot': 5, 'hard_reboot': 5,
+    'suspend': 3, 'resume': 3, 'pause': 1, 'unpause': 1,
+    'resize': 10, 'migrate': 10, 'live_migrate': 10, 'backup': 5,
+    'volume_create': 3, 'volume_delete': 2,
+    'volume_attach': 3, 'volume_detach': 3,
+    'interface_attach': 1, 'interface_detach': 1,
+}
+# action: (vm_state required, task_state while running, vm_state finally)
+SERVER_ACTIONS = {
+    'stop': ({'active'}, 'powering-off', 'stopped'),
+    'start': ({'stopped'}, 'powering-on', 'active'),
+    'reboot': ({'active'}, 'rebooting', 'active'),
+    'hard_reboot': ({'active', 'stopped', 'error'}, 'rebooting_hard',
+                    'active'),
+    'suspend': ({'active'}, 'suspending', 'suspended'),
+    'resume': ({'suspended'}, 'resuming', 'active'),
+    'pause': ({'active'}, 'pausing', 'paused'),
+    'unpause': ({'paused'}, 'unpausing', 'active'),
+    'resize': ({'active', 'stopped'}, 'resize_prep', 'active'),
+    'migrate': ({'active', 'stopped'}, 'resize_migrating', 'active'),
+    'live_migrate': ({'active'}, 'migrating', 'active'),
+    'backup': ({'active', 'stopped'}, 'image_backup', None),
+}
+VM_STATUS = {
+    'active': 'ACTIVE', 'building': 'BUILD', 'stopped': 'SHUTOFF',
+    'error': 'ERROR', 'deleted': 'DELETED', 'paused': 'PAUSED',
+    'suspended': 'SUSPENDED',
+}
+TASK_STATUS = {
+    'rebooting': 'REBOOT', 'rebooting_hard': 'HARD_REBOOT',
+    'resize_prep': 'RESIZE', 'resize_migrating': 'RESIZE',
+    'migrating': 'MIGRATING',
+}
+
+
+def _time_str(timestamp):
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).strftime(
+        '%Y-%m-%dT%H:%M:%S.%fZ')
+
+def _server_status(vm_state, task_state):
+    return TASK_STATUS.get(task_state) or VM_STATUS.get(vm_state, 'UNKNOWN')
+
+
+class FakeResource(object):
+
+    def __init__(self, manager, info):
+        self.manager = manager
+        self._info = {}
+        self._add_details(info)
+
+    def _add_details(self, info):
+        for k, v in info.items():
+            setattr(self, k, v)
+            self._info[k] = v
+
+    def to_dict(self):
+        return dict(self._info)
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__} {self._info.get("id")}>'
+
+
+class FakeCloud(object):
+    """The state of the fake cloud, shared by all the fake clients"""
+
+    def __init__(self, transition_times=None, transition_jitter=0,
+                 api_latency=0, api_latency_jitter=0,
+                 api_latency_distribution='lognormal', api_error_rate=0,
+                 boot_error_rate=0, hosts=10, time_scale=1, quotas=None,
+                 host_vcpus=None, host_ram_mb=None, cpu_allocation_ratio=1,
+                 ram_allocation_ratio=1):
+        self.transition_times = dict(DEFAULT_TRANSITION_TIMES)
+        self.transition_times.update(transition_times or {})
+        self.transition_jitter = transition_jitter
+        self.api_latency = api_latency
+        self.api_latency_jitter = api_latency_jitter
+        self.api_latency_distribution = api_latency_distribution
+        self.api_error_rate = api_error_rate
+        self.boot_error_rate = boot_error_rate
+        self.time_scale = time_scale
+        # resource: limit, the resources not in the quotas are unlimited
+        self.quotas = quotas or {}
+        # resources of every host, None means unlimited
+        self.host_vcpus = host_vcpus
+        self.host_ram_mb = host_ram_mb
+        self.cpu_allocation_ratio = cpu_allocation_ratio
+        self.ram_allocation_ratio = ram_allocation_ratio
+        self.hosts = [f'fake-compute-{i}' for i in range(1, hosts + 1)]
+        self._host_cycle = itertools.cycle(self.hosts)
+        self.lock = threading.RLock()
+        self.api_calls = collections.Counter()
+        # the broker which the notifications are published to
+        self.notifier = None
+        # the process which runs the ticker
+        self.ticker_pid = None
+
+        self.servers = {}
+        self.volumes = {}
+        self.interfaces = collections.defaultdict(list)
+        self.actions = collections.defaultdict(list)
+        self.flavors = {}
+        self.images = {}
+        self.networks = {}
+        self.volume_types = {}
+        # the images of the volumes, e.g. volumes/volume-<id>
+        self.rbd_pool = 'volumes'
+        self.rbd = rbd.StubBackend(pools={self.rbd_pool: []})
+        self._transitions = collections.defaultdict(list)
+
+    # --- helpers ---
+
+    def _sample(self, mean, jitter, distribution):
+        if not mean:
+            return 0
+        if distribution == 'fixed' or not jitter:
+            return mean
+        if distribution == 'uniform':
+            return random.uniform(mean * (1 - jitter), mean * (1 + jitter))
+        # lognormal with the same mean
+        mu = math.log(mean) - jitter ** 2 / 2
+        return random.lognormvariate(mu, jitter)
+
+    def call(self, service, api, error_cls):
+        """Count the API call, sleep for the latency and maybe fail"""
+        with self.lock:
+            self.api_calls[(service, api)] += 1
+        latency = self._sample(self.api_latency, self.api_latency_jitter,
+                               self.api_latency_distribution)
+        if latency:
+            time.sleep(latency * self.time_scale)
+        if self.api_error_rate and random.random() < self.api_error_rate:
+            exporter.observe_request(service, 'CALL', api, code='500')
+            raise error_cls(500, f'fake {service} {api} error')
+        exporter.observe_request(service, 'CALL', api)
+
+    def get_api_calls(self, service=None):
+        with self.lock:
+            return sum(num for (s, _), num in self.api_calls.items()
+                       if not service or s == service)
+
+    def schedule(self, resource_id, op, func):
+        """Run func(timestamp) when the transition of op finished"""
+        duration = self._sample(self.transition_times.get(op, 1),
+                                self.transition_jitter, 'uniform')
+        due = time.time() + duration * self.time_scale
+        self._transitions[resource_id].append((due, func))
+        return due
+
+    def start_ticker(self, interval=0.05):
+        """Apply the due transitions in background
+
+        The transitions are applied when the resources are read, the ticker
+        is required to publish the notifications without reading.
+        """
+        def _tick():
+            while True:
+                with self.lock:
+                    for resource_id in list(self._transitions):
+                        self.refresh(resource_id)
+                time.sleep(interval)
+
+        self.ticker_pid = os.getpid()
+        threading.Thread(target=_tick, name='fake-cloud-ticker',
+                         daemon=True).start()
+
+    def publish(self, event_type, payload):
+        if self.notifier:
+            self.notifier.publish(event_type, payload)
+
+    def refresh(self, resource_id):
+        """Apply the finished transitions of the resource"""
+        transitions = self._transitions.get(resource_id)
+        if not transitions:
+            return
+        now = time.time()
+        pending = []
+        for due, func in sorted(transitions, key=lambda x: x[0]):
+            if due <= now:
+                func(due)
+            else:
+                pending.append((due, func))
+        if pending:
+            self._transitions[resource_id] = pending
+        else:
+            self._transitions.pop(resource_id, None)
+
+    # --- seed ---
+
+    def add_flavor(self, name, flavor_id=None, ram=1024, vcpus=1, disk=10):
+        flavor_id = flavor_id or str(uuid.uuid4())
+        self.flavors[flavor_id] = {'id': flavor_id, 'name': name, 'ram': ram,
+                                   'vcpus': vcpus, 'disk': disk}
+        return self.flavors[flavor_id]
+
+    def add_image(self, image_id, name=None):
+        self.images[image_id] = {'id': image_id, 'name': name or image_id,
+                                 'status': 'active'}
+        return self.images[image_id]
+
+    def add_network(self, net_id, name=None):
+        self.networks[net_id] = {'id': net_id, 'name': name or net_id,
+                                 'status': 'ACTIVE'}
+        return self.networks[net_id]
+
+    def add_volume_type(self, name, type_id=None):
+        type_id = type_id or str(uuid.uuid4())
+        self.volume_types[type_id] = {'id': type_id, 'name': name}
+        return self.volume_types[type_id]
+
+    # --- quotas ---
+
+    def get_usage(self):
+        with self.lock:
+            servers = [s for s in self.servers.values() if not s['deleted']]
+            flavors = [self.flavors.get(s['flavor']['id'], {})
+                       for s in servers]
+            return {
+                'instances': len(servers),
+                'cores': sum(f.get('vcpus', 0) for f in flavors),
+                'ram': sum(f.get('ram', 0) for f in flavors),
+                'volumes': len(self.volumes),
+                'gigabytes': sum(v['size'] for v in self.volumes.values()),
+            }
+
+    def _check_quota(self, error_cls, **required):
+        usage = self.get_usage()
+        for resource, num in required.items():
+            limit = self.quotas.get(resource, -1)
+            if limit >= 0 and usage[resource] + num > limit:
+                raise error_cls(f'Quota exceeded for {resource}: requested '
+                                f'{num}, used {usage[resource]} of {limit}')
+
+    def get_limits(self, service):
+        """Get the absolute limits of nova or cinder"""
+        usage = self.get_usage()
+        limits = {}
+        for resource, (max_name, used_name) in client.ABSOLUTE_LIMITS[
+                service].items():
+            limits[max_name] = self.quotas.get(resource, -1)
+            limits[used_name] = usage[resource]
+        return limits
+
+    # --- hypervisors ---
+
+    def get_host_usage(self):
+        """Get the vcpus, ram and servers used on every host"""
+        usage = {host: collections.Counter() for host in self.hosts}
+        with self.lock:
+            for server in self.servers.values():
+                host = server['OS-EXT-SRV-ATTR:hypervisor_hostname']
+                if server['deleted'] or host not in usage:
+                    continue
+                flavor = self.flavors.get(server['flavor']['id'], {})
+                usage[host].update(vcpus=flavor.get('vcpus', 0),
+                                   ram=flavor.get('ram', 0), servers=1)
+        return usage
+
+    def _fits(self, used, flavor):
+        return (self.host_vcpus is None or
+                used['vcpus'] + flavor['vcpus'] <=
+                self.host_vcpus * self.cpu_allocation_ratio) and \
+            (self.host_ram_mb is None or
+             used['ram'] + flavor['ram'] <=
+             self.host_ram_mb * self.ram_allocation_ratio)
+
+    def _select_host(self, flavor, host=None):
+        """Select the host which has enough resources, or None"""
+        usage = self.get_host_usage()
+        if host:
+            return host if host in usage and \
+                self._fits(usage[host], flavor) else None
+        for _ in self.hosts:
+            host = next(self._host_cycle)
+            if self._fits(usage[host], flavor):
+                return host
+        return None
+
+    def list_hypervisors(self):
+        return [
+            {'id': index, 'hypervisor_hostname': host,
+             'service': {'id': index, 'host': host},
+             'state': 'up', 'status': 'enabled',
+             'vcpus': self.host_vcpus or 0, 'vcpus_used': used['vcpus'],
+             'memory_mb': self.host_ram_mb or 0,
+             'memory_mb_used': used['ram'],
+             'running_vms': used['servers']}
+            for index, (host, used) in enumerate(
+                self.get_host_usage().items(), start=1)
+        ]
+
+    # --- servers ---
+
+    def _update_server(self, server, timestamp,
+                       event_type='instance.update', **kwargs):
+        server.update(kwargs)
+        server['status'] = _server_status(server['OS-EXT-STS:vm_state'],
+                                          server['OS-EXT-STS:task_state'])
+        server['updated'] = _time_str(timestamp)
+        self.publish(event_type, {
+            'nova_object.name': 'InstanceUpdatePayload',
+            'nova_object.data': {
+                'uuid': server['id'],
+                'state': server['OS-EXT-STS:vm_state'],
+                'task_state': server['OS-EXT-STS:task_state'],
+                'host': server['OS-EXT-SRV-ATTR:host'],
+                'updated_at': server['updated'],
+            }})
+
+    def _update_volume(self, volume, timestamp, event_type, **kwargs):
+        volume.update(kwargs, updated_at=_time_str(timestamp))
+        self.publish(event_type, {'volume_id': volume['id'],
+                                  'status': volume['status'],
+                                  'display_name': volume['name']})
+
+    def _start_action(self, server_id, action):
+        request_id = f'req-{uuid.uuid4()}'
+        started = _time_str(time.time())
+        event = {'event': f'compute_{action}', 'start_time': started,
+                 'finish_time': None, 'result': None, 'traceback': None}
+        self.actions[server_id].append({
+            'action': action, 'request_id': request_id,
+            'instance_uuid': server_id, 'start_time': started,
+            'events': [event]})
+        return event
+
+    @staticmethod
+    def _finish_event(event, timestamp, result='Success'):
+        event['finish_time'] = _time_str(timestamp)
+        event['result'] = result
+
+    def get_server(self, server_id, deleted=False):
+        with self.lock:
+            server = self.servers.get(server_id)
+            if server:
+                self.refresh(server_id)
+            if not server or (server['deleted'] and not deleted):
+                raise nova_exc.NotFound(404, f'server {server_id} not found')
+            return dict(server)
+
+    def create_server(self, name, image, flavor, nics=None,
+                      block_device_mapping_v2=None, availability_zone=None,
+                      reservation_id=None):
+        if flavor not in self.flavors:
+            raise nova_exc.BadRequest(400, f'flavor {flavor} not found')
+        if not block_device_mapping_v2 and image not in self.images:
+            raise nova_exc.BadRequest(400, f'image {image} not found')
+        for nic in isinstance(nics, list) and nics or []:
+            if nic.get('net-id') not in self.networks:
+                raise nova_exc.BadRequest(
+                    400, f'network {nic.get("net-id")} not found')
+        host = None
+        if availability_zone and ':' in availability_zone:
+            host = availability_zone.split(':', 1)[1]
+        with self.lock:
+            self._check_quota(
+                lambda msg: nova_exc.Forbidden(403, msg), instances=1,
+                cores=self.flavors[flavor]['vcpus'],
+                ram=self.flavors[flavor]['ram'])
+            now = time.time()
+            server_id = str(uuid.uuid4())
+            server = {
+                'id': server_id, 'name': name, 'image': {'id': image},
+                'flavor': {'id': flavor}, 'created': _time_str(now),
+                'reservation_id': reservation_id or f'r-{uuid.uuid4().hex}',
+                'OS-EXT-SRV-ATTR:host': None,
+                'OS-EXT-SRV-ATTR:hypervisor_hostname': None,
+                'OS-EXT-AZ:availability_zone': 'nova',
+                'os-extended-volumes:volumes_attached': [],
+                'addresses': {}, 'metadata': {}, 'deleted': False,
+            }
+            self._update_server(server, now,
+                                **{'OS-EXT-STS:vm_state': 'building',
+                                   'OS-EXT-STS:task_state': 'spawning'})
+            self.servers[server_id] = server
+            event = self._start_action(server_id, 'create')
+            failed = random.random() < self.boot_error_rate
+            # the resources are claimed when the server is scheduled
+            target_host = self._select_host(self.flavors[flavor], host=host)
+            server['OS-EXT-SRV-ATTR:hypervisor_hostname'] = target_host
+            if not target_host:
+                failed = True
+                server['fault'] = {'code': 500,
+                                   'message': 'No valid host was found.'}
+
+            def booted(timestamp):
+                self._finish_event(event, timestamp,
+                                   failed and 'Error' or 'Success')
+                self._update_server(
+                    server, timestamp,
+                    **{'OS-EXT-STS:vm_state': failed and 'error' or 'active',
+                       'OS-EXT-STS:task_state': None,
+                       'OS-EXT-SRV-ATTR:host': target_host})
+
+            self.schedule(server_id, 'boot', booted)
+            for nic in isinstance(nics, list) and nics or []:
+                self._add_interface(server_id, nic['net-id'])
+            return dict(server)
+
+    def server_action(self, server_id, action):
+        vm_states, task_state, final_vm_state = SERVER_ACTIONS[action]
+        with self.lock:
+            server = self.servers.get(server_id)
+            self.refresh(server_id)
+            if not server or server['deleted']:
+                raise nova_exc.NotFound(404, f'server {server_id} not found')
+            vm_state = server['OS-EXT-STS:vm_state']
+            if vm_state not in vm_states or \
+               server['OS-EXT-STS:task_state']:
+                raise nova_exc.Conflict(
+                    409, f'can not {action} server in vm_state {vm_state} '
+                         f'task_state {server["OS-EXT-STS:task_state"]}')
+            self._update_server(server, time.time(),
+                                **{'OS-EXT-STS:task_state': task_state})
+            event = self._start_action(server_id, action)
+            changes = {'OS-EXT-STS:vm_state': final_vm_state or vm_state,
+                       'OS-EXT-STS:task_state': None}
+            if action in ('resize', 'migrate', 'live_migrate'):
+                hosts = [h for h in self.hosts
+                         if h != server['OS-EXT-SRV-ATTR:host']]
+                changes['OS-EXT-SRV-ATTR:host'] = random.choice(
+                    hosts or self.hosts)
+
+            def finished(timestamp):
+                self._finish_event(event, timestamp)
+                self._update_server(server, timestamp, **changes)
+
+            self.schedule(server_id, action, finished)
+
+    def delete_server(self, server_id):
+        with self.lock:
+            server = self.servers.get(server_id)
+            self.refresh(server_id)
+            if not server or server['deleted']:
+                raise nova_exc.NotFound(404, f'server {server_id} not found')
+            self._update_server(server, time.time(),
+                                **{'OS-EXT-STS:task_state': 'deleting'})
+            event = self._start_action(server_id, 'delete')
+
+            def deleted(timestamp):
+                self._finish_event(event, timestamp)
+                self._update_server(server, timestamp,
+                                    event_type='instance.delete.end',
+                                    deleted=True,
+                                    **{'OS-EXT-STS:vm_state': 'deleted',
+                                       'OS-EXT-STS:task_state': None})
+                for vol_id in [v['id'] for v in server[
+                        'os-extended-volumes:volumes_attached']]:
+                    self._update_volume(self.volumes[vol_id], timestamp,
+                                        'volume.detach.end',
+                                        status='available', attachments=[])
+                self.interfaces.pop(server_id, None)
+
+            self.schedule(server_id, 'delete', deleted)
+
+    def list_servers(self, search_opts=None, marker=None, limit=None):
+        search_opts = search_opts or {}
+        since = search_opts.get('changes-since')
+        name = search_opts.get('name')
+        with self.lock:
+            for server_id in list(self._transitions):
+                if server_id in self.servers:
+                    self.refresh(server_id)
+            servers = sorted(self.servers.values(),
+                             key=lambda s: (s['created'], s['id']))
+            if marker:
+                ids = [s['id'] for s in servers]
+                if marker not in ids:
+                    raise nova_exc.BadRequest(400, f'marker {marker} not found')
+                servers = servers[ids.index(marker) + 1:]
+            matched = []
+            for server in servers:
+                if since:
+                    if server['updated'] < since:
+                        continue
+                elif server['deleted']:
+                    continue
+                if name and not re.search(name, server['name']):
+                    continue
+                if any(search_opts.get(k) and server[attr] != search_opts[k]
+                       for k, attr in [('vm_state', 'OS-EXT-STS:vm_state'),
+                                       ('host', 'OS-EXT-SRV-ATTR:host'),
+                                       ('status', 'status'),
+                                       ('reservation_id', 'reservation_id')]):
+                    continue
+                matched.append(dict(server))
+                if limit and limit > 0 and len(matched) >= limit:
+                    break
+            return matched
+
+    def get_console_output(self, server_id):
+        server = self.get_server(server_id)
+        if server['OS-EXT-STS:vm_state'] != 'active':
+            return ''
+        return f'\n{server["name"]} login: '
+
+    # --- interfaces ---
+
+    def _add_interface(self, server_id, net_id, port_id=None):
+        port_id = port_id or str(uuid.uuid4())
+        interface = {
+            'id': port_id, 'port_id': port_id, 'net_id': net_id,
+            'port_state': 'ACTIVE', 'mac_addr': 'fa:16:3e:%02x:%02x:%02x' % (
+                random.randint(0, 255), random.randint(0, 255),
+                random.randint(0, 255)),
+            'fixed_ips': [{'ip_address': '10.0.%d.%d' % (
+                random.randint(0, 255), random.randint(2, 254))}],
+        }
+        self.interfaces[server_id].append(interface)
+        return interface
+
+    def attach_interface(self, server_id, net_id=None, port_id=None):
+        with self.lock:
+            self.get_server(server_id)
+            if net_id and net_id not in self.networks:
+                raise nova_exc.BadRequest(400, f'network {net_id} not found')
+            event = self._start_action(server_id, 'attach_interface')
+            self._finish_event(event, time.time())
+            return dict(self._add_interface(server_id, net_id,
+                                            port_id=port_id))
+
+    def detach_interface(self, server_id, port_id):
+        with self.lock:
+            self.get_server(server_id)
+            interfaces = self.interfaces[server_id]
+            if all(vif['port_id'] != port_id for vif in interfaces):
+                raise nova_exc.NotFound(404, f'port {port_id} not found')
+            event = self._start_action(server_id, 'detach_interface')
+
+            def detached(timestamp):
+                self._finish_event(event, timestamp)
+                self.interfaces[server_id] = [
+                    vif for vif in self.interfaces[server_id]
+                    if vif['port_id'] != port_id]
+
+            self.schedule(server_id, 'interface_detach', detached)
+
+    def list_interfaces(self, server_id):
+        with self.lock:
+            self.get_server(server_id)
+            return [dict(vif) for vif in self.interfaces[server_id]]
+
+    # --- volumes ---
+
+    def get_volume(self, volume_id):
+        with self.lock:
+            self.refresh(volume_id)
+            if volume_id not in self.volumes:
+                raise cinder_exc.NotFound(404, f'volume {volume_id} not found')
+            return dict(self.volumes[volume_id])
+
+    def create_volume(self, size, name=None, image_ref=None, snapshot_id=None,
+                      volume_type=None):
+        with self.lock:
+            self._check_quota(lambda msg: cinder_exc.OverLimit(413, msg),
+                              volumes=1, gigabytes=size)
+            volume_id = str(uuid.uuid4())
+            now = time.time()
+            volume = {'id': volume_id, 'name': name, 'size': size,
+                      'status': 'creating', 'volume_type': volume_type,
+                      'imageRef': image_ref, 'snapshot_id': snapshot_id,
+                      'attachments': [], 'created_at': _time_str(now),
+                      'updated_at': _time_str(now)}
+            self.volumes[volume_id] = volume
+            self.rbd.add_image(self.rbd_pool,
+                               f'{rbd.VOLUME_PREFIX}{volume_id}')
+
+            def created(timestamp):
+                self._update_volume(volume, timestamp, 'volume.create.end',
+                                    status='available')
+
+            self.schedule(volume_id, 'volume_create', created)
+            return dict(volume)
+
+    def delete_volume(self, volume_id):
+        with self.lock:
+            volume = self.get_volume(volume_id)
+            if volume['status'] not in ('available', 'error'):
+                raise cinder_exc.BadRequest(
+                    400, f'volume status must be available or error, '
+                         f'but is {volume["status"]}')
+            self.volumes[volume_id].update(status='deleting',
+                                           updated_at=_time_str(time.time()))
+
+            def deleted(timestamp):
+                volume = self.volumes.pop(volume_id, None)
+                if volume:
+                    self.rbd.remove_image(
+                        self.rbd_pool, f'{rbd.VOLUME_PREFIX}{volume_id}')
+                    self._update_volume(volume, timestamp,
+                                        'volume.delete.end',
+                                        status='deleted')
+
+            self.schedule(volume_id, 'volume_delete', deleted)
+
+    def list_volumes(self, search_opts=None, marker=None, limit=None):
+        search_opts = search_opts or {}
+        with self.lock:
+            for volume_id in list(self._transitions):
+                if volume_id in self.volumes:
+                    self.refresh(volume_id)
+            volumes = sorted(self.volumes.values(),
+                             key=lambda v: (v['created_at'], v['id']))
+            if marker:
+                ids = [v['id'] for v in volumes]
+                if marker not in ids:
+                    raise cinder_exc.BadRequest(
+                        400, f'marker {marker} not found')
+                volumes = volumes[ids.index(marker) + 1:]
+            matched = []
+            for volume in volumes:
+                if search_opts.get('status') and \
+                   volume['status'] != search_opts['status']:
+                    continue
+                if search_opts.get('name') and \
+                   volume['name'] != search_opts['name']:
+                    continue
+                if search_opts.get('name~') and \
+                   search_opts['name~'] not in (volume['name'] or ''):
+                    continue
+                matched.append(dict(volume))
+                if limit and len(matched) >= limit:
+                    break
+            return matched
+
+    def attach_volume(self, server_id, volume_id):
+        with self.lock:
+            self.get_server(server_id)
+            volume = self.get_volume(volume_id)
+            if volume['status'] != 'available':
+                raise nova_exc.BadRequest(
+                    400, f'volume {volume_id} status is {volume["status"]}')
+            self.volumes[volume_id]['status'] = 'attaching'
+            event = self._start_action(server_id, 'attach_volume')
+            device = '/dev/vd%s' % chr(ord('b') + len(
+                self.servers[server_id]['os-extended-volumes:volumes_attached']
+            ))
+
+            def attached(timestamp):
+                self._finish_event(event, timestamp)
+                self._update_volume(
+                    self.volumes[volume_id], timestamp, 'volume.attach.end',
+                    status='in-use',
+                    attachments=[{'server_id': server_id, 'device': device}])
+                self.servers[server_id][
+                    'os-extended-volumes:volumes_attached'].append(
+                        {'id': volume_id})
+
+            self.schedule(volume_id, 'volume_attach', attached)
+            return {'id': volume_id, 'volumeId': volume_id,
+                    'serverId': server_id, 'device': device}
+
+    def detach_volume(self, server_id, volume_id):
+        with self.lock:
+            self.get_server(server_id)
+            volume = self.get_volume(volume_id)
+            if volume['status'] != 'in-use':
+                raise nova_exc.BadRequest(
+                    400, f'volume {volume_id} status is {volume["status"]}')
+            self.volumes[volume_id]['status'] = 'detaching'
+            event = self._start_action(server_id, 'detach_volume')
+
+            def detached(timestamp):
+                self._finish_event(event, timestamp)
+                self._update_volume(
+                    self.volumes[volume_id], timestamp, 'volume.detach.end',
+                    status='available', attachments=[])
+                self.servers[server_id][
+                    'os-extended-volumes:volumes_attached'] = [
+                        v for v in self.servers[server_id][
+                            'os-extended-volumes:volumes_attached']
+                        if v['id'] != volume_id]
+
+            self.schedule(volume_id, 'volume_detach', detached)
+
+    def list_server_volumes(self, server_id):
+        with self.lock:
+            self.get_server(server_id)
+            attachments = []
+            for volume in self.volumes.values():
+                for attachment in volume['attachments']:
+                    if attachment['server_id'] == server_id:
+                        attachments.append({
+                            'id': volume['id'], 'volumeId': volume['id'],
+                            'serverId': server_id,
+                            'device': attachment['device']})
+            return attachments
+
+
+class FakeServer(FakeResource):
+
+    def get(self):
+        self._add_details(self.manager.get(self.id)._info)
+
+    def delete(self):
+        self.manager.delete(self)
+
+    def force_delete(self):
+        self.manager.delete(self)
+
+    def _action(self, action):
+        self.manager.action(self, action)
+
+    def stop(self):
+        self._action('stop')
+
+    def start(self):
+        self._action('start')
+
+    def reboot(self, reboot_type='SOFT'):
+        self._action('hard_reboot' if reboot_type == 'HARD' else 'reboot')
+
+    def suspend(self):
+        self._action('suspend')
+
+    def resume(self):
+        self._action('resume')
+
+    def pause(self):
+        self._action('pause')
+
+    def unpause(self):
+        self._action('unpause')
+
+    def resize(self, flavor):
+        self._action('resize')
+
+    def migrate(self):
+        self._action('migrate')
+
+    def live_migrate(self, host=None, block_migration='auto'):
+        self._action('live_migrate')
+
+    def backup(self, name, backup_type='daily', rotation=1):
+        self._action('backup')
+
+    def get_console_output(self, length=None):
+        return self.manager.get_console_output(self)
+
+    def interface_attach(self, port_id, net_id, fixed_ip):
+        return self.manager.interface_attach(self, port_id, net_id, fixed_ip)
+
+    def interface_detach(self, port_id):
+        return self.manager.interface_detach(self, port_id)
+
+    def interface_list(self):
+        return self.manager.interface_list(self)
+
+
+class FakeManager(object):
+    service = None
+    error_cls = nova_exc.ClientException
+
+    def __init__(self, cloud: FakeCloud):
+        self.cloud = cloud
+
+    def _call(self, api):
+        self.cloud.call(self.service, api, self.error_cls)
+
+
+class FakeServerManager(FakeManager):
+    service = 'nova'
+
+    def _server(self, info):
+        return FakeServer(self, info)
+
+    @staticmethod
+    def _id(server):
+        return getattr(server, 'id', server)
+
+    def get(self, server):
+        self._call('servers.get')
+        return self._server(self.cloud.get_server(self._id(server)))
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None,
+             sort_keys=None, sort_dirs=None):
+        self._call('servers.list')
+        return [self._server(info) for info in
+                self.cloud.list_servers(search_opts=search_opts,
+                                        marker=marker, limit=limit)]
+
+    def create(self, name, image, flavor, nics=None,
+               block_device_mapping_v2=None, availability_zone=None,
+               min_count=None, max_count=None, return_reservation_id=False,
+               **kwargs):
+        self._call('servers.create')
+        flavor = getattr(flavor, 'id', flavor)
+        image = getattr(image, 'id', image)
+        count = max_count or min_count or 1
+        reservation_id = f'r-{uuid.uuid4().hex}'
+        servers = [
+            self.cloud.create_server(
+                name if count == 1 else f'{name}-{index}', image, flavor,
+                nics=nics, block_device_mapping_v2=block_device_mapping_v2,
+                availability_zone=availability_zone,
+                reservation_id=reservation_id)
+            for index in range(1, count + 1)
+        ]
+        if return_reservation_id:
+            # novaclient returns the reservation id string
+            return reservation_id
+        return self._server(servers[0])
+
+    def delete(self, server):
+        self._call('servers.delete')
+        self.cloud.delete_server(self._id(server))
+
+    def action(self, server, action):
+        self._call(f'servers.{action}')
+        self.cloud.server_action(self._id(server), action)
+
+    def get_console_output(self, server, length=None):
+        self._call('servers.get_console_output')
+        return self.cloud.get_console_output(self._id(server))
+
+    def interface_attach(self, server, port_id, net_id, fixed_ip=None):
+        self._call('servers.interface_attach')
+        return FakeResource(self, self.cloud.attach_interface(
+            self._id(server), net_id=net_id, port_id=port_id))
+
+    def interface_detach(self, server, port_id):
+        self._call('servers.interface_detach')
+        self.cloud.detach_interface(self._id(server), port_id)
+
+    def interface_list(self, server):
+        self._call('servers.interface_list')
+        return [FakeResource(self, vif)
+                for vif in self.cloud.list_interfaces(self._id(server))]
+
+
+class FakeNovaVolumeManager(FakeManager):
+    service = 'nova'
+
+    def create_server_volume(self, server_id, volume_id, device=None):
+        self._call('volumes.create_server_volume')
+        return FakeResource(self, self.cloud.attach_volume(server_id,
+                                                           volume_id))
+
+    def delete_server_volume(self, server_id, volume_id=None,
+                             attachment_id=None):
+        self._call('volumes.delete_server_volume')
+        self.cloud.detach_volume(server_id, volume_id or attachment_id)
+
+    def get_server_volumes(self, server_id):
+        self._call('volumes.get_server_volumes')
+        return [FakeResource(self, info)
+                for info in self.cloud.list_server_volumes(server_id)]
+
+
+class FakeFlavor(FakeResource):
+
+    def get_keys(self):
+        return {}
+
+
+class FakeFlavorManager(FakeManager):
+    service = 'nova'
+
+    def get(self, flavor_id):
+        self._call('flavors.get')
+        if flavor_id not in self.cloud.flavors:
+            raise nova_exc.NotFound(404, f'flavor {flavor_id} not found')
+        return FakeFlavor(self, self.cloud.flavors[flavor_id])
+
+    def list(self, detailed=True, is_public=True):
+        self._call('flavors.list')
+        return [FakeFlavor(self, f) for f in self.cloud.flavors.values()]
+
+    def find(self, **kwargs):
+        self._call('flavors.list')
+        for flavor in self.cloud.flavors.values():
+            if all(flavor.get(k) == v for k, v in kwargs.items()):
+                return FakeFlavor(self, flavor)
+        raise nova_exc.NotFound(404, f'flavor {kwargs} not found')
+
+
+class FakeServiceManager(FakeManager):
+    service = 'nova'
+
+    def list(self, host=None, binary=None):
+        self._call('services.list')
+        return [
+            FakeResource(self, {'id': index, 'host': h,
+                                'binary': 'nova-compute', 'zone': 'nova',
+                                'status': 'enabled', 'state': 'up'})
+            for index, h in enumerate(self.cloud.hosts, start=1)
+            if (not host or h == host) and
+               (not binary or binary == 'nova-compute')
+        ]
+
+
+class FakeHypervisorManager(FakeManager):
+    service = 'nova'
+
+    def list(self, detailed=True):
+        self._call('hypervisors.list')
+        return [FakeResource(self, info)
+                for info in self.cloud.list_hypervisors()]
+
+
+class FakeLimitsManager(FakeManager):
+
+    def __init__(self, cloud, service):
+        super().__init__(cloud)
+        self.service = service
+        if service == 'cinder':
+            self.error_cls = cinder_exc.ClientException
+
+    def get(self, **kwargs):
+        self._call('limits.get')
+        return FakeResource(self, {'absolute': [
+            FakeResource(self, {'name': name, 'value': value})
+            for name, value in self.cloud.get_limits(self.service).items()
+        ]})
+
+
+class FakeInstanceActionManager(FakeManager):
+    service = 'nova'
+
+    def list(self, server):
+        self._call('instance_action.list')
+        server_id = getattr(server, 'id', server)
+        with self.cloud.lock:
+            self.cloud.refresh(server_id)
+            return [FakeResource(self, {k: v for k, v in action.items()
+                                        if k != 'events'})
+                    for action in self.cloud.actions[server_id]]
+
+    def get(self, server, request_id):
+        self._call('instance_action.get')
+        server_id = getattr(server, 'id', server)
+        with self.cloud.lock:
+            self.cloud.refresh(server_id)
+            for action in self.cloud.actions[server_id]:
+                if action['request_id'] == request_id:
+                    return FakeResource(self, {
+                        **action,
+                        'events': [dict(e) for e in action['events']]})
+        raise nova_exc.NotFound(404, f'action {request_id} not found')
+
+
+class FakeNova(object):
+
+    def __init__(self, cloud):
+        self.servers = FakeServerManager(cloud)
+        self.volumes = FakeNovaVolumeManager(cloud)
+        self.flavors = FakeFlavorManager(cloud)
+        self.services = FakeServiceManager(cloud)
+        self.limits = FakeLimitsManager(cloud, 'nova')
+        self.hypervisors = FakeHypervisorManager(cloud)
+        self.instance_action = FakeInstanceActionManager(cloud)
+
+
+class FakeCinderVolumeManager(FakeManager):
+    service = 'cinder'
+    error_cls = cinder_exc.ClientException
+
+    def get(self, volume_id):
+        self._call('volumes.get')
+        return FakeResource(self, self.cloud.get_volume(
+            getattr(volume_id, 'id', volume_id)))
+
+    def create(self, size, name=None, imageRef=None, snapshot_id=None,
+               volume_type=None, **kwargs):
+        self._call('volumes.create')
+        return FakeResource(self, self.cloud.create_volume(
+            size, name=name, image_ref=imageRef, snapshot_id=snapshot_id,
+            volume_type=volume_type))
+
+    def delete(self, volume):
+        self._call('volumes.delete')
+        self.cloud.delete_volume(getattr(volume, 'id', volume))
+
+    def list(self, detailed=True, search_opts=None, marker=None, limit=None,
+             sort=None):
+        self._call('volumes.list')
+        volumes = self.cloud.list_volumes(search_opts=search_opts,
+                                          marker=marker, limit=limit)
+        if not detailed:
+            volumes = [{'id': v['id'], 'name': v['name']} for v in volumes]
+        return [FakeResource(self, info) for info in volumes]
+
+
+class FakeVolumeTypeManager(FakeManager):
+    service = 'cinder'
+    error_cls = cinder_exc.ClientException
+
+    def get(self, volume_type):
+        self._call('types.get')
+        if volume_type not in self.cloud.volume_types:
+            raise cinder_exc.NotFound(404, f'volume type {volume_type} '
+                                           f'not found')
+        return FakeResource(self, self.cloud.volume_types[volume_type])
+
+    def list(self, search_opts=None, is_public=None):
+        self._call('types.list')
+        return [FakeResource(self, t)
+                for t in self.cloud.volume_types.values()]
+
+    def find(self, **kwargs):
+        self._call('types.list')
+        for volume_type in self.cloud.volume_types.values():
+            if all(volume_type.get(k) == v for k, v in kwargs.items()):
+                return FakeResource(self, volume_type)
+        raise cinder_exc.NotFound(404, f'volume type {kwargs} not found')
+
+
+class FakeCinder(object):
+
+    def __init__(self, cloud):
+        self.volumes = FakeCinderVolumeManager(cloud)
+        self.volume_types = FakeVolumeTypeManager(cloud)
+        self.limits = FakeLimitsManager(cloud, 'cinder')
+
+
+class FakeImageManager(FakeManager):
+    service = 'glance'
+
+    def get(self, image_id):
+        self.cloud.call(self.service, 'images.get', glance_exc.HTTPError)
+        if image_id not in self.cloud.images:
+            raise glance_exc.HTTPNotFound(f'image {image_id} not found')
+        return dict(self.cloud.images[image_id])
+
+
+class FakeGlance(object):
+
+    def __init__(self, cloud):
+        self.images = FakeImageManager(cloud)
+
+
+class FakeNeutron(FakeManager):
+    service = 'neutron'
+
+    def _call(self, api):
+        self.cloud.call(self.service, api,
+                        lambda code, msg: neutron_exc.NeutronClientException(
+                            message=msg, status_code=code))
+
+    def show_network(self, network_id, **params):
+        self._call('show_network')
+        if network_id not in self.cloud.networks:
+            raise neutron_exc.NotFound(
+                message=f'network {network_id} not found')
+        return {'network': dict(self.cloud.networks[network_id])}
+
+    def list_networks(self, **params):
+        self._call('list_networks')
+        return {'networks': [dict(n) for n in self.cloud.networks.values()]}
+
+
+class FakeOpenstackClient(client.OpenstackClient):
+    """OpenstackClient whose services are backed by the fake cloud"""
+
+    def __init__(self, cloud: FakeCloud):
+        self.cloud = cloud
+        self.action_events = client.ActionEventsCache()
+        self.auth = None
+        self.session = None
+        self.pools = {}
+        self.keystone = None
+        self.nova = FakeNova(cloud)
+        self.cinder = FakeCinder(cloud)
+        self.glance = FakeGlance(cloud)
+        self.neutron = FakeNeutron(cloud)
+        # the ceph cluster of the fake cloud
+        self.rbd = cloud.rbd
+
+    def resize_pools(self, pool_size, services=None):
+        pass
+
+    def get_pool_stats(self):
+        return {
+            service: {'requests': self.cloud.get_api_calls(service)}
+            for service in self.SERVICES
+        }
+
+    def get_limiter_stats(self):
+        return {}
+
+    def report_pool_stats(self):
+        for service, stats in self.get_pool_stats().items():
+            if stats['requests']:
+                LOG.info('{} fake api calls: {}', service, stats['requests'])
+
+
+_CLOUD = None
+_CLOUD_LOCK = threading.Lock()
+
+
+def _parse_times(items):
+    return {op: float(seconds) for op, seconds in
+            (item.split(':', 1) for item in items)}
+
+
+def get_cloud():
+    """Get the fake cloud of this process, created from [fake] config
+
+    The configured image, flavor and networks of [openstack] and the default
+    volume type are added to the cloud.
+    """
+    global _CLOUD
+
+    with _CLOUD_LOCK:
+        if _CLOUD:
+            # the threads are not inherited by the forked workers
+            if _CLOUD.ticker_pid and _CLOUD.ticker_pid != os.getpid():
+                _CLOUD.start_ticker()
+            return _CLOUD
+        cloud = FakeCloud(
+            transition_times=_parse_times(CONF.fake.transition_times),
+            transition_jitter=CONF.fake.transition_jitter_percent / 100,
+            api_latency=CONF.fake.api_latency_ms / 1000,
+            api_latency_jitter=CONF.fake.api_latency_jitter_percent / 100,
+            api_latency_distribution=CONF.fake.api_latency_distribution,
+            api_error_rate=float(CONF.fake.api_error_rate),
+            boot_error_rate=float(CONF.fake.boot_error_rate),
+            hosts=CONF.fake.hosts,
+            time_scale=float(CONF.fake.time_scale),
+            quotas={resource: int(limit) for resource, limit in
+                    (item.split(':', 1) for item in CONF.fake.quotas)},
+            host_vcpus=CONF.fake.host_vcpus,
+            host_ram_mb=CONF.fake.host_ram_mb,
+            cpu_allocation_ratio=float(
+                CONF.scenario_test.cpu_allocation_ratio),
+            ram_allocation_ratio=float(
+                CONF.scenario_test.ram_allocation_ratio))
+        if CONF.openstack.flavor:
+            cloud.add_flavor(CONF.openstack.flavor,
+                             flavor_id=CONF.openstack.flavor)
+        if CONF.openstack.image_id:
+            cloud.add_image(CONF.openstack.image_id)
+        for net_id in (CONF.openstack.net_ids or []) + \
+                [CONF.openstack.attach_net]:
+            if net_id:
+                cloud.add_network(net_id)
+        cloud.add_volume_type('__DEFAULT__')
+        if CONF.openstack.volume_type:
+            cloud.add_volume_type(CONF.openstack.volume_type,
+                                  type_id=CONF.openstack.volume_type)
+        if CONF.notification.listener == notification.LISTENER_LOCAL:
+            cloud.notifier = notification.get_local_broker()
+            cloud.start_ticker()
+        # never fork the workers while the state is being changed
+        os.register_at_fork(before=cloud.lock.acquire,
+                            after_in_parent=cloud.lock.release,
+                            after_in_child=cloud.lock.release)
+        _CLOUD = cloud
+        return _CLOUD
+
+
+def factory(**kwargs):
+    """Create the fake client, kwargs of the real client are ignored"""
+    return FakeOpenstackClient(get_cloud())
@@ -1,23 +1,34 @@
+import asyncio
 from concurrent import futures
 import random
-import subprocess
+import re
+import time
 import uuid
 
+from cinderclient import exceptions as cinder_exc
 from novaclient import exceptions as nova_exc
 import prettytable
 
-from easy2use.common import retry
 from easy2use.component import pbr
 from easy2use.globals import cfg
 
+from . import cache
 from . import client
+from . import fake
+from . import notification
+from . import poller
+from . import rbd
 from ectoys.common import exceptions
-from ectoys.common import utils
 from ectoys.common import log
+from ectoys.common import polling
+from ectoys.common import ratelimit
+from ectoys.common import utils
 
 CONF = cfg.CONF
 LOG = log.getLogger()
 
+BACKENDS = {'openstack': client, 'fake': fake}
+
 def create_random_str(length):
     return ''.join(
         random.sample(
@@ -28,9 +39,96 @@ def create_random_str(length):
 
 class OpenstackManager:
 
-    def __init__(self):
-        self.client = client.factory()
-        self.flavors_cached = {}
+    def __init__(self, pool_size=None, backend=None):
+        backend = backend or CONF.openstack.backend
+        if backend not in BACKENDS:
+            raise exceptions.InvalidConfig(
+                reason=f'openstack backend must be one of {list(BACKENDS)}')
+        self.client = BACKENDS[backend].factory(
+            pool_size=pool_size or CONF.openstack.pool_size,
+            pool_sizes={
+                service: int(size) for service, size in
+                (item.split(':', 1) for item in CONF.openstack.pool_sizes)
+            },
+            pool_block=CONF.openstack.pool_block,
+            rate_limit=CONF.openstack.rate_limit,
+            rate_limits={
+                service: float(rate) for service, rate in
+                (item.split(':', 1) for item in CONF.openstack.rate_limits)
+            },
+            rate_burst=CONF.openstack.rate_burst)
+        self.cache = cache.get_cache()
+        self._rbd_backend = None
+        self.server_poller = poller.ServerPoller(
+            self.client.nova, interval=CONF.openstack.batch_poll_interval,
+            min_interval=CONF.openstack.batch_poll_min_interval)
+        self.volume_poller = poller.VolumePoller(
+            self.client, interval=CONF.openstack.batch_poll_interval,
+            min_interval=CONF.openstack.batch_poll_min_interval,
+            page_size=CONF.openstack.list_page_size)
+        self.listener = notification.create_listener(self.server_poller,
+                                                     self.volume_poller)
+        if self.listener and not CONF.openstack.batch_poll:
+            LOG.warning('notifications are only used when batch_poll is '
+                        'enabled')
+
+    def _watch_policy(self, policy):
+        # poll slowly as the fallback if the notifications are listened
+        return self.listener.fallback_policy() if self.listener else policy
+
+    def _recheck_server(self, vm):
+        """Check the watched server once more if notifications are listened
+
+        The notifications which arrived after the server was refreshed and
+        before it was watched are lost, the fallback polling is slow.
+        """
+        if not self.listener:
+            return
+        try:
+            info = self.client.nova.servers.get(vm.id)._info
+        except nova_exc.NotFound:
+            info = {'OS-EXT-STS:vm_state': 'deleted',
+                    'OS-EXT-STS:task_state': None}
+        except Exception as e:
+            LOG.warning('recheck server failed: {}', e, vm=vm.id)
+            return
+        self.server_poller.notify(vm.id, info)
+
+    def _recheck_volume(self, volume_id):
+        """The volume version of _recheck_server"""
+        if not self.listener:
+            return
+        try:
+            info = self.client.get_volume(volume_id)._info
+        except cinder_exc.NotFound:
+            info = None
+        except Exception as e:
+            LOG.warning('recheck volume {} failed: {}', volume_id, e)
+            return
+        self.volume_poller.notify(volume_id, info, missing=info is None)
+
+    def close(self):
+        """Stop the notification listener and close the rbd connection,
+        call it when the manager is done
+        """
+        if self.listener:
+            self.listener.stop()
+            self.listener = None
+        # the stub backend belongs to the fake cloud
+        if self._rbd_backend and \
+           self._rbd_backend is not getattr(self.client, 'rbd', None):
+            self._rbd_backend.close()
+        self._rbd_backend = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def resize_pools(self, workers, services=None):
+        # one more connection for the batched pollers
+        self.client.resize_pools(workers + 1, services=services)
 
     def get_task_state(self, vm, refresh=False):
         if refresh:
@@ -42,52 +140,174 @@ class OpenstackManager:
             vm.get()
         return getattr(vm, 'OS-EXT-STS:vm_state')
 
-    def find_servers(self, name=None, status=None, host=None,
-                     all_tenants=False):
+    def iter_servers(self, name=None, status=None, host=None,
+                     all_tenants=False, page_size=None, reservation_id=None):
+        """Find servers page by page
+
+        The filters are sent to nova, the vm_state and host filters are
+        admin only, so they are checked here again. The pages may be
+        smaller than page_size if it's larger than osapi_max_limit of nova,
+        so the pages are listed until an empty one is returned.
+        """
         LOG.debug('find servers with name={}, status={}, host={}'
                   'all_tenants={}', name, status, host, all_tenants)
-        vms = []
+        page_size = page_size or CONF.openstack.list_page_size
         search_opts = {}
         if all_tenants:
             search_opts['all_tenants'] = 1
-        for vm in self.client.nova.servers.list(search_opts=search_opts):
-            vm_state = self.get_vm_state(vm)
-            LOG.debug('name={}, vm_state={}',
-                      vm.id, vm.name, vm_state)
-            if name and (name not in vm.name) or \
-               status and vm_state != status or\
-               host and getattr(vm, 'OS-EXT-SRV-ATTR:host') != host:
-                continue
-            vms.append(vm)
-        return vms
+        if name:
+            # the name filter of nova is a regular expression
+            search_opts['name'] = re.escape(name)
+        if status:
+            search_opts['vm_state'] = status
+        if host:
+            search_opts['host'] = host
+        if reservation_id:
+            search_opts['reservation_id'] = reservation_id
+
+        marker = None
+        while True:
+            vms = self.client.nova.servers.list(search_opts=search_opts,
+                                                marker=marker,
+                                                limit=page_size)
+            LOG.debug('found {} server(s) after marker {}', len(vms), marker)
+            for vm in vms:
+                if name and (name not in vm.name) or \
+                   status and self.get_vm_state(vm) != status or\
+                   host and getattr(vm, 'OS-EXT-SRV-ATTR:host') != host:
+                    continue
+                yield vm
+            if not vms:
+                break
+            marker = vms[-1].id
 
-    def _wait_for_vm(self, vm, status={'active'}, task_states=None, timeout=None,
-                     interval=5):
+    def find_servers(self, name=None, status=None, host=None,
+                     all_tenants=False):
+        return list(self.iter_servers(name=name, status=status, host=host,
+                                      all_tenants=all_tenants))
+
+    def _wait_timeout_error(self, vm, expect):
+        return exceptions.WaitVMStatusTimeout(
+            vm=vm.id, expect=expect,
+            actual=f'{self.get_vm_state(vm)}/{self.get_task_state(vm)}')
+
+    def _wait_for_server(self, vm, check_func, expect=None, timeout=None,
+                         interval=5, op='task'):
+        """Wait until check_func(vm) returns True
+
+        The vm is refreshed once here, then it's watched by the shared
+        server poller if batch_poll is enabled. The probes follow the
+        polling policy of the operation.
+        """
+        policy = polling.get_policy(op, interval=interval)
+        started = time.monotonic()
+
+        if not CONF.openstack.batch_poll:
+            def check_vm():
+                vm.get()
+                return check_func(vm)
+
+            try:
+                polling.wait_until(check_vm, policy, timeout=timeout)
+            except exceptions.LoopTimeout:
+                raise self._wait_timeout_error(vm, expect)
+        else:
+            vm.get()
+            if not check_func(vm):
+                future = self.server_poller.watch(
+                    vm, check_func, policy=self._watch_policy(policy))
+                self._recheck_server(vm)
+                try:
+                    future.result(timeout=timeout)
+                except futures.TimeoutError:
+                    future.cancel()
+                    raise self._wait_timeout_error(vm, expect)
+        polling.get_hints().record(op, time.monotonic() - started)
+        return vm
+
+    async def async_wait_for_server(self, vm, check_func, expect=None,
+                                    timeout=None, interval=5, op='task'):
+        """The coroutine version of _wait_for_server
+
+        Only the requests are run in the executor, the waits don't hold
+        a thread.
+        """
+        policy = polling.get_policy(op, interval=interval)
+        started = time.monotonic()
+
+        if not CONF.openstack.batch_poll:
+            async def check_vm():
+                await utils.to_thread(vm.get)
+                return check_func(vm)
+
+            try:
+                await polling.async_wait_until(check_vm, policy,
+                                               timeout=timeout)
+            except exceptions.LoopTimeout:
+                raise self._wait_timeout_error(vm, expect)
+        else:
+            await utils.to_thread(vm.get)
+            if not check_func(vm):
+                future = self.server_poller.watch(
+                    vm, check_func, policy=self._watch_policy(policy))
+                await utils.to_thread(self._recheck_server, vm)
+                try:
+                    await asyncio.wait_for(asyncio.wrap_future(future),
+                                           timeout)
+                except asyncio.TimeoutError:
+                    raise self._wait_timeout_error(vm, expect)
+        polling.get_hints().record(op, time.monotonic() - started)
+        return vm
+
+    def _vm_status_checker(self, status, task_states):
         if isinstance(status, str):
             states = {status}
         else:
             states = status
         task_states = task_states or [None]
 
-        def check_vm_status():
-            vm.get()
+        def check_vm_status(vm):
             vm_state = self.get_vm_state(vm)
             if vm_state == 'error':
                 raise exceptions.VMIsError(vm=vm.id)
             task_state = self.get_task_state(vm)
             LOG.debug('vm_state={}, stask_state={}',
-                      vm.id, vm_state, task_state)
+                      vm_state, task_state, vm=vm.id)
             return vm_state in states and task_state in task_states
 
-        retry.retry_untile_true(check_vm_status,
-                                interval=interval, timeout=timeout)
+        return (check_vm_status,
+                f'vm_state in {states}, task_state in {task_states}')
 
-        return vm
+    def _wait_for_vm(self, vm, status={'active'}, task_states=None, timeout=None,
+                     interval=5, op='task'):
+        check_func, expect = self._vm_status_checker(status, task_states)
+        return self._wait_for_server(vm, check_func, expect=expect,
+                                     timeout=timeout, interval=interval, op=op)
+
+    async def async_wait_for_vm(self, vm, status={'active'}, task_states=None,
+                                timeout=None, interval=5, op='task'):
+        check_func, expect = self._vm_status_checker(status, task_states)
+        return await self.async_wait_for_server(
+            vm, check_func, expect=expect, timeout=timeout, interval=interval,
+            op=op)
 
     def clean_vms(self, vms):
         for vm in vms:
             self.delete_vm(vm)
 
+    def _check_deleted(self, vm):
+        # the vm_state of error vms is still error while deleting
+        return self.get_vm_state(vm) == 'deleted'
+
+    async def async_delete_vm(self, server, force=False):
+        await utils.to_thread(self.delete_vm, server, wait=False, force=force)
+        try:
+            await self.async_wait_for_server(server, self._check_deleted,
+                                             expect='deleted', op='delete')
+        except nova_exc.NotFound:
+            LOG.debug('deleted', vm=server.id)
+        return server
+
     def delete_vm(self, server, wait=True, force=False):
         if force and not hasattr(server, 'force_delete'):
             raise ValueError('force delete is not support')
@@ -95,60 +315,243 @@ class OpenstackManager:
             server.force_delete()
         else:
             server.delete()
-        LOG.debug('deleting', server.id)
+        LOG.debug('deleting', vm=server.id)
         if wait:
             try:
-                self._wait_for_vm(server, status='deleted')
+                self._wait_for_server(server, self._check_deleted,
+                                      expect='deleted', op='delete')
             except nova_exc.NotFound:
-                LOG.debug('deleted', server.id)
+                LOG.debug('deleted', vm=server.id)
         return server
 
-    def _wait_for_volume_deleted(self, vol, timeout=None, interval=5):
+    def _delete_vm_and_watch(self, server, force=False, bucket=None,
+                             all_tenants=False):
+        """Issue the DELETE request and return a future of the deletion
+
+        The deletion is confirmed by the batched server poller, so the
+        caller thread is not blocked. Without batch_poll the deletion is
+        waited here.
+        """
+        if bucket:
+            bucket.acquire()
+        if not CONF.openstack.batch_poll:
+            future = futures.Future()
+            future.set_result(self.delete_vm(server, force=force))
+            return future
+        self.delete_vm(server, wait=False, force=force)
+        return self.server_poller.watch(
+            server, self._check_deleted,
+            policy=self._watch_policy(polling.get_policy('delete')),
+            all_tenants=all_tenants)
+
+    def _wait_for_volume(self, volume_id, check_func, expect=None,
+                         timeout=None, interval=5, op='volume',
+                         all_tenants=False):
+        """Wait until check_func(volume) returns True
+
+        check_func is called with None if the volume is not found. The
+        volume is fetched once here, then it's watched by the shared volume
+        poller if batch_poll is enabled. all_tenants must be True if the
+        volume may belong to the other projects.
+        """
+        def get_volume():
+            return self._get_volume_or_none(volume_id)
+
+        policy = polling.get_policy(op, interval=interval)
+        started = time.monotonic()
+
+        if not CONF.openstack.batch_poll:
+            volumes = [None]
+
+            def check_volume():
+                volumes[0] = get_volume()
+                return check_func(volumes[0])
 
-        def is_volume_not_found():
             try:
-                self.client.cinder.volumes.get(vol.id)
-            except Exception as e:
-                LOG.debug(e)
-                return True
+                polling.wait_until(check_volume, policy, timeout=timeout)
+            except exceptions.LoopTimeout:
+                raise exceptions.WaitVolumeStatusTimeout(
+                    volume=volume_id, expect=expect,
+                    actual=volumes[0] and volumes[0].status)
+            vol = volumes[0]
+        else:
+            vol = get_volume()
+            if not check_func(vol):
+                future = self.volume_poller.watch(
+                    vol, check_func, policy=self._watch_policy(policy),
+                    all_tenants=all_tenants)
+                self._recheck_volume(volume_id)
+                try:
+                    vol = future.result(timeout=timeout)
+                except futures.TimeoutError:
+                    future.cancel()
+                    # report the latest status like the non-batch path
+                    vol = get_volume()
+                    raise exceptions.WaitVolumeStatusTimeout(
+                        volume=volume_id, expect=expect,
+                        actual=vol and vol.status)
+        polling.get_hints().record(op, time.monotonic() - started)
+        return vol
+
+    async def async_wait_for_volume(self, volume_id, check_func, expect=None,
+                                    timeout=None, interval=5, op='volume',
+                                    all_tenants=False):
+        """The coroutine version of _wait_for_volume"""
+        policy = polling.get_policy(op, interval=interval)
+        started = time.monotonic()
+
+        if not CONF.openstack.batch_poll:
+            volumes = [None]
+
+            async def check_volume():
+                volumes[0] = await utils.to_thread(self._get_volume_or_none,
+                                                   volume_id)
+                return check_func(volumes[0])
+
+            try:
+                await polling.async_wait_until(check_volume, policy,
+                                               timeout=timeout)
+            except exceptions.LoopTimeout:
+                raise exceptions.WaitVolumeStatusTimeout(
+                    volume=volume_id, expect=expect,
+                    actual=volumes[0] and volumes[0].status)
+            vol = volumes[0]
+        else:
+            vol = await utils.to_thread(self._get_volume_or_none, volume_id)
+            if not check_func(vol):
+                future = self.volume_poller.watch(
+                    vol, check_func, policy=self._watch_policy(policy),
+                    all_tenants=all_tenants)
+                await utils.to_thread(self._recheck_volume, volume_id)
+                try:
+                    vol = await asyncio.wait_for(asyncio.wrap_future(future),
+                                                 timeout)
+                except asyncio.TimeoutError:
+                    vol = await utils.to_thread(self._get_volume_or_none,
+                                                volume_id)
+                    raise exceptions.WaitVolumeStatusTimeout(
+                        volume=volume_id, expect=expect,
+                        actual=vol and vol.status)
+        polling.get_hints().record(op, time.monotonic() - started)
+        return vol
 
-        retry.retry_untile_true(is_volume_not_found,
-                                interval=interval, timeout=timeout)
+    def _get_volume_or_none(self, volume_id):
+        try:
+            return self.client.get_volume(volume_id)
+        except cinder_exc.NotFound:
+            return None
+
+    @staticmethod
+    def _check_volume_deleted(volume):
+        if volume:
+            LOG.debug('volume {} status: {}', volume.id, volume.status)
+        return volume is None
+
+    def _wait_for_volume_deleted(self, vol, timeout=None, interval=5,
+                                 all_tenants=False):
+        self._wait_for_volume(vol.id, self._check_volume_deleted,
+                              expect='deleted', timeout=timeout,
+                              interval=interval, op='volume_delete',
+                              all_tenants=all_tenants)
 
     def delete_vms(self, name=None, host=None, status=None, all_tenants=False,
-                   workers=None, force=False):
+                   workers=None, force=False, rate=None, timeout=600,
+                   on_done=None):
+        """Delete servers with a pipeline
+
+        The stages overlap: listing the pages, issuing the DELETE requests
+        with workers (at most `rate` requests per second) and confirming the
+        deletions with the batched server poller. The servers which are not
+        deleted in `timeout` seconds after the requests are logged.
+        on_done(server, duration, error) is called when the deletion of every
+        server is confirmed or failed.
+        """
         workers = workers or 1
-        servers = self.find_servers(name=name, status=status, host=host,
-                                    all_tenants=all_tenants)
-        LOG.info('found {} deletable server(s)', len(servers))
-        if not servers:
-            return
+        self.resize_pools(workers, services=['nova'])
+        bucket = ratelimit.TokenBucket(rate) if rate else None
+
+        def delete_vm(vm):
+            started = time.monotonic()
+            try:
+                deletion = self._delete_vm_and_watch(
+                    vm, force=force, bucket=bucket, all_tenants=all_tenants)
+            except Exception as e:
+                if on_done:
+                    on_done(vm, time.monotonic() - started, e)
+                raise
+            if on_done:
+                deletion.add_done_callback(lambda f: on_done(
+                    vm, time.monotonic() - started,
+                    futures.CancelledError() if f.cancelled()
+                    else f.exception()))
+            return deletion
 
         with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            tasks = [executor.submit(self.delete_vm, vm, force=force)
-                    for vm in servers]
+            # the deletions start while the next pages are being listed
+            tasks = [executor.submit(delete_vm, vm)
+                     for vm in self.iter_servers(name=name, status=status,
+                                                 host=host,
+                                                 all_tenants=all_tenants)]
+            LOG.info('found {} deletable server(s)', len(tasks))
+            if not tasks:
+                return
+
+            deletions = []
+            for task in futures.as_completed(tasks):
+                try:
+                    deletions.append(task.result())
+                except Exception as e:
+                    LOG.error('delete server failed: {}', e)
 
-            with pbr.progressbar(len(servers), description='delete vm') as bar:
-                for _ in futures.as_completed(tasks):
+        with pbr.progressbar(len(tasks), description='delete vm') as bar:
+            bar.update(len(tasks) - len(deletions))
+            try:
+                for deletion in futures.as_completed(deletions,
+                                                     timeout=timeout):
+                    if deletion.exception():
+                        LOG.error('wait server deleted failed: {}',
+                                  deletion.exception())
                     bar.update(1)
+            except futures.TimeoutError:
+                LOG.error('{} server(s) are not deleted in {}s',
+                          sum(not d.done() for d in deletions), timeout)
+                for deletion in deletions:
+                    deletion.cancel()
         bar.close()
 
     def create_volumes(self, size, name=None, num=1, workers=None, image=None,
-                       snapshot=None, volume_type=None, pbr_driver=None):
+                       snapshot=None, volume_type=None, pbr_driver=None,
+                       on_done=None):
+        """Create the volumes concurrently and wait for them
+
+        on_done(volume, duration, error) is called when every volume is
+        created or failed, the volume is None if it failed.
+        """
         name = name or utils.generate_name('vol')
         workers = workers or num
         LOG.info('Try to create {} volume(s), name: {}, image: {}, '
                  'snapshot: {}, workers: {} ', num, name, image, snapshot,
                  workers)
         volumes = []
-        
-        
+        self.resize_pools(workers, services=['cinder'])
+
+        def create_volume(index):
+            started = time.monotonic()
+            try:
+                vol = self.create_volume(
+                    size_gb=size, name=f'{name}-{index}', image=image,
+                    snapshot=snapshot, volume_type=volume_type, wait=True)
+            except Exception as e:
+                if on_done:
+                    on_done(None, time.monotonic() - started, e)
+                raise
+            if on_done:
+                on_done(vol, time.monotonic() - started, None)
+            return vol
+
         with futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            tasks = [executor.submit(self.create_volume,
-                                     size_gb=size, name=f'{name}-{index}',
-                                     image=image, snapshot=snapshot,
-                                     volume_type=volume_type, wait=True)
-                for index in range(1, num + 1)]
+            tasks = [executor.submit(create_volume, index)
+                     for index in range(1, num + 1)]
             LOG.info('Creating, please be patient ...')
             for task in futures.as_completed(tasks):
                 vol = task.result()
@@ -162,16 +565,7 @@ class OpenstackManager:
     def create_volume(self, size_gb=None, name=None, image=None,
                        snapshot=None, wait=False, interval=1,
                        volume_type=None):
-        timeout = 600
-
-        def compute_volume_finished(result):
-            LOG.debug('volume {} status: {}', result.id, result.status)
-            if result.status == 'error':
-                LOG.error('volume {} created failed', result.id)
-                return exceptions.VolumeCreateTimeout(volume=result.id,
-                                                      timeout=timeout)
-            return result.status == 'available'
-
+        timeout = CONF.scenario_test.volume_wait_timeout
         name = name or utils.generate_name('vol')
         LOG.debug('creating volume {}, image={}, snapshot={}',
                   name, image, snapshot)
@@ -184,13 +578,61 @@ class OpenstackManager:
             raise
 
         if wait:
-            # TODO: add timeout argument
-            retry.retry_for(self.client.get_volume, args=(vol.id,),
-                            interval=interval, timeout=timeout,
-                            finish_func=compute_volume_finished)
+            vol = self._wait_for_volume(vol.id,
+                                        self._volume_created_checker(vol.id),
+                                        expect='available',
+                                        timeout=timeout, interval=interval,
+                                        op='volume_create')
 
         return vol
 
+    def _volume_created_checker(self, volume_id):
+
+        def compute_volume_finished(result):
+            if not result:
+                raise exceptions.VolumeCreateFailed(volume=volume_id)
+            LOG.debug('volume {} status: {}', result.id, result.status)
+            if result.status == 'error':
+                LOG.error('volume {} created failed', result.id)
+                raise exceptions.VolumeCreateFailed(volume=result.id)
+            return result.status == 'available'
+
+        return compute_volume_finished
+
+    async def async_create_volume(self, size_gb=None, name=None, image=None,
+                                  snapshot=None, interval=1,
+                                  volume_type=None):
+        """Create the volume and wait for it available"""
+        name = name or utils.generate_name('vol')
+        LOG.debug('creating volume {}, image={}, snapshot={}',
+                  name, image, snapshot)
+        vol = await utils.to_thread(
+            self.client.create_volume, name, size_gb=size_gb,
+            image_ref=image, snapshot=snapshot, volume_type=volume_type)
+        return await self.async_wait_for_volume(
+            vol.id, self._volume_created_checker(vol.id), expect='available',
+            timeout=CONF.scenario_test.volume_wait_timeout,
+            interval=interval, op='volume_create')
+
+    async def async_create_volumes(self, size, name=None, num=1, image=None,
+                                   snapshot=None, volume_type=None):
+        """The coroutine version of create_volumes
+
+        The volumes are created concurrently, the first error is raised
+        after all of them are finished.
+        """
+        name = name or utils.generate_name('vol')
+        results = await asyncio.gather(
+            *[self.async_create_volume(size_gb=size, name=f'{name}-{index}',
+                                       image=image, snapshot=snapshot,
+                                       volume_type=volume_type)
+              for index in range(1, num + 1)],
+            return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
     def attach_interfaces(self, server_id, net_id, num=1):
         vm = self.client.nova.servers.get(server_id)
         for _ in range(num):
@@ -207,93 +649,209 @@ class OpenstackManager:
             return
 
         for port_id in port_ids:
-            self.client.detach_server_interface(server_id, port_id, wait=True)
-
-    def delete_volumes(self, volumes, workers=None):
-        LOG.debug('try to delete volumes: {}', volumes)
-        with futures.ThreadPoolExecutor(max_workers=workers or 1) as executor:
-            tasks = [executor.submit(self.delete_volume, vol, wait=True)
-                     for vol in volumes]
-            LOG.info('deleting volumes, please be patient ...')
-            completed = 0
-            for _ in futures.as_completed(tasks):
+            self.client.detach_server_interface(
+                server_id, port_id, wait=True,
+                timeout=CONF.scenario_test.detach_interface_wait_timeout,
+                policy=polling.get_policy(
+                    'interface_detach',
+                    interval=CONF.scenario_test.detach_interface_wait_interval))
+
+    def delete_volumes(self, volumes, workers=None, all_tenants=False):
+        """Delete the volumes and wait for them deleted
+
+        volumes may be a generator, at most twice the workers are submitted
+        at the same time, so the deletions start from the first volumes.
+        all_tenants must be True if the volumes may belong to the other
+        projects. Returns the number of the deleted volumes.
+        """
+        workers = workers or 1
+        self.resize_pools(workers, services=['cinder'])
+        LOG.info('deleting volumes, please be patient ...')
+        completed = 0
+        pending = set()
+
+        def wait_pending(return_when):
+            nonlocal completed, pending
+            done, pending = futures.wait(pending, return_when=return_when)
+            for task in done:
+                try:
+                    task.result()
+                    completed += 1
+                    LOG.info('deleted volume {}', completed)
+                except Exception as e:
+                    LOG.error('delete volume failed: {}', e)
+
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for vol in volumes:
+                if len(pending) >= workers * 2:
+                    wait_pending(futures.FIRST_COMPLETED)
+                pending.add(executor.submit(self.delete_volume, vol,
+                                            wait=True,
+                                            all_tenants=all_tenants))
+            wait_pending(futures.ALL_COMPLETED)
+        return completed
+
+    async def async_delete_volumes(self, volumes, all_tenants=False):
+        """The coroutine version of delete_volumes"""
+
+        async def delete_volume(vol):
+            LOG.debug('delete volume {}', vol.id)
+            await utils.to_thread(self.client.delete_volume, vol.id)
+            await self.async_wait_for_volume(
+                vol.id, self._check_volume_deleted, expect='deleted',
+                timeout=60, op='volume_delete', all_tenants=all_tenants)
+
+        completed = 0
+        for result in await asyncio.gather(
+                *[delete_volume(vol) for vol in volumes],
+                return_exceptions=True):
+            if isinstance(result, Exception):
+                LOG.error('delete volume failed: {}', result)
+            else:
                 completed += 1
-                LOG.info('deleted volume {}', completed)
+        return completed
 
-    def delete_volume(self, volume, wait=False):
+    def delete_volume(self, volume, wait=False, all_tenants=False):
         LOG.debug('delete volume {}', volume.id)
         self.client.delete_volume(volume.id)
         if not wait:
             return
-        self._wait_for_volume_deleted(volume, timeout=60)
-
-    def rbd_ls(self, pool):
-        status, lines = subprocess.getstatusoutput(f'rbd ls {pool}')
-        if status != 0:
-            raise RuntimeError(f'Run rbd ls failed, {lines}')
-        return lines.split('\n')
-
-    def rbd_rm(self, pool, image):
-        cmd = f'rbd remove {pool}/{image}'
-        status, output = subprocess.getstatusoutput(cmd)
-        if status != 0:
-            raise RuntimeError(f'Run rbd rm failed, {output}')
-
-    def cleanup_rbd(self, pool, workers=1):
-        volumes = [
-            'volume-{}'.format(vol.id) for vol in self.client.list_volumes()]
-        lines = self.rbd_ls(pool)
-        delete_images = [
-            line for line in lines \
-                if line and line.startswith('volume') and line not in volumes]
-        LOG.info('Found {} image(s)', len(delete_images))
-        if not delete_images:
-            return
-        LOG.info('Try to delete {} image(s) with rbd', len(delete_images))
-
-        def delete_image(image):
-            return self.rbd_rm(pool, image)
-
-        bar = pbr.factory(len(delete_images), driver='logging')
-        with futures.ThreadPoolExecutor(max_workers=workers or 1) as executor:
-            LOG.info('Deleting, please be patient ...')
-            for _ in executor.map(delete_image, delete_images):
-                bar.update(1)
-            bar.close()
+        self._wait_for_volume_deleted(volume, timeout=60,
+                                      all_tenants=all_tenants)
+
+    def get_rbd_backend(self):
+        if not self._rbd_backend:
+            # the fake backend has its own in-memory pools
+            self._rbd_backend = getattr(self.client, 'rbd', None) or \
+                rbd.create_backend()
+        return self._rbd_backend
+
+    def find_orphan_rbd_images(self, pool):
+        """Find the volume images in the pool whose volumes don't exist"""
+        # the images are listed before the volumes, so the images of the
+        # volumes created meanwhile are never orphans
+        images = self.get_rbd_backend().list_images(pool)
+        volume_ids = {vol.id for vol in self.client.iter_volumes(
+            all_tenants=True, detailed=False,
+            page_size=CONF.openstack.list_page_size)}
+        LOG.info('Found {} image(s) in pool {}, {} volume(s)',
+                 len(images), pool, len(volume_ids))
+        return rbd.find_orphans(images, volume_ids)
+
+    def cleanup_rbd(self, pool, workers=1, images=None):
+        """Remove the orphan images, or the images if they are given
+
+        Returns the removed images and the failed images.
+        """
+        if images is None:
+            images = self.find_orphan_rbd_images(pool)
+        LOG.info('Found {} orphan image(s)', len(images))
+        if not images:
+            return [], []
+        LOG.info('Try to delete {} image(s) with rbd', len(images))
+        return rbd.remove_images(self.get_rbd_backend(), pool, images,
+                                 workers=workers)
+
+    def get_zone_services(self, binary='nova-compute'):
+        """Get the services of the binary grouped by the availability zone"""
+
+        def _load():
+            zone_services = {}
+            for service in self.client.nova.services.list(binary=binary):
+                zone_services.setdefault(service.zone, []).append(service)
+            return zone_services
+
+        return self.cache.get(('services', binary), _load)
 
     def get_available_services(self, host=None, zone=None, binary=None):
-        services = self.client.nova.services.list(host=host, binary=binary)
-        if zone:
-            services = [s for s in services if s.zone == zone]
+        zone_services = self.get_zone_services(binary=binary)
+        services = zone_services.get(zone, []) if zone else [
+            s for zone_list in zone_services.values() for s in zone_list]
         return [
             s for s in services if s.status == 'enabled' and s.state == 'up'
+            and (not host or s.host == host)
         ]
 
+    def get_available_hypervisors(self, host=None, zone=None):
+        """Get the hypervisors of the available compute services"""
+        hosts = {s.host for s in self.get_available_services(
+            host=host, zone=zone, binary='nova-compute')}
+        return [h for h in self.client.nova.hypervisors.list()
+                if h.service['host'] in hosts]
+
     def get_flavor_id(self, flavor):
         if not flavor:
             raise exceptions.InvalidConfig(reason='flavor is none')
-        flavor_id = None
-
         try:
             uuid.UUID(flavor)
             return flavor
         except (TypeError, ValueError):
-            if flavor not in self.flavors_cached:
-                flavor_obj = self.client.nova.flavors.find(name=flavor)
-                flavor_id = flavor_obj.id
-                self.flavors_cached[flavor] = flavor_id
-
+            flavor_id = self.cache.get(
+                ('flavor_id', flavor),
+                lambda: self.client.nova.flavors.find(name=flavor).id)
             LOG.debug('the id of flavor {} is: {}', flavor, flavor_id)
-            return self.flavors_cached[flavor]
+            return flavor_id
 
     def get_flavor(self, id_or_name):
-        try:
-            return self.client.nova.flavors.get(id_or_name)
-        except Exception as e:
-            return self.client.nova.flavors.find(name=id_or_name)
+        return self.cache.get(('flavor', id_or_name),
+                              lambda: self.client.get_flavor(id_or_name))
 
     def get_image(self, id_or_name):
-        return self.client.glance.images.get(id_or_name)
+        return self.cache.get(
+            ('image', id_or_name),
+            lambda: self.client.glance.images.get(id_or_name))
+
+    def get_network(self, net_id):
+        return self.cache.get(
+            ('network', net_id),
+            lambda: self.client.neutron.show_network(net_id)['network'])
+
+    def get_volume_type(self, id_or_name):
+
+        def _load():
+            try:
+                return self.client.cinder.volume_types.get(id_or_name)
+            except cinder_exc.NotFound:
+                return self.client.cinder.volume_types.find(name=id_or_name)
+
+        return self.cache.get(('volume_type', id_or_name), _load)
+
+    @staticmethod
+    def _headroom(limits, resources):
+        absolute = {limit.name: limit.value for limit in limits.absolute}
+        headroom = {}
+        for resource, (max_name, used_name) in resources.items():
+            max_value = absolute.get(max_name, -1)
+            headroom[resource] = None if max_value < 0 else \
+                max(max_value - absolute.get(used_name, 0), 0)
+        return headroom
+
+    def get_quota_headroom(self):
+        """Get the free quotas of the project, None means unlimited"""
+        headroom = self._headroom(self.client.nova.limits.get(reserved=True),
+                                  client.ABSOLUTE_LIMITS['nova'])
+        headroom.update(self._headroom(self.client.cinder.limits.get(),
+                                       client.ABSOLUTE_LIMITS['cinder']))
+        return headroom
+
+    def warm_cache(self):
+        """Load the configured resources which are used by the tests"""
+        if CONF.openstack.flavor:
+            self.get_flavor_id(CONF.openstack.flavor)
+            self.get_flavor(CONF.openstack.flavor)
+        if CONF.openstack.image_id:
+            self.get_image(CONF.openstack.image_id)
+        for net_id in (CONF.openstack.net_ids or []) + \
+                [CONF.openstack.attach_net]:
+            if net_id:
+                self.get_network(net_id)
+        if CONF.openstack.volume_type:
+            self.get_volume_type(CONF.openstack.volume_type)
+        self.get_zone_services()
+        LOG.debug('resource cache is warmed: {}', self.cache.to_dict())
+
+    def report_cache_stats(self):
+        LOG.info('resource cache: {}', self.cache.to_dict())
 
     @staticmethod
     def _get_nics():
@@ -301,16 +859,9 @@ class OpenstackManager:
             {'net-id': net_id} for net_id in CONF.openstack.net_ids
         ] if CONF.openstack.net_ids else 'none'
 
-    def create_server(self, name=None, timeout=1800, wait=False):
-        if not name:
-            name = utils.generate_name(
-                CONF.openstack.boot_from_volume and 'vol-vm' or 'img-vm')
-
-        image_id =CONF.openstack.image_id
-        nics = self._get_nics()
-        if not name:
-            name = self.generate_name(
-                CONF.openstack.boot_from_volume and 'vol-vm' or 'img-vm')
+    def _get_boot_args(self):
+        """Get the image, flavor and the other arguments to boot servers"""
+        image_id = CONF.openstack.image_id
         image, block_device_mapping_v2 = None, None
         if CONF.openstack.boot_from_volume:
             block_device_mapping_v2 = [{
@@ -321,27 +872,81 @@ class OpenstackManager:
             }]
         else:
             image = image_id
-        vm = self.client.nova.servers.create(
-            name, image, self.get_flavor_id(CONF.openstack.flavor), nics=nics,
-            block_device_mapping_v2=block_device_mapping_v2,
-            availability_zone=CONF.openstack.boot_az)
+        return image, self.get_flavor_id(CONF.openstack.flavor), {
+            'nics': self._get_nics(),
+            'block_device_mapping_v2': block_device_mapping_v2,
+            'availability_zone': CONF.openstack.boot_az,
+        }
+
+    def create_server(self, name=None, timeout=1800, wait=False):
+        if not name:
+            name = utils.generate_name(
+                CONF.openstack.boot_from_volume and 'vol-vm' or 'img-vm')
+
+        image, flavor_id, kwargs = self._get_boot_args()
+        vm = self.client.nova.servers.create(name, image, flavor_id, **kwargs)
         LOG.info('booting with {}',
-                 'bdm' if block_device_mapping_v2 else 'image',
+                 'bdm' if kwargs['block_device_mapping_v2'] else 'image',
                  vm=vm.id)
         if wait:
             try:
-                self._wait_for_vm(vm, timeout=timeout)
+                self._wait_for_vm(vm, timeout=timeout, op='boot')
             except exceptions.VMIsError:
                 raise exceptions.VmCreatedFailed(vm=vm.id)
             LOG.debug('created, host is {}',
                       vm.id, getattr(vm, 'OS-EXT-SRV-ATTR:host'))
         return vm
 
-    def report_server_actions(self, vm):
+    def create_servers(self, num, name=None, timeout=None):
+        """Boot num servers with one multi-create request
+
+        The servers are found by the reservation id, they are not waited
+        to be active. Less servers are returned if some of them are not
+        found in timeout, which defaults to [boot] timeout.
+        """
+        timeout = timeout or CONF.boot.timeout
+        if not name:
+            name = utils.generate_name(
+                CONF.openstack.boot_from_volume and 'vol-vm' or 'img-vm')
+
+        image, flavor_id, kwargs = self._get_boot_args()
+        reservation_id = str(self.client.nova.servers.create(
+            name, image, flavor_id, min_count=num, max_count=num,
+            return_reservation_id=True, **kwargs))
+        LOG.info('booting {} server(s), reservation id: {}', num,
+                 reservation_id)
+
+        servers = []
+
+        def found_all():
+            servers[:] = self.iter_servers(reservation_id=reservation_id)
+            return len(servers) >= num
+
+        try:
+            polling.wait_until(found_all, polling.PollingPolicy(interval=1),
+                               timeout=timeout)
+        except exceptions.LoopTimeout:
+            LOG.warning('found {}/{} server(s) of reservation {}',
+                        len(servers), num, reservation_id)
+        return servers
+
+    async def async_create_server(self, name=None, timeout=1800):
+        vm = await utils.to_thread(self.create_server, name=name)
+        try:
+            await self.async_wait_for_vm(vm, timeout=timeout, op='boot')
+        except exceptions.VMIsError:
+            raise exceptions.VmCreatedFailed(vm=vm.id)
+        LOG.debug('created, host is {}',
+                  vm.id, getattr(vm, 'OS-EXT-SRV-ATTR:host'))
+        return vm
+
+    def report_server_actions(self, vm, workers=None):
         pt = prettytable.PrettyTable(['Action', 'Event', 'StartTime',
                                       'EndTime', 'Result'])
-        vm_actions = self.client.get_vm_events(vm)
-        vm_actions = sorted(vm_actions, key=lambda x: x[1][0]['start_time'])
+        vm_actions = self.client.get_vm_events(
+            vm, workers=workers or CONF.scenario_test.action_fetch_workers)
+        vm_actions = sorted(vm_actions,
+                            key=lambda x: x[1] and x[1][0]['start_time'] or '')
         for action_name, events in vm_actions:
             for i, event in enumerate(events):
                 pt.add_row([action_name if i == 0 else "",
@@ -353,7 +958,7 @@ class OpenstackManager:
     def get_server_host(self, server):
         return getattr(server, 'OS-EXT-SRV-ATTR:host')
 
-    def _wait_for_console_log(self, vm, interval=10):
+    def _console_log_checker(self, vm):
         def check_vm_console_log():
             output = vm.get_console_output(length=10)
             LOG.debug('console log: {}', vm.id, output)
@@ -369,21 +974,42 @@ class OpenstackManager:
             if match_ok == len(CONF.boot.console_log_ok_keys):
                 return True
 
-        retry.retry_untile_true(check_vm_console_log, interval=interval,
-                                timeout=600)
+        return check_vm_console_log
 
-    def wait_for_vm_task_finished(self, vm, timeout=None, interval=5):
-
-        def check_vm_status():
-            vm.get()
-            task_state = self.get_task_state(vm)
-            LOG.debug('stask_state={}', vm.id, task_state)
-            return not task_state
-
-        retry.retry_untile_true(check_vm_status,
-                                interval=interval, timeout=timeout)
-
-        return vm
+    def _wait_for_console_log(self, vm, interval=10):
+        polling.wait_until(self._console_log_checker(vm),
+                           polling.get_policy('console_log', interval=interval),
+                           timeout=CONF.boot.console_log_timeout)
+
+    async def async_wait_for_console_log(self, vm, interval=10):
+        """Only the console log requests are run in the executor"""
+        check_func = self._console_log_checker(vm)
+
+        async def check_vm_console_log():
+            return await utils.to_thread(check_func)
+
+        await polling.async_wait_until(
+            check_vm_console_log,
+            polling.get_policy('console_log', interval=interval),
+            timeout=CONF.boot.console_log_timeout)
+
+    def _check_task_finished(self, vm):
+        task_state = self.get_task_state(vm)
+        LOG.debug('stask_state={}', task_state, vm=vm.id)
+        return not task_state
+
+    def wait_for_vm_task_finished(self, vm, timeout=None, interval=5,
+                                  op='task'):
+        return self._wait_for_server(vm, self._check_task_finished,
+                                     expect='task_state is None',
+                                     timeout=timeout, interval=interval,
+                                     op=op)
+
+    async def async_wait_for_vm_task_finished(self, vm, timeout=None,
+                                              interval=5, op='task'):
+        return await self.async_wait_for_server(
+            vm, self._check_task_finished, expect='task_state is None',
+            timeout=timeout, interval=interval, op=op)
 
     def get_vm_ips(self, vm):
         ip_list = []
@@ -402,14 +1028,11 @@ class OpenstackManager:
         if not wait:
             return
 
-        def check_volume():
-            vol = self.client.cinder.volumes.get(volume_id)
-            LOG.debug('volume {} status: {}', volume_id, vol.status, vm=vm.id)
-            if vol.status == 'error':
-                raise exceptions.VolumeDetachFailed(volume=volume_id)
-            return vol.status == 'in-use'
-
-        retry.retry_untile_true(check_volume, interval=5, timeout=600)
+        self._wait_for_volume(volume_id,
+                              self._volume_attached_checker(vm, volume_id),
+                              expect='in-use',
+                              timeout=CONF.scenario_test.volume_wait_timeout,
+                              interval=5, op='volume_attach')
         if check_with_qga:
             # qga = guest.QGAExecutor()
             # TODO: check with qga
@@ -417,17 +1040,58 @@ class OpenstackManager:
             LOG.warning('TODO check with qga')
         LOG.info('attached volume {}', volume_id, vm=vm.id)
 
+    def _volume_attached_checker(self, vm, volume_id):
+
+        def check_volume(vol):
+            if not vol:
+                raise exceptions.VolumeAttachtFailed(volume=volume_id)
+            LOG.debug('volume {} status: {}', volume_id, vol.status, vm=vm.id)
+            if vol.status == 'error':
+                raise exceptions.VolumeDetachFailed(volume=volume_id)
+            return vol.status == 'in-use'
+
+        return check_volume
+
+    async def async_attach_volume(self, vm, volume_id):
+        """Attach the volume and wait for it in-use"""
+        await utils.to_thread(self.client.attach_volume, vm.id, volume_id)
+        LOG.info('attaching volume {}', volume_id, vm=vm.id)
+        await self.async_wait_for_volume(
+            volume_id, self._volume_attached_checker(vm, volume_id),
+            expect='in-use', timeout=CONF.scenario_test.volume_wait_timeout,
+            interval=5, op='volume_attach')
+        LOG.info('attached volume {}', volume_id, vm=vm.id)
+
     def detach_volume(self, vm, volume_id, wait=False):
         self.client.detach_volume(vm.id, volume_id)
         LOG.info('detaching volume {}', volume_id, vm=vm.id)
         if not wait:
             return
 
-        def check_volume():
-            vol = self.client.cinder.volumes.get(volume_id)
-            if vol.status == 'error':
+        self._wait_for_volume(volume_id,
+                              self._volume_detached_checker(volume_id),
+                              expect='available',
+                              timeout=CONF.scenario_test.volume_wait_timeout,
+                              interval=5, op='volume_detach')
+        LOG.info('detached volume {}', volume_id, vm=vm.id)
+
+    @staticmethod
+    def _volume_detached_checker(volume_id):
+
+        def check_volume(vol):
+            if not vol or vol.status == 'error':
                 raise exceptions.VolumeDetachFailed(volume=volume_id)
             return vol.status == 'available'
 
-        retry.retry_untile_true(check_volume, interval=5, timeout=600)
+        return check_volume
+
+    async def async_detach_volume(self, vm, volume_id):
+        """Detach the volume and wait for it available"""
+        await utils.to_thread(self.client.detach_volume, vm.id, volume_id)
+        LOG.info('detaching volume {}', volume_id, vm=vm.id)
+        await self.async_wait_for_volume(
+            volume_id, self._volume_detached_checker(volume_id),
+            expect='available',
+            timeout=CONF.scenario_test.volume_wait_timeout,
+            interval=5, op='volume_detach')
         LOG.info('detached volume {}', volume_id, vm=vm.id)
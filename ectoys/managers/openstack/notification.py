@@ -0,0 +1,263 @@
+"""
+Notification listeners
+
+A listener consumes the notifications of nova and cinder and resolves the
+waiters of the batched pollers as soon as the events arrive, the pollers
+keep polling with a long interval as the fallback.
+
+Listeners:
+    local: consume the notifications of the in-process local broker, which
+           the fake backend publishes to.
+    rabbit: consume the oslo.messaging notifications from rabbitmq, the
+            kombu library is required.
+"""
+import json
+import queue
+import socket
+import threading
+import time
+import uuid
+
+from easy2use.globals import cfg
+
+from ectoys.common import exceptions
+from ectoys.common import exporter
+from ectoys.common import log
+from ectoys.common import polling
+
+try:
+    import kombu
+except ImportError:
+    kombu = None
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+LISTENER_LOCAL = 'local'
+LISTENER_RABBIT = 'rabbit'
+
+
+def parse_message(body):
+    """Get the event type and payload of the notification
+
+    The body may be the oslo.messaging envelope or the notification itself.
+    """
+    if isinstance(body, (str, bytes)):
+        body = json.loads(body)
+    if 'oslo.message' in body:
+        body = json.loads(body['oslo.message'])
+    return body.get('event_type'), body.get('payload') or {}
+
+
+def server_info(event_type, payload):
+    """Convert the versioned instance notification to the server info"""
+    data = payload.get('nova_object.data', payload)
+    if 'uuid' not in data or 'state' not in data:
+        return None, None
+    if event_type == 'instance.delete.end':
+        vm_state, task_state = 'deleted', None
+    else:
+        vm_state, task_state = data['state'], data.get('task_state')
+    info = {'OS-EXT-STS:vm_state': vm_state,
+            'OS-EXT-STS:task_state': task_state}
+    if data.get('host'):
+        info['OS-EXT-SRV-ATTR:host'] = data['host']
+    if data.get('updated_at'):
+        info['updated'] = data['updated_at']
+    return data['uuid'], info
+
+
+def volume_info(event_type, payload):
+    """Convert the volume notification to the volume info
+
+    The info is None if the volume is deleted.
+    """
+    if 'volume_id' not in payload:
+        return None, None
+    if event_type == 'volume.delete.end':
+        return payload['volume_id'], None
+    info = {'status': payload.get('status')}
+    if payload.get('updated_at'):
+        info['updated_at'] = payload['updated_at']
+    return payload['volume_id'], info
+
+
+class LocalBroker(object):
+    """In-process stand-in of the message bus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = []
+
+    def subscribe(self):
+        subscriber = queue.Queue()
+        with self._lock:
+            self._subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+
+    def publish(self, event_type, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            subscriber.put({'event_type': event_type, 'payload': payload})
+
+
+_LOCAL_BROKER = LocalBroker()
+
+
+def get_local_broker():
+    return _LOCAL_BROKER
+
+
+class NotificationListener(object):
+    """Base class of the listeners, subclasses implement `_run`"""
+    name = None
+
+    def __init__(self, server_poller, volume_poller, fallback_interval=60):
+        self.server_poller = server_poller
+        self.volume_poller = volume_poller
+        self.fallback_interval = fallback_interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name=f'{self.name}-listener',
+                                        daemon=True)
+        self._thread.start()
+        LOG.info('{} notification listener started', self.name)
+
+    def stop(self):
+        self._stopped.set()
+
+    def _run(self):
+        raise NotImplementedError()
+
+    def fallback_policy(self):
+        """The polling policy of the watched resources"""
+        return polling.PollingPolicy(interval=self.fallback_interval)
+
+    def handle(self, event_type, payload):
+        if not event_type:
+            return
+        exporter.NOTIFICATIONS.inc(event_type=event_type)
+        if event_type.startswith('instance.'):
+            server_id, info = server_info(event_type, payload)
+            if server_id:
+                self.server_poller.notify(server_id, info)
+        elif event_type.startswith('volume.') and event_type.endswith('.end'):
+            volume_id, info = volume_info(event_type, payload)
+            if volume_id:
+                self.volume_poller.notify(volume_id, info,
+                                          missing=info is None)
+
+
+class LocalListener(NotificationListener):
+    name = LISTENER_LOCAL
+
+    def __init__(self, *args, broker=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.broker = broker or get_local_broker()
+        self._subscriber = self.broker.subscribe()
+
+    def stop(self):
+        super().stop()
+        self.broker.unsubscribe(self._subscriber)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                message = self._subscriber.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                self.handle(message['event_type'], message['payload'])
+            except Exception as e:
+                LOG.warning('handle notification {} failed: {}',
+                            message['event_type'], e)
+
+
+class RabbitListener(NotificationListener):
+    """Consume the notifications with temporary queues
+
+    The queues are bound to the `<topic>.info` routing keys of the
+    exchanges, so the notification consumers of the cloud are not affected.
+    """
+    name = LISTENER_RABBIT
+
+    def __init__(self, *args, url=None, exchanges=None, topics=None,
+                 **kwargs):
+        if not kombu:
+            raise exceptions.InvalidConfig(
+                reason='kombu is required by the rabbit listener')
+        if not url:
+            raise exceptions.InvalidConfig(
+                reason='transport_url is required by the rabbit listener')
+        super().__init__(*args, **kwargs)
+        self.url = url
+        self.exchanges = exchanges or ['nova', 'openstack']
+        self.topics = topics or ['versioned_notifications', 'notifications']
+
+    def _queues(self):
+        suffix = uuid.uuid4().hex[:8]
+        return [
+            kombu.Queue(f'ectoys-{exchange}-{topic}-{suffix}',
+                        exchange=kombu.Exchange(exchange, type='topic',
+                                                durable=False),
+                        routing_key=f'{topic}.info', durable=False,
+                        auto_delete=True)
+            for exchange in self.exchanges for topic in self.topics
+        ]
+
+    def _on_message(self, body, message):
+        try:
+            self.handle(*parse_message(body))
+        except Exception as e:
+            LOG.warning('handle notification failed: {}', e)
+        finally:
+            message.ack()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                with kombu.Connection(self.url) as conn:
+                    with conn.Consumer(self._queues(),
+                                       callbacks=[self._on_message],
+                                       accept=['json']):
+                        while not self._stopped.is_set():
+                            try:
+                                conn.drain_events(timeout=1)
+                            except socket.timeout:
+                                continue
+            except Exception as e:
+                LOG.warning('consume notifications failed: {}, '
+                            'reconnect in 5s', e)
+                time.sleep(5)
+
+
+def create_listener(server_poller, volume_poller):
+    """Create and start the listener of [notification] config
+
+    Returns None if the listener is not enabled.
+    """
+    if not CONF.notification.listener:
+        return None
+    kwargs = {'fallback_interval': CONF.notification.fallback_interval}
+    if CONF.notification.listener == LISTENER_LOCAL:
+        listener = LocalListener(server_poller, volume_poller, **kwargs)
+    elif CONF.notification.listener == LISTENER_RABBIT:
+        listener = RabbitListener(server_poller, volume_poller,
+                                  url=CONF.notification.transport_url,
+                                  exchanges=CONF.notification.exchanges,
+                                  topics=CONF.notification.topics, **kwargs)
+    else:
+        raise exceptions.InvalidConfig(
+            reason=f'notification listener must be one of '
+                   f'{[LISTENER_LOCAL, LISTENER_RABBIT]}')
+    listener.start()
+    return listener
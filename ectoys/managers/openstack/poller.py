@@ -0,0 +1,276 @@
+"""
+Batched status pollers
+
+Waiting callers register a check function for a resource and get a future,
+one background thread refreshes all the watched resources with a single list
+request per cycle and resolves the futures.
+
+Each waiter has its own polling policy, the poller lists the resources when
+any waiter is due, but not more often than `min_interval`.
+"""
+from concurrent import futures
+import datetime
+import os
+import threading
+import time
+
+from ectoys.common import exporter
+from ectoys.common import log
+from ectoys.common import polling
+
+LOG = log.getLogger()
+
+
+def parse_time(value):
+    """Parse the updated time of the resources and the notifications"""
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except (AttributeError, ValueError):
+        return None
+    if not parsed.tzinfo:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed
+
+
+class Waiter(object):
+
+    def __init__(self, resource, check_func, policy, all_tenants=False,
+                 updated_field=None):
+        self.resource = resource
+        self.check_func = check_func
+        self.all_tenants = all_tenants
+        # the info older than the resource is ignored, e.g. the late
+        # notifications of the last action
+        self.updated_field = updated_field
+        self.future = futures.Future()
+        self._lock = threading.Lock()
+        self._delays = policy.delays()
+        self.next_probe = time.monotonic() + next(self._delays)
+
+    def advance(self, now):
+        if now >= self.next_probe:
+            self.next_probe = now + next(self._delays)
+
+    def _is_stale(self, info):
+        if not self.updated_field:
+            return False
+        updated = parse_time(info.get(self.updated_field))
+        baseline = parse_time(getattr(self.resource, self.updated_field,
+                                      None))
+        return bool(updated and baseline and updated < baseline)
+
+    def resolve(self, info=None, missing=False):
+        """Update the resource with the new info and run the check function
+
+        If the resource is missing, the check function is called with None.
+        Returns True if the waiter is finished.
+        """
+        # resolved by the poller and the notification listener
+        with self._lock:
+            if self.future.done():
+                return True
+            if info is not None:
+                if self._is_stale(info):
+                    LOG.debug('ignore the stale info of {} {}',
+                              self.resource.id, info)
+                    return False
+                self.resource._add_details(info)
+            try:
+                finished = self.check_func(None if missing else self.resource)
+            except Exception as e:
+                if self.future.set_running_or_notify_cancel():
+                    self.future.set_exception(e)
+                return True
+            if not finished:
+                return False
+            if self.future.set_running_or_notify_cancel():
+                self.future.set_result(self.resource)
+            return True
+
+
+class BatchPoller(object):
+    """Base class of batched pollers
+
+    Subclasses implement `list_resources` which returns a dict of
+    resource id -> resource info for the given waiters. If `detect_missing`
+    is True, the watched resources which are absent from the result are
+    treated as deleted, so the resources must be listed in the scope of the
+    waiters, see `all_tenants`.
+    """
+    name = 'resource'
+    detect_missing = False
+    # the field of the updated time of the resources
+    updated_field = None
+
+    def __init__(self, interval=5, min_interval=1):
+        self.interval = interval
+        self.min_interval = min_interval
+        self._waiters = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._last_poll = 0
+
+    def watch(self, resource, check_func, policy=None,
+              all_tenants=False) -> futures.Future:
+        """Watch the resource until check_func returns True
+
+        all_tenants must be True if the resource may belong to the other
+        projects.
+        """
+        waiter = Waiter(resource, check_func,
+                        policy or polling.PollingPolicy(interval=self.interval),
+                        all_tenants=all_tenants,
+                        updated_field=self.updated_field)
+        with self._lock:
+            self._waiters.setdefault(resource.id, []).append(waiter)
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name=f'{self.name}-poller',
+                    daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return waiter.future
+
+    def pending(self):
+        with self._lock:
+            return sum(len(waiters) for waiters in self._waiters.values())
+
+    def list_resources(self, waiters):
+        raise NotImplementedError()
+
+    @staticmethod
+    def all_tenants(waiters):
+        """Whether the resources of all the projects should be listed"""
+        return any(waiter.all_tenants for resource_waiters in waiters.values()
+                   for waiter in resource_waiters)
+
+    def notify(self, resource_id, info=None, missing=False):
+        """Resolve the waiters of the resource with the notified info"""
+        with self._lock:
+            waiters = list(self._waiters.get(resource_id, []))
+        for waiter in waiters:
+            waiter.resolve(info, missing=missing)
+        if waiters:
+            self._wakeup.set()
+        return bool(waiters)
+
+    def _pending_waiters(self):
+        with self._lock:
+            for resource_id in list(self._waiters):
+                waiters = [w for w in self._waiters[resource_id]
+                           if not w.future.done()]
+                if waiters:
+                    self._waiters[resource_id] = waiters
+                else:
+                    del self._waiters[resource_id]
+            if not self._waiters:
+                self._thread = None
+                return {}
+            return {k: list(v) for k, v in self._waiters.items()}
+
+    def _dispatch(self, waiters, resources):
+        for resource_id, resource_waiters in waiters.items():
+            info = resources.get(resource_id)
+            if info is None and not self.detect_missing:
+                continue
+            for waiter in resource_waiters:
+                waiter.resolve(info, missing=info is None)
+
+    def _next_poll(self, waiters):
+        next_probe = min(waiter.next_probe
+                         for resource_waiters in waiters.values()
+                         for waiter in resource_waiters)
+        return max(next_probe, self._last_poll + self.min_interval)
+
+    def _run(self):
+        while True:
+            waiters = self._pending_waiters()
+            if not waiters:
+                LOG.debug('{} poller stopped', self.name)
+                return
+            delay = self._next_poll(waiters) - time.monotonic()
+            if delay > 0:
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+                continue
+
+            self._last_poll = time.monotonic()
+            exporter.POLLS.inc(kind=f'{self.name}_list')
+            try:
+                resources = self.list_resources(waiters)
+            except Exception as e:
+                LOG.warning('list {}s failed: {}', self.name, e)
+            else:
+                LOG.debug('polled {} {}(s) for {} waiting resource(s)',
+                          len(resources), self.name, len(waiters))
+                self._dispatch(waiters, resources)
+            for resource_waiters in waiters.values():
+                for waiter in resource_waiters:
+                    waiter.advance(self._last_poll)
+
+
+class ServerPoller(BatchPoller):
+    """Refresh all the watched servers with one changes-since list
+
+    The changes-since filter is set to the oldest `updated` time of the
+    watched servers, so any server which changed after the caller refreshed
+    it will be returned, including the deleted ones. The servers of all the
+    projects are listed if any watched server may belong to the other
+    projects.
+    """
+    name = 'server'
+    updated_field = 'updated'
+
+    def __init__(self, nova, interval=5, min_interval=1):
+        super().__init__(interval=interval, min_interval=min_interval)
+        self.nova = nova
+
+    def list_resources(self, waiters):
+        search_opts = {}
+        updated = [w[0].resource.updated for w in waiters.values()
+                   if getattr(w[0].resource, 'updated', None)]
+        if updated:
+            search_opts['changes-since'] = min(updated)
+        if self.all_tenants(waiters):
+            search_opts['all_tenants'] = 1
+        return {
+            server.id: server._info
+            for server in self.nova.servers.list(search_opts=search_opts,
+                                                 limit=-1)
+        }
+
+
+class VolumePoller(BatchPoller):
+    """Refresh all the watched volumes with one paged volume list
+
+    The volumes are matched by id, so the ones which are not in the list
+    any more are deleted, all the pages are listed to find them. Only the
+    volumes whose names contain the common prefix of the watched volumes are
+    listed, and the volumes of all the projects are listed if any watched
+    volume may belong to the other projects.
+    """
+    name = 'volume'
+    detect_missing = True
+    updated_field = 'updated_at'
+
+    def __init__(self, client, interval=5, min_interval=1, page_size=1000):
+        super().__init__(interval=interval, min_interval=min_interval)
+        self.client = client
+        self.page_size = page_size
+
+    @staticmethod
+    def name_prefix(waiters):
+        names = [getattr(w[0].resource, 'name', None) or ''
+                 for w in waiters.values()]
+        return os.path.commonprefix(names)
+
+    def list_resources(self, waiters):
+        return {
+            vol.id: vol._info
+            for vol in self.client.iter_volumes(
+                all_tenants=self.all_tenants(waiters),
+                name_like=self.name_prefix(waiters),
+                page_size=self.page_size)
+            if vol.id in waiters
+        }
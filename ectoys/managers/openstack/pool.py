@@ -0,0 +1,200 @@
+"""
+HTTP connection pools of the openstack clients
+
+Every service client uses its own requests session with a sized connection
+pool. The pools record the time waiting for a connection and how many
+requests reuse a kept-alive connection.
+
+The requests of a service can be limited by a token bucket which is shared
+by all the clients in the process, the Retry-After header of 429 and 503
+responses pauses the bucket and the request is sent again.
+"""
+from email import utils as email_utils
+import socket
+import threading
+import time
+
+import requests
+from requests import adapters
+from urllib3 import connection
+from urllib3 import connectionpool
+
+from ectoys.common import exporter
+from ectoys.common import log
+from ectoys.common import ratelimit
+
+LOG = log.getLogger()
+
+DEFAULT_POOL_SIZE = 10
+RETRY_AFTER_STATUS = (429, 503)
+SOCKET_OPTIONS = connection.HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+]
+
+
+class PoolStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+
+    def add_request(self, wait_time):
+        with self._lock:
+            self.requests += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def add_connection(self):
+        with self._lock:
+            self.connections += 1
+
+    @property
+    def reuse_rate(self):
+        if not self.requests:
+            return 0
+        return max(1 - self.connections / self.requests, 0)
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'connections': self.connections,
+            'reuse_rate': round(self.reuse_rate, 3),
+            'wait_time': round(self.wait_time, 3),
+            'max_wait_time': round(self.max_wait_time, 3),
+        }
+
+
+def _instrumented_pool_class(pool_class, stats):
+
+    class InstrumentedPool(pool_class):
+
+        def _new_conn(self):
+            stats.add_connection()
+            return super()._new_conn()
+
+        def _get_conn(self, timeout=None):
+            started = time.monotonic()
+            try:
+                return super()._get_conn(timeout=timeout)
+            finally:
+                stats.add_request(time.monotonic() - started)
+
+    return InstrumentedPool
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(service, rate, burst=None):
+    """Get the process-wide token bucket of the service"""
+    with _LIMITERS_LOCK:
+        if service not in _LIMITERS:
+            _LIMITERS[service] = ratelimit.TokenBucket(rate, burst=burst)
+        return _LIMITERS[service]
+
+
+def parse_retry_after(value):
+    """Parse Retry-After header, seconds or a http date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        retry_at = email_utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0)
+
+
+class InstrumentedHTTPAdapter(adapters.HTTPAdapter):
+
+    def __init__(self, stats=None, limiter=None, retry_after_times=3,
+                 service=None, **kwargs):
+        self.service = service
+        self.stats = stats or PoolStats()
+        self.limiter = limiter
+        self.retry_after_times = retry_after_times
+        super().__init__(**kwargs)
+
+    def _observe(self, request, code=None):
+        exporter.observe_request(
+            self.service, request.method,
+            exporter.normalize_endpoint(request.path_url), code=code)
+
+    def send(self, request, **kwargs):
+        for retry_times in range(self.retry_after_times + 1):
+            if self.limiter:
+                self.limiter.acquire()
+            try:
+                response = super().send(request, **kwargs)
+            except Exception as e:
+                self._observe(request, code=e.__class__.__name__)
+                raise
+            self._observe(request, code=response.status_code >= 400 and
+                          str(response.status_code) or None)
+            if response.status_code not in RETRY_AFTER_STATUS or \
+               retry_times >= self.retry_after_times:
+                return response
+            retry_after = parse_retry_after(
+                response.headers.get('Retry-After'))
+            if retry_after is None:
+                return response
+            LOG.warning('{} {} returns {}, retry after {}s',
+                        request.method, request.url, response.status_code,
+                        retry_after)
+            response.close()
+            exporter.API_RETRIES.inc(service=self.service)
+            if self.limiter:
+                self.limiter.pause(retry_after)
+            else:
+                time.sleep(retry_after)
+        return response
+
+    def init_poolmanager(self, connections, maxsize, block=False,
+                         **pool_kwargs):
+        pool_kwargs.setdefault('socket_options', SOCKET_OPTIONS)
+        super().init_poolmanager(connections, maxsize, block=block,
+                                 **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _instrumented_pool_class(
+                connectionpool.HTTPConnectionPool, self.stats),
+            'https': _instrumented_pool_class(
+                connectionpool.HTTPSConnectionPool, self.stats),
+        }
+
+
+class ServicePool(object):
+    """The requests session and the connection pool of one service"""
+
+    def __init__(self, service, pool_size=None, block=False, limiter=None):
+        self.service = service
+        self.block = block
+        self.limiter = limiter
+        self.pool_size = 0
+        self.stats = PoolStats()
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+        self.resize(pool_size or DEFAULT_POOL_SIZE)
+
+    def resize(self, pool_size):
+        """Grow the connection pool to pool_size, never shrink it"""
+        with self._lock:
+            if pool_size <= self.pool_size:
+                return
+            adapter = InstrumentedHTTPAdapter(stats=self.stats,
+                                              limiter=self.limiter,
+                                              service=self.service,
+                                              pool_maxsize=pool_size,
+                                              pool_block=self.block)
+            for prefix in ['https://', 'http://']:
+                old_adapter = self.session.adapters.get(prefix)
+                self.session.mount(prefix, adapter)
+                if old_adapter:
+                    old_adapter.close()
+            self.pool_size = pool_size
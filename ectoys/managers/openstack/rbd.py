@@ -0,0 +1,195 @@
+"""
+RBD images of the cinder volumes
+
+Backends:
+    rados: use one persistent connection of the librados/librbd python
+           bindings (python3-rados and python3-rbd), the removals run
+           concurrently on it. The cli backend is used instead if the
+           bindings are not installed.
+    cli: run the rbd command, one process for every removal.
+
+The in-memory StubBackend holds the volume images of the fake openstack
+backend.
+"""
+from concurrent import futures
+import subprocess
+import threading
+
+from easy2use.component import pbr
+from easy2use.globals import cfg
+
+from ectoys.common import exceptions
+from ectoys.common import log
+
+try:
+    import rados
+    import rbd
+except ImportError:
+    rados, rbd = None, None
+
+CONF = cfg.CONF
+LOG = log.getLogger()
+
+VOLUME_PREFIX = 'volume-'
+
+
+class RbdBackend(object):
+    name = None
+
+    def list_images(self, pool):
+        raise NotImplementedError()
+
+    def remove_image(self, pool, image):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class RadosBackend(RbdBackend):
+    """Share one cluster connection and one io context of every pool
+
+    librados is thread-safe and librbd releases the GIL while removing, so
+    the removals of the threads run concurrently on the connection.
+    """
+    name = 'rados'
+
+    def __init__(self, conf_file=None, client_id=None):
+        if not rados:
+            raise exceptions.InvalidConfig(
+                reason='the rados and rbd python bindings are required by '
+                       'the rados backend')
+        self.cluster = rados.Rados(conffile=conf_file, rados_id=client_id)
+        self.cluster.connect()
+        self._ioctxs = {}
+        self._lock = threading.Lock()
+
+    def _ioctx(self, pool):
+        with self._lock:
+            if pool not in self._ioctxs:
+                self._ioctxs[pool] = self.cluster.open_ioctx(pool)
+            return self._ioctxs[pool]
+
+    def list_images(self, pool):
+        return rbd.RBD().list(self._ioctx(pool))
+
+    def remove_image(self, pool, image):
+        rbd.RBD().remove(self._ioctx(pool), image)
+
+    def close(self):
+        with self._lock:
+            for ioctx in self._ioctxs.values():
+                ioctx.close()
+            self._ioctxs = {}
+        self.cluster.shutdown()
+
+
+class CliBackend(RbdBackend):
+    name = 'cli'
+
+    def __init__(self, conf_file=None, client_id=None):
+        self.args = ''
+        if conf_file:
+            self.args += f' -c {conf_file}'
+        if client_id:
+            self.args += f' --id {client_id}'
+
+    def list_images(self, pool):
+        status, output = subprocess.getstatusoutput(
+            f'rbd{self.args} ls {pool}')
+        if status != 0:
+            raise RuntimeError(f'Run rbd ls failed, {output}')
+        return [line for line in output.split('\n') if line]
+
+    def remove_image(self, pool, image):
+        status, output = subprocess.getstatusoutput(
+            f'rbd{self.args} remove {pool}/{image}')
+        if status != 0:
+            raise RuntimeError(f'Run rbd rm failed, {output}')
+
+
+class StubBackend(RbdBackend):
+    """In-memory pools, the images are added by the fake cloud"""
+    name = 'stub'
+
+    def __init__(self, pools=None):
+        # pool: the image names
+        self.pools = {pool: set(images) for pool, images in
+                      (pools or {}).items()}
+        self._lock = threading.Lock()
+
+    def add_image(self, pool, image):
+        with self._lock:
+            self.pools.setdefault(pool, set()).add(image)
+
+    def list_images(self, pool):
+        with self._lock:
+            if pool not in self.pools:
+                raise RuntimeError(f'pool {pool} not found')
+            return sorted(self.pools[pool])
+
+    def remove_image(self, pool, image):
+        with self._lock:
+            if image not in self.pools.get(pool, set()):
+                raise RuntimeError(f'image {pool}/{image} not found')
+            self.pools[pool].remove(image)
+
+
+BACKENDS = {
+    RadosBackend.name: RadosBackend,
+    CliBackend.name: CliBackend,
+}
+
+
+def create_backend(name=None):
+    """Create the backend of [rbd] config"""
+    name = name or CONF.rbd.backend
+    if name not in BACKENDS:
+        raise exceptions.InvalidConfig(
+            reason=f'rbd backend must be one of {list(BACKENDS)}')
+    if name == RadosBackend.name and not rados:
+        LOG.warning('the rados and rbd python bindings are not installed, '
+                    'use the rbd command')
+        name = CliBackend.name
+    return BACKENDS[name](conf_file=CONF.rbd.conf_file,
+                          client_id=CONF.rbd.client_id)
+
+
+def find_orphans(images, volume_ids):
+    """Find the volume images whose volumes don't exist
+
+    volume_ids is a set of the ids of all the volumes.
+    """
+    return [
+        image for image in images
+        if image.startswith(VOLUME_PREFIX) and
+        image[len(VOLUME_PREFIX):] not in volume_ids
+    ]
+
+
+def remove_images(backend: RbdBackend, pool, images, workers=1):
+    """Remove the images concurrently
+
+    Returns the removed images and the failed images.
+    """
+    removed, failed = [], []
+
+    def remove_image(image):
+        try:
+            backend.remove_image(pool, image)
+            return image, None
+        except Exception as e:
+            return image, e
+
+    bar = pbr.factory(len(images), driver='logging')
+    with futures.ThreadPoolExecutor(max_workers=workers or 1) as executor:
+        LOG.info('Deleting, please be patient ...')
+        for image, error in executor.map(remove_image, images):
+            if error:
+                LOG.error('remove {}/{} failed: {}', pool, image, error)
+                failed.append(image)
+            else:
+                removed.append(image)
+            bar.update(1)
+        bar.close()
+    return removed, failed
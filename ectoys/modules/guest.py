@@ -1,9 +1,14 @@
-import json
-import time
 import base64
-import time
+import collections
+from concurrent import futures
 import contextlib
+import fnmatch
+import functools
+import json
 import pathlib
+import queue
+import threading
+import time
 
 import libvirt
 import libvirt_qemu
@@ -12,44 +17,190 @@ from ectoys.common import log
 
 LOG = log.getLogger()
 
+ExecResult = collections.namedtuple('ExecResult',
+                                    ['pid', 'exitcode', 'out', 'err'])
+
+
 class DomainNotFound(Exception):
     def __init__(self, name):
         super().__init__(f'Domain {name} not found.')
 
 
-class Guest(object):
+class DomainNotRunning(Exception):
+    def __init__(self, name, host):
+        super().__init__(f'Domain {name} is not running on {host}.')
 
-    def __init__(self, domain, host=None):
-        self.host = host or 'localhost'
-        self.name_or_id = domain
-        self._domain = None
-        self._connect = None
 
-    @property
-    def connect(self):
-        if not self._connect:
-            self._connect = libvirt.open(f'qemu+tcp://{self.host}/system')
-        return self._connect
+class ConnectionPool(object):
+    """One libvirt connection of every host, shared in the process
 
-    def _lookup_domain(self):
-        LOG.debug('look up domain %s', self.name_or_id)
-        if self._domain:
-            return
-        for func in [self.connect.lookupByName,
-                     self.connect.lookupByUUIDString]:
+    The connections are checked by keepalive and isAlive, the closed or
+    dead connections are opened again by the next `get`. A connection is
+    opened with the lock of its host, the lock of the pool is only held to
+    read and publish it, so a slow host never blocks the others. The domain
+    handles are cached by name and UUID, the cache of the domain is
+    invalidated by its lifecycle events and the cache of the host is
+    invalidated when the connection is closed.
+    """
+
+    def __init__(self, keepalive_interval=5, keepalive_count=3):
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_count = keepalive_count
+        self._lock = threading.RLock()
+        self._connections = {}
+        # host: the lock held while opening the connection of the host
+        self._host_locks = collections.defaultdict(threading.Lock)
+        # host: {name or uuid: domain}
+        self._domains = {}
+        self._event_loop = None
+
+    def _start_event_loop(self):
+        """Run the libvirt event loop for keepalive and the events"""
+        with self._lock:
+            if self._event_loop:
+                return
+            libvirt.virEventRegisterDefaultImpl()
+
+            def _run():
+                while True:
+                    libvirt.virEventRunDefaultImpl()
+
+            self._event_loop = threading.Thread(target=_run,
+                                                name='libvirt-events',
+                                                daemon=True)
+            self._event_loop.start()
+
+    def _open(self, host):
+        self._start_event_loop()
+        LOG.debug('open libvirt connection of {}', host)
+        conn = libvirt.open(f'qemu+tcp://{host}/system')
+        conn.setKeepAlive(self.keepalive_interval, self.keepalive_count)
+        conn.registerCloseCallback(self._on_close, host)
+        conn.domainEventRegisterAny(
+            None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE, self._on_lifecycle,
+            host)
+        return conn
+
+    def _on_close(self, conn, reason, host):
+        LOG.warning('libvirt connection of {} closed, reason: {}',
+                    host, reason)
+        with self._lock:
+            if self._connections.get(host) is conn:
+                self._connections.pop(host)
+                self._domains.pop(host, None)
+
+    def _on_lifecycle(self, conn, dom, event, detail, host):
+        self.invalidate(host, dom.name(), dom.UUIDString())
+
+    def get(self, host):
+        """Get the connection of the host, open it if it's missing or dead"""
+        with self._lock:
+            conn = self._connections.get(host)
+            host_lock = self._host_locks[host]
+        if conn is not None and conn.isAlive():
+            return conn
+        with host_lock:
+            # the connection may be opened by the other threads meanwhile
+            with self._lock:
+                conn = self._connections.get(host)
+            if conn is not None and conn.isAlive():
+                return conn
+            if conn is not None:
+                LOG.warning('libvirt connection of {} is dead, reconnect',
+                            host)
+                with self._lock:
+                    if self._connections.get(host) is conn:
+                        self._connections.pop(host)
+                        self._domains.pop(host, None)
+                with contextlib.suppress(libvirt.libvirtError):
+                    conn.close()
+            conn = self._open(host)
+            with self._lock:
+                self._connections[host] = conn
+            return conn
+
+    def lookup_domain(self, host, name_or_id):
+        """Look up the domain by name or UUID, the handles are cached"""
+        conn = self.get(host)
+        with self._lock:
+            domain = self._domains.get(host, {}).get(name_or_id)
+        if domain is not None:
+            return domain
+        LOG.debug('look up domain {}', name_or_id)
+        for func in [conn.lookupByName, conn.lookupByUUIDString]:
             try:
-                self._domain = func(self.name_or_id)
+                domain = func(name_or_id)
                 break
             except libvirt.libvirtError as e:
                 if e.get_error_code() != libvirt.VIR_ERR_NO_DOMAIN:
                     raise
+        else:
+            raise DomainNotFound(name_or_id)
+        with self._lock:
+            if self._connections.get(host) is conn:
+                domains = self._domains.setdefault(host, {})
+                domains[domain.name()] = domain
+                domains[domain.UUIDString()] = domain
+        return domain
+
+    def list_domains(self, host):
+        """List the running domains of the host, the handles are cached"""
+        conn = self.get(host)
+        domains = conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        with self._lock:
+            if self._connections.get(host) is conn:
+                cached = self._domains.setdefault(host, {})
+                for domain in domains:
+                    cached[domain.name()] = domain
+                    cached[domain.UUIDString()] = domain
+        return domains
+
+    def invalidate(self, host, *names):
+        """Remove the domains of the names, or all the domains of the host"""
+        with self._lock:
+            if not names:
+                self._domains.pop(host, None)
+                return
+            domains = self._domains.get(host, {})
+            for name in names:
+                domains.pop(name, None)
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+            self._domains = {}
+        for conn in connections.values():
+            with contextlib.suppress(libvirt.libvirtError):
+                conn.close()
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def get_pool():
+    """Get the connection pool of this process"""
+    global _POOL
+
+    with _POOL_LOCK:
+        if not _POOL:
+            _POOL = ConnectionPool()
+        return _POOL
+
+
+class Guest(object):
+
+    def __init__(self, domain, host=None):
+        self.host = host or 'localhost'
+        self.name_or_id = domain
+
+    @property
+    def connect(self):
+        return get_pool().get(self.host)
 
     @property
     def domain(self):
-        self._lookup_domain()
-        if not self._domain:
-            raise DomainNotFound(self.name_or_id)
-        return self._domain
+        return get_pool().lookup_domain(self.host, self.name_or_id)
 
     @property
     def uuid(self):
@@ -71,44 +222,47 @@ class Guest(object):
         return json.dumps(
             {'execute': 'guest-exec-status', 'arguments': {'pid': pid}})
 
-    def guest_exec(self, cmd, wait_exists=True, timeout=60):
-        exec_cmd = self._get_agent_exec_cmd(cmd)
-        result = libvirt_qemu.qemuAgentCommand(self.domain, exec_cmd,
-                                               timeout, 0)
-        result_obj = json.loads(result)
-        cmd_pid = result_obj.get('return', {}).get('pid')
-        LOG.debug('[vm: %s] RUN: %s => PID: %s',
-                  self.domain.UUIDString(), cmd, cmd_pid)
+    def _agent_command(self, cmd, timeout):
+        result = libvirt_qemu.qemuAgentCommand(self.domain, cmd, timeout, 0)
+        return json.loads(result).get('return', {})
 
+    def exec_start(self, cmd, timeout=60):
+        """Start the command by guest-exec and return the pid"""
+        cmd_pid = self._agent_command(self._get_agent_exec_cmd(cmd),
+                                      timeout).get('pid')
+        LOG.debug('[vm: {}] RUN: {} => PID: {}', self.uuid, cmd, cmd_pid)
         if not cmd_pid:
             raise RuntimeError('guest-exec pid is none')
-        return (
-            self.guest_exec_status(cmd_pid, wait_exists=wait_exists,
-                                   timeout=timeout)
-            if wait_exists else cmd_pid
-        )
+        return cmd_pid
+
+    def exec_status(self, pid, timeout=60):
+        """Get the status of the guest-exec pid"""
+        return self._agent_command(self._get_agent_exec_status_cmd(pid),
+                                   timeout)
+
+    def guest_exec_async(self, cmd, timeout=60, executor=None):
+        """Run the command and return the future of the ExecResult"""
+        return (executor or get_executor()).submit(self, cmd,
+                                                   timeout=timeout)
+
+    def guest_exec(self, cmd, wait_exists=True, timeout=60):
+        if not wait_exists:
+            return self.exec_start(cmd, timeout=timeout)
+        result = self.guest_exec_async(cmd, timeout=timeout).result()
+        LOG.debug('[vm: {}] PID: {} => OUTPUT: {}', self.uuid, result.pid,
+                  result.out)
+        return result.out or result.err
 
     def guest_exec_status(self, pid, wait_exists=False, timeout=None):
-        cmd_obj = self._get_agent_exec_status_cmd(pid)
-        result_obj = {}
-        start_timeout = time.time()
-        while True:
-            LOG.debug('waiting for %s', pid)
-            result = libvirt_qemu.qemuAgentCommand(self.domain, cmd_obj,
-                                                   timeout, 0)
-            result_obj = json.loads(result)
-            if not wait_exists or result_obj.get('return', {}).get('exited'):
-                break
-            if timeout and (time.time() - start_timeout) >= timeout:
-                raise RuntimeError(f'Waiting for {pid} timeout')
-            time.sleep(1)
-        out_data = result_obj.get('return', {}).get('out-data')
-        err_data = result_obj.get('return', {}).get('err-data')
-        out_decode = out_data and base64.b64decode(out_data)
-        err_decode = err_data and base64.b64decode(err_data)
-        LOG.debug('[vm: %s] PID: %s => OUTPUT: %s',
-                 self.domain.UUIDString(), pid, out_decode)
-        return out_decode or err_decode
+        if wait_exists:
+            result = get_executor().watch(self, pid,
+                                          timeout=timeout).result()
+        else:
+            result = _exec_result(pid, self.exec_status(pid,
+                                                        timeout=timeout or 60))
+        LOG.debug('[vm: {}] PID: {} => OUTPUT: {}', self.uuid, pid,
+                  result.out)
+        return result.out or result.err
 
     def rpm_i(self, rpm_file):
         if rpm_file:
@@ -165,3 +319,206 @@ class Guest(object):
         else:
             device_xml = xml
         self.domain.updateDeviceFlags(device_xml, flags=flags)
+
+
+def _exec_result(pid, status):
+    out_data, err_data = status.get('out-data'), status.get('err-data')
+    return ExecResult(pid, status.get('exitcode'),
+                      out_data and base64.b64decode(out_data),
+                      err_data and base64.b64decode(err_data))
+
+
+class _Watch(object):
+
+    def __init__(self, guest, pid, future, timeout, interval):
+        self.guest = guest
+        self.pid = pid
+        self.future = future
+        self.deadline = timeout and time.monotonic() + timeout
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+
+
+class QGAExecutor(object):
+    """Multiplex the guest-exec commands of many domains
+
+    The commands are started by the worker threads, one scheduler thread
+    submits the status polls of the due pids to a separate pool, so the
+    polls are never queued behind the blocking starts. The interval of every
+    pid grows from min_interval to max_interval while it's running. The
+    results are returned by futures.
+    """
+
+    def __init__(self, workers=16, poll_workers=8, min_interval=0.1,
+                 max_interval=2):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._workers = futures.ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='qga')
+        self._pollers = futures.ThreadPoolExecutor(
+            max_workers=poll_workers, thread_name_prefix='qga-poll')
+        self._cond = threading.Condition()
+        self._watches = []
+        self._thread = None
+
+    def submit(self, guest, cmd, timeout=60):
+        """Start the command and return the future of the ExecResult"""
+        future = futures.Future()
+
+        def _start():
+            try:
+                pid = guest.exec_start(cmd, timeout=timeout)
+            except Exception as e:
+                future.set_exception(e)
+                return
+            self._add(_Watch(guest, pid, future, timeout, self.min_interval))
+
+        self._workers.submit(_start)
+        return future
+
+    def watch(self, guest, pid, timeout=None):
+        """Return the future of the ExecResult of the started pid"""
+        future = futures.Future()
+        self._add(_Watch(guest, pid, future, timeout, self.min_interval))
+        return future
+
+    def _add(self, watch):
+        with self._cond:
+            self._watches.append(watch)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run,
+                                                name='qga-poller',
+                                                daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _poll(self, watch):
+        """Poll the status, returns True if the watch is finished"""
+        try:
+            status = watch.guest.exec_status(watch.pid)
+        except Exception as e:
+            watch.future.set_exception(e)
+            return True
+        if status.get('exited'):
+            watch.future.set_result(_exec_result(watch.pid, status))
+            return True
+        now = time.monotonic()
+        if watch.deadline and now >= watch.deadline:
+            watch.future.set_exception(
+                RuntimeError(f'Waiting for {watch.pid} timeout'))
+            return True
+        watch.interval = min(watch.interval * 2, self.max_interval)
+        watch.next_poll = now + watch.interval
+        return False
+
+    def _poll_and_requeue(self, watch):
+        if not self._poll(watch):
+            self._add(watch)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                due = [w for w in self._watches if w.next_poll <= now]
+                if not due:
+                    self._cond.wait(min(
+                        (w.next_poll for w in self._watches),
+                        default=now + 60) - now)
+                    continue
+                self._watches = [w for w in self._watches
+                                 if w.next_poll > now]
+            LOG.debug('polling {} guest-exec pid(s)', len(due))
+            # the running watches are added back by the pollers
+            for watch in due:
+                self._pollers.submit(self._poll_and_requeue, watch)
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def get_executor():
+    """Get the QGA executor shared in the process"""
+    global _EXECUTOR
+
+    with _EXECUTOR_LOCK:
+        if not _EXECUTOR:
+            _EXECUTOR = QGAExecutor()
+        return _EXECUTOR
+
+
+def find_guests(hosts, domains=None, pattern=None):
+    """Find the running guests of the hosts
+
+    The guests are matched by the names or UUIDs in domains and the name
+    pattern, all the running guests are returned if both are empty.
+    Returns the guests and the errors of the domains which are not found,
+    DomainNotRunning if the domain is defined but not running, otherwise
+    DomainNotFound.
+    """
+    guests, found = [], set()
+    for host in hosts:
+        for domain in get_pool().list_domains(host):
+            name, uuid = domain.name(), domain.UUIDString()
+            if domains and not {name, uuid} & set(domains):
+                continue
+            if pattern and not fnmatch.fnmatch(name, pattern):
+                continue
+            found.update([name, uuid])
+            guests.append(Guest(name, host=host))
+    missing = {}
+    for name in domains or []:
+        if name in found:
+            continue
+        missing[name] = DomainNotFound(name)
+        for host in hosts:
+            with contextlib.suppress(DomainNotFound):
+                get_pool().lookup_domain(host, name)
+                missing[name] = DomainNotRunning(name, host)
+                break
+    return guests, missing
+
+
+def fan_out(guests, cmd, parallel=8, timeout=60, executor=None):
+    """Run the command on the guests concurrently
+
+    At most `parallel` commands run on every host at the same time, the
+    commands are started by the workers of the executor, so its workers
+    should be parallel * the number of the hosts to start them all at once.
+    Yields the guest and the future of the ExecResult as the commands
+    finish, the future has the exception if the command failed to start.
+    """
+    pending = collections.defaultdict(collections.deque)
+    for instance in guests:
+        pending[instance.host].append(instance)
+    finished = queue.Queue()
+    lock = threading.Lock()
+
+    def _on_done(instance, host, future):
+        finished.put((instance, future))
+        _start_next(host)
+
+    def _start_next(host):
+        # the errors are put on the queue, the done callbacks swallow them
+        while True:
+            with lock:
+                if not pending[host]:
+                    return
+                instance = pending[host].popleft()
+            try:
+                future = instance.guest_exec_async(cmd, timeout=timeout,
+                                                   executor=executor)
+            except Exception as e:
+                future = futures.Future()
+                future.set_exception(e)
+                finished.put((instance, future))
+                continue
+            future.add_done_callback(
+                functools.partial(_on_done, instance, host))
+            return
+
+    for host in list(pending):
+        for _ in range(parallel):
+            _start_next(host)
+    for _ in range(len(guests)):
+        yield finished.get()
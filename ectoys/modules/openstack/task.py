@@ -2,13 +2,13 @@ from concurrent import futures
 import random
 
 from easy2use.globals import cfg
-from easy2use.common import retry
 from easy2use.common import colorstr
 from easy2use.common import table
 from easy2use.component import pbr
 
 
 from ectoys.common import log
+from ectoys.common import polling
 from ectoys.common import utils
 from . import manager
 from ...common import exceptions
@@ -19,13 +19,6 @@ LOG = log.getLogger()
 
 
 class VmActionTest(manager.OpenstackManager):
-    flavors = {}
-
-    def _get_flavor(self, flavor_id):
-        if flavor_id not in self.flavors_cached:
-            self.flavors_cached[flavor_id] = self.client.nova.flavors.get(
-                self._get_flavor_id(CONF.openstack.flavor))
-        return self.flavors_cached[flavor_id]
 
     def detach_interfaces_and_wait(self, vm_id, port_ids):
         self.detach_interfaces(vm_id, port_ids=port_ids)
@@ -34,9 +27,11 @@ class VmActionTest(manager.OpenstackManager):
             interfaces = self.client.nova.servers.interface_list(vm_id)
             return all(vif.id not in port_ids for vif in interfaces)
 
-        retry.retry_untile_true(
+        polling.wait_until(
             check_interfaces,
-            interval=CONF.task.detach_interface_wait_interval,
+            polling.get_policy(
+                'interface_detach',
+                interval=CONF.task.detach_interface_wait_interval),
             timeout=CONF.task.detach_interface_wait_timeout)
 
     def create_flavor(self, ram, vcpus, disk=0, metadata=None):
@@ -61,11 +56,11 @@ class VmActionTest(manager.OpenstackManager):
         vm = None
         try:
             vm = self.create_vm(CONF.openstack.image_id,
-                                self._get_flavor_id(CONF.openstack.flavor),
+                                self.get_flavor_id(CONF.openstack.flavor),
                                 nics=self._get_nics())
             LOG.info('[vm: {}] creating', vm.id)
 
-            self._wait_for_vm(vm, timeout=CONF.boot.timeout)
+            self._wait_for_vm(vm, timeout=CONF.boot.timeout, op='boot')
             if CONF.boot.check_console_log:
                 self._wait_for_console_log(vm, interval=10)
             LOG.info('[vm: {}] created, host: {}', vm.id, getattr(vm, 'OS-EXT-SRV-ATTR:host'))
@@ -113,7 +108,8 @@ class VmActionTest(manager.OpenstackManager):
         vm.reboot(reboot_type='HARD')
         LOG.info('[vm: {}] hard rebooting', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 10, interval=5)
+            self._wait_for_vm(vm, timeout=60 * 10, interval=5,
+                              op='hard_reboot')
             if CONF.boot.check_console_log:
                 self._wait_for_console_log(vm, interval=10)
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
@@ -124,14 +120,15 @@ class VmActionTest(manager.OpenstackManager):
         vm.suspend()
         LOG.info('[vm: {}] suspending', vm.id)
         try:
-            self._wait_for_vm(vm, status='suspended', timeout=60 * 5)
+            self._wait_for_vm(vm, status='suspended', timeout=60 * 5,
+                              op='suspend')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.SuspendFailed(vm=vm.id, reason=e)
         LOG.info(colorstr.GreenStr('[vm: {}] suspended'), vm.id)
         vm.resume()
         LOG.info('[vm: {}] resuming', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 5)
+            self._wait_for_vm(vm, timeout=60 * 5, op='resume')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.ResumeFailed(vm=vm.id, reason=e)
         LOG.info(colorstr.GreenStr('[vm: {}] resumed'), vm.id)
@@ -140,14 +137,15 @@ class VmActionTest(manager.OpenstackManager):
         vm.pause()
         LOG.info('[vm: {}] pasuing', vm.id)
         try:
-            self._wait_for_vm(vm, status='paused', timeout=60 * 5)
+            self._wait_for_vm(vm, status='paused', timeout=60 * 5,
+                              op='pause')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.ResumeFailed(vm=vm.id, reason=e)
         LOG.info(colorstr.GreenStr('[vm: {}] paused'), vm.id)
         vm.unpause()
         LOG.info('[vm: {}] unpasuing', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 5)
+            self._wait_for_vm(vm, timeout=60 * 5, op='unpause')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.ResumeFailed(vm=vm.id, reason=e)
         LOG.info(colorstr.GreenStr('[vm: {}] unpaused'), vm.id)
@@ -212,16 +210,16 @@ class VmActionTest(manager.OpenstackManager):
         """Make sure configed actions are all exists"""
         if not CONF.openstack.flavor:
             return
-        self._get_flavor(CONF.openstack.flavor)
+        self.get_flavor(CONF.openstack.flavor)
 
     def check_image(self):
         """Make sure configed actions are all exists"""
         if not CONF.openstack.image_id:
             return
-        self.client.glance.images.get(CONF.openstack.image_id)
+        self.get_image(CONF.openstack.image_id)
 
     def test_resize(self, vm):
-        flavor = self._get_flavor(CONF.openstack.flavor)
+        flavor = self.get_flavor(CONF.openstack.flavor)
         new_flavor = self.create_flavor(flavor.ram + 1024, flavor.vcpus + 1,
                                         disk=flavor.disk,
                                         metadata=flavor.get_keys())
@@ -231,7 +229,7 @@ class VmActionTest(manager.OpenstackManager):
         vm.resize(new_flavor)
         LOG.info('[vm: {}] resizing', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 10, interval=5)
+            self._wait_for_vm(vm, timeout=60 * 10, interval=5, op='resize')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.ResizeFailed(vm=vm.id, reason=e)
         dest_host = getattr(vm, 'OS-EXT-SRV-ATTR:host')
@@ -245,7 +243,7 @@ class VmActionTest(manager.OpenstackManager):
         vm.migrate()
         LOG.info('[vm: {}] cold migrating', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 10, interval=5)
+            self._wait_for_vm(vm, timeout=60 * 10, interval=5, op='migrate')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.MigrateFailed(vm=vm.id, reason=e)
         dest_host = getattr(vm, 'OS-EXT-SRV-ATTR:host')
@@ -262,7 +260,7 @@ class VmActionTest(manager.OpenstackManager):
         vm.live_migrate()
         LOG.info('[vm: {}] live migrating', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 10, interval=5)
+            self._wait_for_vm(vm, timeout=60 * 10, interval=5, op='live_migrate')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.LiveMigrateFailed(vm=vm.id, reason=e)
         dest_host = getattr(vm, 'OS-EXT-SRV-ATTR:host')
@@ -276,7 +274,7 @@ class VmActionTest(manager.OpenstackManager):
         vm.backup(self.generate_name('backup'))
         LOG.info('[vm: {}] backup started', vm.id)
         try:
-            self._wait_for_vm(vm, timeout=60 * 10, interval=5)
+            self._wait_for_vm(vm, timeout=60 * 10, interval=5, op='backup')
         except (exceptions.WaitVMStatusTimeout, exceptions.VMIsError) as e:
             raise exceptions.VMBackupFailed(vm=vm.id, reason=e)
         LOG.info('[vm: {}] backup success', vm.id)
@@ -317,8 +315,9 @@ class VmActionTest(manager.OpenstackManager):
             if match_ok == len(CONF.boot.console_log_ok_keys):
                 return True
 
-        retry.retry_untile_true(check_vm_console_log, interval=interval,
-                                timeout=600)
+        polling.wait_until(check_vm_console_log,
+                           polling.get_policy('console_log', interval=interval),
+                           timeout=CONF.boot.console_log_timeout)
 
     def attach_new_volume(self, vm):
         vol = self._create_volume(size_gb=10, wait=True)
@@ -341,7 +340,9 @@ class VmActionTest(manager.OpenstackManager):
                 raise exceptions.VolumeDetachFailed(volume=volume_id)
             return vol.status == 'in-use'
 
-        retry.retry_untile_true(check_volume, interval=5, timeout=600)
+        polling.wait_until(check_volume,
+                           polling.get_policy('volume_attach', interval=5),
+                           timeout=CONF.scenario_test.volume_wait_timeout)
         if check_with_qga:
             # qga = guest.QGAExecutor()
             # TODO: check with qga
@@ -360,7 +361,9 @@ class VmActionTest(manager.OpenstackManager):
                 raise exceptions.VolumeDetachFailed(volume=volume_id)
             return vol.status == 'available'
 
-        retry.retry_untile_true(check_volume, interval=5, timeout=600)
+        polling.wait_until(check_volume,
+                           polling.get_policy('volume_detach', interval=5),
+                           timeout=CONF.scenario_test.volume_wait_timeout)
         LOG.info('[vm: {}] volume {} detached', vm.id, volume_id)
 
 